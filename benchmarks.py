@@ -0,0 +1,615 @@
+# coding=utf-8
+"""Measure the voxel hot paths without opening a window.
+
+Every benchmark returns a dictionary of plain numbers so the results can be
+written out as JSON and compared between runs:
+
+    python benchmarks.py --sizes 32 64 128 --output results.json
+
+Sessions logged with `main.py --record` can be replayed as benchmarks too,
+with `--replays session.rec`.
+"""
+import argparse
+import json
+import math
+import os
+import random
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, List
+
+import numpy as np
+from panda3d.core import loadPrcFileData
+loadPrcFileData('', 'window-type none\naudio-library-name null')
+
+from direct.showbase.ShowBase import ShowBase
+from panda3d.bullet import BulletBoxShape
+from panda3d.bullet import BulletRigidBodyNode
+from panda3d.bullet import BulletWorld
+from panda3d.core import Camera
+from panda3d.core import PerspectiveLens
+from panda3d.core import Vec3
+
+import crowd
+import culling
+import debris
+import editing
+import network
+import profiling
+import recording
+import terrain
+import voxel
+import voxel_light
+import voxel_physics
+import world_format
+from main import RoomEditor
+from mesh_scheduler import MeshScheduler
+
+WORLD_SIZES = (32, 64, 128)  # Blocks along each side of the terrain
+EDITS = 1000  # Random place/remove toggles per world
+RAYCASTS = 1000
+PHYSICS_BODIES = 100  # Boxes dropped onto the terrain
+PHYSICS_STEPS = 120
+STEP = 1.0 / 60.0
+WALK_STEPS = 240  # Frames spent walking across streamed terrain
+WALK_SPEED = 2.0  # Blocks per frame, much faster than a player runs
+GENERATE_RADIUS = 8  # Chunks around the origin for the generation benchmark
+CROWD_MEMBERS = 500
+NETWORK_CLIENTS = 4  # Editors joining a server on this machine
+DEBRIS_BLOCKS = 2000  # Blocks dropped onto a floor at once
+DEBRIS_TICKS = 60 * 60  # Ticks waited at most for them to settle
+
+
+def timed(function: Callable, *args) -> float:
+    """Return how many seconds calling `function` took."""
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+def make_terrain(size: int, seed: int=0) -> np.ndarray:
+    """Return the positions of rolling hills `size` blocks across."""
+    rng = np.random.default_rng(seed)
+    x, y = np.meshgrid(np.arange(size), np.arange(size), indexing='ij')
+    phase = rng.uniform(0, 2 * math.pi, 2)
+    heights = 8 + 6 * np.sin(x / 9 + phase[0]) * np.cos(y / 7 + phase[1])
+    heights = heights.astype(np.int64)
+    x, y, z = np.broadcast_arrays(x[..., None], y[..., None],
+                                  np.arange(heights.max()))
+    solid = z < heights[..., None]
+    return np.stack((x[solid], y[solid], z[solid]), axis=1)
+
+
+def build_room(mesher: voxel.Mesher) -> voxel.VoxelWorld:
+    """Build the editor's default room using the given mesher."""
+    world = voxel.VoxelWorld(mesher)
+    terrain.ChunkStreamer(world, terrain.RoomGenerator()).update(
+        (0, 0, 0), everything=True)
+    world.flush()
+    return world
+
+
+def bench_meshers() -> List[Dict]:
+    """Compare triangle counts and build times of every mesher."""
+    results = []
+    for mesher in voxel.Mesher:
+        start = time.perf_counter()
+        world = build_room(mesher)
+        results.append({
+            'mesher': mesher.value,
+            'triangles': world.triangle_count,
+            'build_seconds': time.perf_counter() - start,
+        })
+        world.node_path.removeNode()
+    return results
+
+
+def bench_render_modes(size: int) -> List[Dict]:
+    """Compare the buffer sizes and meshing times of every render mode."""
+    positions = make_terrain(size)
+    results = []
+    for mesher in voxel.Mesher:
+        for mode in voxel.RenderMode:
+            world = voxel.VoxelWorld(mesher, render_mode=mode)
+            world.place_voxels(positions)
+            results.append({
+                'size': size,
+                'mesher': mesher.value,
+                'render_mode': mode.value,
+                'mesh_seconds': timed(world.flush),
+                'triangles': world.triangle_count,
+                'buffer_bytes': world.buffer_bytes,
+            })
+            world.node_path.removeNode()
+    return results
+
+
+def bench_shading(size: int) -> List[Dict]:
+    """Measure what baking ambient occlusion costs while meshing, and how
+    many more quads the greedy mesher is left with.
+    """
+    positions = make_terrain(size)
+    results = []
+    for mesher in voxel.Mesher:
+        for occlusion in (False, True):
+            world = voxel.VoxelWorld(mesher, ambient_occlusion=occlusion)
+            world.place_voxels(positions)
+            results.append({
+                'size': size,
+                'mesher': mesher.value,
+                'ambient_occlusion': occlusion,
+                'mesh_seconds': timed(world.flush),
+                'triangles': world.triangle_count,
+            })
+            world.node_path.removeNode()
+    return results
+
+
+def bench_light(size: int) -> Dict:
+    """Time lighting terrain `size` blocks across from scratch, and keeping
+    the light up to date through single voxel edits.
+    """
+    positions = make_terrain(size)
+    world = voxel.VoxelWorld(voxel.Mesher.Greedy)
+    world.place_voxels(positions)
+    engine = voxel_light.LightEngine(world)
+
+    def light():
+        world.set_light_engine(engine)
+        engine.update()
+    result = {'size': size, 'light_seconds': timed(light)}
+
+    rng = random.Random(0)
+    edits = [(rng.randrange(size), rng.randrange(size), rng.randrange(16))
+             for _ in range(EDITS)]
+    for name, voxel_type in (('edit_seconds', None),
+                             ('lamp_edit_seconds', 'lamp')):
+        def churn():
+            for position in edits:
+                if position in world:
+                    world.remove_voxel(position)
+                else:
+                    world.place_voxel(voxel_type, position)
+        result[name] = timed(churn) / EDITS
+    world.node_path.removeNode()
+    return result
+
+
+def bench_world(size: int, mesher: voxel.Mesher=voxel.Mesher.Naive) -> Dict:
+    """Time the hot paths of a world holding terrain `size` blocks across."""
+    positions = make_terrain(size)
+    world = voxel.VoxelWorld(mesher)
+    result = {'size': size, 'mesher': mesher.value, 'voxels': len(positions)}
+
+    def place():
+        world.place_voxels(positions)
+        world.flush()
+    result['place_seconds'] = timed(place)
+    result['chunks'] = len(list(world.chunks))
+    result['triangles'] = world.triangle_count
+
+    def remesh():
+        for chunk in list(world.chunks):
+            world.mark_dirty(chunk.origin)
+        world.flush()
+    result['remesh_seconds'] = timed(remesh)
+
+    scheduler = MeshScheduler(world)
+
+    def remesh_threaded():
+        for chunk in list(world.chunks):
+            world.mark_dirty(chunk.origin)
+        scheduler.finish()
+    result['threaded_remesh_seconds'] = timed(remesh_threaded)
+    scheduler.shutdown()
+
+    rng = random.Random(0)
+    edits = [(rng.randrange(size), rng.randrange(size), rng.randrange(16))
+             for _ in range(EDITS)]
+
+    def churn():
+        for position in edits:
+            if position in world:
+                world.remove_voxel(position)
+            else:
+                world.place_voxel(None, position)
+        world.flush()
+    result['edit_seconds'] = timed(churn) / EDITS
+
+    rays = [((rng.uniform(0, size), rng.uniform(0, size), 20.0),
+             (rng.uniform(-1, 1), rng.uniform(-1, 1), -1.0))
+            for _ in range(RAYCASTS)]
+
+    def cast():
+        for origin, direction in rays:
+            world.raycast(origin, direction, 32)
+    result['raycast_seconds'] = timed(cast) / RAYCASTS
+
+    result.update(bench_physics(world, size))
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'bench.world')
+        result['save_seconds'] = timed(world_format.save, world, path)
+        result['file_bytes'] = os.path.getsize(path)
+        loaded = voxel.VoxelWorld(mesher)
+
+        def load():
+            world_format.load(path, loaded)
+            loaded.flush()
+        result['load_seconds'] = timed(load)
+        loaded.node_path.removeNode()
+
+    world.node_path.removeNode()
+    return result
+
+
+def bench_physics(world: voxel.VoxelWorld, size: int) -> Dict:
+    """Time building the chunk colliders and stepping boxes dropped on them.
+    """
+    physics = BulletWorld()
+    physics.setGravity(Vec3(0, 0, -9.81))
+    parent = render.attachNewNode('physics')
+    colliders = voxel_physics.ChunkColliders(physics, parent)
+    for chunk in world.chunks:
+        colliders.mark_dirty(chunk)
+    result = {'collider_seconds': timed(colliders.update)}
+
+    rng = random.Random(1)
+    shape = BulletBoxShape(Vec3(0.5, 0.5, 0.5))
+    for i in range(PHYSICS_BODIES):
+        node = BulletRigidBodyNode('box')
+        node.setMass(1.0)
+        node.addShape(shape)
+        parent.attachNewNode(node).setPos(
+            rng.uniform(0, size), rng.uniform(0, size), 20 + i % 10)
+        physics.attachRigidBody(node)
+
+    def step():
+        for _ in range(PHYSICS_STEPS):
+            physics.doPhysics(STEP)
+    result['physics_step_seconds'] = timed(step) / PHYSICS_STEPS
+    parent.removeNode()
+    return result
+
+
+def bench_streaming() -> Dict:
+    """Time streaming terrain around a position walking across it."""
+    world = voxel.VoxelWorld()
+    streamer = terrain.ChunkStreamer(world, terrain.HeightmapGenerator())
+
+    def initial():
+        streamer.update((0, 0, 0), everything=True)
+        world.flush()
+    result = {'initial_seconds': timed(initial)}
+
+    most = 0
+
+    def walk():
+        nonlocal most
+        for step in range(WALK_STEPS):
+            streamer.update((step * WALK_SPEED, step * WALK_SPEED / 2, 0))
+            world.flush()
+            most = max(most, len(list(world.chunks)))
+    result['update_seconds'] = timed(walk) / WALK_STEPS
+    result['max_chunks'] = most
+    world.node_path.removeNode()
+    return result
+
+
+def bench_culling() -> Dict:
+    """Count what a camera on the streamed terrain draws with and without
+    cave culling, and time the culling itself.
+    """
+    world = voxel.VoxelWorld(voxel.Mesher.Greedy)
+    terrain.ChunkStreamer(world, terrain.HeightmapGenerator()).update(
+        (0, 0, 0), everything=True)
+    world.flush()
+    camera = render.attachNewNode(Camera('culling', PerspectiveLens()))
+    camera.setPos(0, 0, 16)
+    camera.lookAt(64, 32, 0)
+    culler = culling.ChunkCuller(world, enabled=False)
+    result = {'unculled': culler.update(camera)._asdict()}
+    culler.toggle()
+    result['culled'] = culler.update(camera)._asdict()
+    result['update_seconds'] = timed(culler.update, camera)
+    camera.removeNode()
+    world.node_path.removeNode()
+    return result
+
+
+def bench_lod() -> List[Dict]:
+    """Compare the triangles and meshing time of the streamed terrain at
+    every level of detail, and time switching back to full detail from the
+    mesh cache.
+    """
+    world = voxel.VoxelWorld(voxel.Mesher.Greedy)
+    terrain.ChunkStreamer(world, terrain.HeightmapGenerator()).update(
+        (0, 0, 0), everything=True)
+    results = [{'lod': 0, 'mesh_seconds': timed(world.flush),
+                'triangles': world.triangle_count}]
+    levels = len(voxel.LOD_DISTANCES)
+    for lod in range(1, levels + 1):
+        # Every chunk is past the first `lod` distances.
+        distances = (-math.inf,) * lod + (math.inf,) * (levels - lod)
+
+        def remesh():
+            world.update_lod((0, 0, 0), distances)
+            world.flush()
+        results.append({'lod': lod, 'mesh_seconds': timed(remesh),
+                        'triangles': world.triangle_count})
+
+    def switch():
+        world.update_lod((0, 0, 0), (math.inf,) * levels)
+        world.flush()
+    results.append({'lod': 0, 'cached_switch_seconds': timed(switch),
+                    'triangles': world.triangle_count})
+    world.node_path.removeNode()
+    return results
+
+
+def bench_crowd(members: int=CROWD_MEMBERS) -> Dict:
+    """Time simulating a crowd wandering over the streamed terrain."""
+    world = voxel.VoxelWorld(voxel.Mesher.Greedy)
+    terrain.ChunkStreamer(world, terrain.HeightmapGenerator()).update(
+        (0, 0, 0), everything=True)
+    world.flush()
+    people = crowd.Crowd(world, render, seed=0)
+    rng = np.random.default_rng(0)
+    people.spawn(np.column_stack((rng.uniform(-32, 32, (members, 2)),
+                                  np.full(members, 32.0))))
+
+    def simulate():
+        for _ in range(PHYSICS_STEPS):
+            people.snapshot()
+            people.update(STEP)
+    result = {'members': members,
+              'tick_seconds': timed(simulate) / PHYSICS_STEPS,
+              'draw_seconds': timed(people.draw, 0.5)}
+    people.node_path.removeNode()
+    world.node_path.removeNode()
+    return result
+
+
+def bench_debris(blocks: int=DEBRIS_BLOCKS) -> Dict:
+    """Time ticks of dropping a tall pile of blocks onto a floor, until
+    they have all settled back into voxels.
+    """
+    world = voxel.VoxelWorld()
+    floor = editing.box((-32, -32, 0), (31, 31, 0))
+    world.place_voxels(floor, ['stone'] * len(floor))
+    physics = BulletWorld()
+    physics.setGravity(Vec3(0, 0, -9.81))
+    parent = render.attachNewNode('physics')
+    colliders = voxel_physics.ChunkColliders(physics, parent)
+    world.on_chunk_changed = colliders.mark_dirty
+    for chunk in world.chunks:
+        colliders.mark_dirty(chunk)
+    colliders.update()
+    props = debris.Debris(world, physics, parent, render)
+    side = int(math.ceil(math.sqrt(blocks / 5.0)))
+    pile = editing.box((0, 0, 3), (side - 1, side - 1, 7))[:blocks]
+    props.drop(pile, 'brick')
+
+    seconds = []
+    for _ in range(DEBRIS_TICKS):
+        start = time.perf_counter()
+        colliders.update()
+        props.snapshot()
+        physics.doPhysics(STEP, 2, STEP / 2)
+        props.update(STEP)
+        props.draw(0.5)
+        seconds.append(time.perf_counter() - start)
+        if not len(props) and not props.waiting:
+            break
+    result = {'blocks': len(pile), 'ticks': len(seconds),
+              'settled': len(world) - len(floor),
+              'tick_seconds': float(np.mean(seconds)),
+              'max_tick_seconds': float(np.max(seconds))}
+    props.node_path.removeNode()
+    parent.removeNode()
+    world.node_path.removeNode()
+    return result
+
+
+def bench_network(clients: int=NETWORK_CLIENTS,
+                  generator: terrain.TerrainGenerator=None) -> Dict:
+    """Measure what it takes for editors to join a server streaming
+    generated terrain on this machine, and to keep them in step while one
+    of them edits. The terrain is hills unless another `generator` is given.
+    """
+    generator = generator or terrain.HeightmapGenerator()
+    server = network.WorldServer(voxel.VoxelWorld(), port=0,
+                                 generator=generator)
+    worlds = [voxel.VoxelWorld() for _ in range(clients)]
+    remotes = [network.WorldClient(world, *server.address)
+               for world in worlds]
+    # A little apart, but all close enough to hold the edited chunks.
+    positions = [(i * 8.0, 0.0, 16.0) for i in range(clients)]
+
+    def update():
+        for remote, position in zip(remotes, positions):
+            remote.update(position)
+        server.update()
+
+    start = time.perf_counter()
+    while not all(remote.ready for remote in remotes):
+        update()
+    join_seconds = time.perf_counter() - start
+    joined = [remote.connection.bytes_received for remote in remotes]
+
+    journal = editing.EditJournal(worlds[0])
+    journal.on_change = remotes[0].send_edits
+    rng = random.Random(0)
+    for _ in range(PHYSICS_STEPS):
+        corner = [rng.randint(-8, 8) for _ in range(3)]
+        journal.fill(corner, [c + 2 for c in corner], 'stone')
+        update()
+    for _ in range(10):  # Let the last edits arrive
+        time.sleep(0.001)
+        update()
+    result = {
+        'clients': clients,
+        'generator': type(generator).__name__,
+        'join_seconds': join_seconds,
+        'join_bytes': joined,
+        'edit_bytes_per_tick': [
+            (remote.connection.bytes_received - before) / PHYSICS_STEPS
+            for remote, before in zip(remotes, joined)],
+    }
+    # Palette numbers differ between worlds, so compare the types.
+    edited = editing.box((-8, -8, -8), (10, 10, 10))
+    result['in_step'] = len({
+        tuple(world.palette[i] for i in world.voxel_ids(edited).tolist())
+        for world in worlds + [server.world]}) == 1
+    for remote in remotes:
+        remote.close()
+    server.close()
+    for world in worlds + [server.world]:
+        world.node_path.removeNode()
+    return result
+
+
+def bench_generation(workers: int=None) -> Dict:
+    """Compare generating and meshing a large world in this process with
+    spreading the work over a process pool.
+    """
+    def generate(executor):
+        world = voxel.VoxelWorld(voxel.Mesher.Greedy)
+        streamer = terrain.ChunkStreamer(world, terrain.HeightmapGenerator(),
+                                         radius=GENERATE_RADIUS)
+        scheduler = MeshScheduler(world)
+        start = time.perf_counter()
+        streamer.update((0, 0, 0), everything=True, executor=executor)
+        scheduler.finish(executor)
+        elapsed = time.perf_counter() - start
+        scheduler.shutdown()
+        world.node_path.removeNode()
+        return world, elapsed
+
+    serial, serial_seconds = generate(None)
+    with ProcessPoolExecutor(workers) as executor:
+        executor.submit(int).result()  # Start the workers before timing
+        parallel, parallel_seconds = generate(executor)
+    return {
+        'chunks': len(list(serial.chunks)),
+        'serial_seconds': serial_seconds,
+        'parallel_seconds': parallel_seconds,
+        'workers': workers or os.cpu_count(),
+        'identical': (serial.triangle_count == parallel.triangle_count and
+                      len(serial.palette) == len(parallel.palette) and
+                      all(np.array_equal(c.types, parallel.get_chunk(
+                          c.origin).types) for c in serial.chunks)),
+    }
+
+
+def bench_editing() -> Dict:
+    """Compare filling a box voxel by voxel with filling it as one journaled
+    operation, and time undoing that.
+    """
+    corners = ((0, 0, 16), (31, 31, 23))
+    world = build_room(voxel.Mesher.Greedy)
+
+    def one_by_one():
+        for position in editing.box(*corners).tolist():
+            world.place_voxel('stone', position)
+        world.flush()
+    result = {'voxels': len(editing.box(*corners)),
+              'single_edits_seconds': timed(one_by_one)}
+    world.node_path.removeNode()
+
+    world = build_room(voxel.Mesher.Greedy)
+    journal = editing.EditJournal(world)
+
+    def fill():
+        journal.fill(*corners, 'stone')
+        world.flush()
+
+    def undo():
+        journal.undo()
+        world.flush()
+    result['fill_seconds'] = timed(fill)
+    result['undo_seconds'] = timed(undo)
+    world.node_path.removeNode()
+    return result
+
+
+def bench_replay(path: str) -> Dict:
+    """Time every tick of replaying a recorded session."""
+    editor, seconds = recording.replay(path)
+    result = dict(recording.summarize(seconds), log=path)
+    editor.scheduler.shutdown()
+    editor.node_path.removeNode()
+    editor.physics_np.removeNode()
+    return result
+
+
+def bench_editor() -> Dict:
+    """Time `RoomEditor.update` on the default room, editing every frame."""
+    with tempfile.TemporaryDirectory() as directory:
+        # A missing file makes the editor build its default room.
+        editor = RoomEditor(filepath=os.path.join(directory, 'missing.world'))
+    editor.scheduler.finish()
+    rng = random.Random(0)
+    edits = [(rng.randint(-9, 9), rng.randint(-9, 9), rng.randint(-9, 9))
+             for _ in range(PHYSICS_STEPS)]
+
+    def update():
+        for position in edits:
+            if position in editor:
+                editor.remove_voxel(position)
+            else:
+                editor.place_voxel(None, position)
+            editor.update(STEP)
+    result = {'update_seconds': timed(update) / PHYSICS_STEPS,
+              # Where the last frames went, see `profiling`
+              'hot_paths': profiling.averages()}
+    editor.scheduler.shutdown()
+    editor.node_path.removeNode()
+    editor.physics_np.removeNode()
+    return result
+
+
+def main():
+    """Run all benchmarks and print or save the results as JSON."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=WORLD_SIZES,
+                        help='sides of the terrain worlds to benchmark')
+    parser.add_argument('--output', help='write the JSON results here')
+    parser.add_argument('--replays', nargs='+', default=(), metavar='LOG',
+                        help='recorded sessions to replay')
+    args = parser.parse_args()
+
+    ShowBase()
+    results = {
+        'meshers': bench_meshers(),
+        'render_modes': [result for size in args.sizes
+                         for result in bench_render_modes(size)],
+        'shading': [result for size in args.sizes
+                    for result in bench_shading(size)],
+        'light': [bench_light(size) for size in args.sizes],
+        'worlds': [bench_world(size, mesher)
+                   for size in args.sizes for mesher in voxel.Mesher],
+        'streaming': bench_streaming(),
+        'culling': bench_culling(),
+        'lod': bench_lod(),
+        'crowd': bench_crowd(),
+        'debris': bench_debris(),
+        # The default room's plain block type is None, not a name.
+        'network': [bench_network(generator=generator) for generator in
+                    (terrain.HeightmapGenerator(), terrain.RoomGenerator())],
+        'generation': bench_generation(),
+        'editing': bench_editing(),
+        'editor': bench_editor(),
+        'replays': [bench_replay(path) for path in args.replays],
+    }
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            outfile.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+# coding=utf-8
+"""Describe the kinds of blocks a world can hold and how they look.
+
+Every image used by any block becomes one layer of a single 2D texture
+array, so a chunk can draw blocks of every type with one texture and one
+draw call. Faces pick their layer through the third texture coordinate.
+"""
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+import numpy as np
+from panda3d.core import LoaderOptions
+from panda3d.core import PNMImage
+from panda3d.core import SamplerState
+from panda3d.core import Texture
+
+from panda_utils import find_file
+
+FACE_COUNT = 6  # Faces are numbered like `voxel.UNIT_VECTORS`
+UP, DOWN = 4, 5  # The faces pointing along +z and -z, gravity pulls along -z
+SIDES = (0, 1, 2, 3)
+TILE_SIZE = 16  # Pixels along each side of a tile in a texture sheet
+DEFAULT_IMAGE = 'diffuse.png'
+SHEET = 'texture.png'
+
+# An image file, or a (file, column, row) tile counted from its top left.
+Image = Union[str, Tuple[str, int, int]]
+
+
+class BlockType:
+    """How one kind of block looks: an image for each of its six faces,
+    and the light level it gives off, if it glows.
+    """
+    def __init__(self, name, top: Image, bottom: Image=None,
+                 sides: Image=None, light: int=0):
+        self.name = name
+        self.light = light
+        faces = [sides or top] * FACE_COUNT
+        faces[UP] = top
+        faces[DOWN] = bottom or top
+        self.faces: Tuple[Image, ...] = tuple(faces)
+
+
+class BlockRegistry:
+    """Maps voxel types to block types and their texture array layers.
+    Voxel types that were never registered look like the default block.
+    """
+    def __init__(self, default: Image=DEFAULT_IMAGE):
+        self._images: List[Image] = []
+        self._layers: Dict[Image, int] = {}
+        self._types: Dict[object, BlockType] = {}
+        self.default = BlockType(None, default)
+        self._add_images(self.default.faces)
+
+    def __contains__(self, name):
+        return name in self._types
+
+    def __getitem__(self, name) -> BlockType:
+        return self._types.get(name, self.default)
+
+    @property
+    def layer_count(self) -> int:
+        """The number of layers in the texture array."""
+        return len(self._images)
+
+    def register(self, name, top: Image, bottom: Image=None,
+                 sides: Image=None, light: int=0) -> BlockType:
+        """Add a block type. Register all types before making the texture.
+        """
+        block = self._types[name] = BlockType(name, top, bottom, sides, light)
+        self._add_images(block.faces)
+        return block
+
+    def _add_images(self, images: Iterable[Image]):
+        for image in images:
+            if image not in self._layers:
+                self._layers[image] = len(self._images)
+                self._images.append(image)
+
+    def face_layers(self, name) -> Tuple[int, ...]:
+        """Return the texture layer of each face of a voxel type."""
+        return tuple(self._layers[image] for image in self[name].faces)
+
+    def layer_table(self, voxel_types: Iterable) -> np.ndarray:
+        """Return the layers of each face of each voxel type, as a table
+        indexed by position in `voxel_types` plus one. Row 0 is for air.
+        """
+        rows = [(0,) * FACE_COUNT]
+        rows.extend(self.face_layers(name) for name in voxel_types)
+        return np.array(rows, dtype=np.float32)
+
+    def make_texture(self) -> Texture:
+        """Build the texture array holding every image, one per layer."""
+        texture = Texture('blocks')
+        texture.setup2dTextureArray(TILE_SIZE, TILE_SIZE, len(self._images),
+                                    Texture.T_unsigned_byte, Texture.F_rgba)
+        for layer, image in enumerate(self._images):
+            texture.load(read_image(image), layer, 0, LoaderOptions())
+        texture.setMagfilter(SamplerState.FT_nearest)
+        texture.setMinfilter(SamplerState.FT_nearest)
+        return texture
+
+
+def read_image(image: Image) -> PNMImage:
+    """Load an image or a tile of a sheet as a TILE_SIZE² RGBA image."""
+    column: Optional[int] = None
+    if not isinstance(image, str):
+        image, column, row = image
+    source = PNMImage()
+    if not source.read(find_file(image)):
+        raise IOError('Could not load texture: {}'.format(image))
+    if column is not None:
+        tile = PNMImage(TILE_SIZE, TILE_SIZE, source.getNumChannels())
+        tile.copySubImage(source, 0, 0, column * TILE_SIZE, row * TILE_SIZE,
+                          TILE_SIZE, TILE_SIZE)
+        source = tile
+    result = PNMImage(TILE_SIZE, TILE_SIZE, 4)
+    result.alphaFill(1.0)
+    if source.getXSize() == TILE_SIZE and source.getYSize() == TILE_SIZE:
+        result.copySubImage(source, 0, 0)
+    else:
+        result.quickFilterFrom(source)
+    return result
+
+
+def default_registry() -> BlockRegistry:
+    """Return the block types used by the editor and the terrain."""
+    registry = BlockRegistry()
+    registry.register('grass', top=(SHEET, 1, 2), bottom=(SHEET, 1, 3),
+                      sides=(SHEET, 0, 2))
+    registry.register('dirt', (SHEET, 1, 3))
+    registry.register('stone', (SHEET, 0, 3))
+    registry.register('brick', (SHEET, 2, 2))
+    registry.register('gravel', (SHEET, 2, 3))
+    registry.register('lamp', (SHEET, 3, 2), light=15)
+    return registry
@@ -4,10 +4,11 @@ import math
 
 from panda3d.bullet import BulletCapsuleShape, ZUp
 from panda3d.bullet import BulletCharacterControllerNode
+from panda3d.core import NodePath
 from panda3d.core import Vec2D, Vec3D
 from panda3d.core import Vec3
 
-from fps_controls import FPSControls, ActionKey
+from fps_controls import Controls, ActionKey
 
 
 WALKING_SPEED = 5
@@ -25,9 +26,11 @@ class Character:
     human.
     """
 
-    def __init__(self, world, controls: FPSControls, position: Vec3D, rotation: Vec2D):
+    def __init__(self, world, controls: Controls, position: Vec3D,
+                 rotation: Vec2D, camera: NodePath=None):
         self.rotation = rotation  # horizontal and vertical angle (no roll)
         self.controls = controls
+        self.camera = camera  # Only the player being played looks through it
         self.make_physics(world, position)
 
     def make_physics(self, world, position):
@@ -37,14 +40,25 @@ class Character:
         playerNP = world.physics_np.attachNewNode(self.physics)
         playerNP.setPos(*position)
         playerNP.setH(45)
+        self.node_path = playerNP
 
         world.physics.attachCharacter(playerNP.node())
 
-        # TODO: Shouldn't be on all characters
-        camera.reparentTo(playerNP)
+        # What is drawn follows the physics between ticks
+        self.view_np = world.interpolator.add(playerNP)
+
+        if self.camera is not None:
+            self.camera.reparentTo(self.view_np)
+
+    @property
+    def position(self) -> Vec3D:
+        """Where the character is in the world."""
+        return Vec3D(*self.node_path.getPos(render))
 
     def update(self, dt, world):
+        """Steer the character for one simulation tick."""
         # Check input
+        self.controls.tick()
         movement_direction = self.controls.get_movement_direction()
 
         if self.controls.key_pressed(ActionKey.Jump):
@@ -56,6 +70,8 @@ class Character:
         velocity = self.get_motion_vector(movement_direction) * WALKING_SPEED
         self.physics.setLinearMovement(velocity, True)
 
+    def look(self):
+        """Turn the camera with the mouse, once per frame."""
         # Handle mouse movements
         # TODO: Pull from the fps controls
         dx, dy = self.controls.get_mouse_change()
@@ -66,7 +82,8 @@ class Character:
         self.rotation[1] += dy * 60
         # Clamp to (-pi, pi)
         self.rotation[1] = min(max(-90, self.rotation[1]), 90)
-        base.camera.setHpr(self.rotation[0], self.rotation[1], 0)
+        if self.camera is not None:
+            self.camera.setHpr(self.rotation[0], self.rotation[1], 0)
 
     def get_motion_vector(self, motion: Vec2D) -> Vec3D:
         """ Returns the current motion vector indicating the velocity of the
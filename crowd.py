@@ -0,0 +1,267 @@
+# coding=utf-8
+"""Hundreds of computer-controlled characters, simulated together.
+
+A `Character` owns a Bullet character controller and runs its own Python
+update, which suits players but is far too slow for a crowd. A `Crowd` keeps
+the state of all its members in NumPy arrays with a row per member, and
+steers and moves them all at once every tick. Members collide with the voxels
+directly rather than through Bullet: a body is a column of blocks that walks
+up single steps, falls under gravity and stops at walls. All members are
+drawn as instances of one box, in a single draw call.
+"""
+from typing import Sequence
+
+import numpy as np
+from panda3d.core import BoundingBox
+from panda3d.core import Geom
+from panda3d.core import GeomNode
+from panda3d.core import GeomTriangles
+from panda3d.core import GeomVertexArrayFormat
+from panda3d.core import GeomVertexData
+from panda3d.core import GeomVertexFormat
+from panda3d.core import NodePath
+from panda3d.core import Point3
+from panda3d.core import Shader
+from panda3d.core import Vec3
+from panda3d.core import Vec4
+
+import voxel
+from characters import GRAVITY, PLAYER_HEIGHT, PLAYER_RADIUS, \
+    TERMINAL_VELOCITY, WALKING_SPEED
+from panda_utils import find_file
+
+WANDER_RADIUS = 16.0  # How far from where they stand members walk to
+ARRIVAL_DISTANCE = 1.0  # Members pick somewhere new this close to their goal
+SEPARATION_RADIUS = 1.5  # Members step aside for others closer than this
+SEPARATION_WEIGHT = 1.5  # How much stepping aside counts against walking on
+TURN_RATE = 6.0  # How quickly members take up a new velocity, per second
+BODY_COLOR = (0.8, 0.5, 0.3, 1.0)
+SKIN = 1e-3  # How far past their bodies members look for voxels
+_CELL_ROW = 1 << 32  # Numbers cells and chunks by row, x then y
+
+
+class Crowd:
+    """Computer-controlled characters that wander around a voxel world.
+
+    Positions are where the members' feet are. Call `update()` once per
+    simulation tick, with `snapshot()` before it, and `draw()` once per
+    frame.
+    """
+    def __init__(self, world: voxel.VoxelWorld, parent: NodePath,
+                 seed: int=None):
+        self.world = world
+        self.height = int(round(PLAYER_HEIGHT))  # In blocks
+        self.radius = PLAYER_RADIUS
+        self._rng = np.random.default_rng(seed)
+        self.positions = np.zeros((0, 3))
+        self.velocities = np.zeros((0, 3))
+        self.goals = np.zeros((0, 2))  # Where each member walks to
+        self.speeds = np.zeros(0)
+        self.headings = np.zeros(0)  # Radians from +x, counterclockwise
+        self.grounded = np.zeros(0, dtype=bool)
+        self._previous = np.zeros((0, 3))  # Positions before the last tick
+        self._prepare_node_path(parent)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def spawn(self, positions: Sequence, speed: float=WALKING_SPEED) -> None:
+        """Add members with their feet at `positions`."""
+        positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+        count = len(positions)
+        self.positions = np.concatenate((self.positions, positions))
+        self._previous = np.concatenate((self._previous, positions))
+        self.velocities = np.concatenate((self.velocities,
+                                          np.zeros((count, 3))))
+        self.goals = np.concatenate((self.goals,
+                                     self._wander(positions[:, :2])))
+        self.speeds = np.concatenate((self.speeds, np.full(count, speed)))
+        self.headings = np.concatenate((self.headings, np.zeros(count)))
+        self.grounded = np.concatenate((self.grounded,
+                                        np.zeros(count, dtype=bool)))
+
+    def remove(self, members: np.ndarray) -> None:
+        """Remove the members with the given indices or mask."""
+        keep = np.ones(len(self), dtype=bool)
+        keep[members] = False
+        for name in ('positions', '_previous', 'velocities', 'goals',
+                     'speeds', 'headings', 'grounded'):
+            setattr(self, name, getattr(self, name)[keep])
+
+    def snapshot(self) -> None:
+        """Remember where everybody is before a tick, see `draw()`."""
+        self._previous = self.positions.copy()
+
+    def update(self, dt: float) -> None:
+        """Steer and move every member by one tick."""
+        if not len(self):
+            return
+        self._steer(dt)
+        self._move(dt)
+
+    def draw(self, alpha: float=1.0) -> None:
+        """Draw the members `alpha` of the way from where they were before
+        the last tick to where they are now.
+        """
+        if not len(self):
+            self.node_path.hide()
+            return
+        self.node_path.show()
+        positions = self._previous + (self.positions - self._previous) * alpha
+        instances = np.empty((len(self), 4), dtype=np.float32)
+        instances[:, :3] = positions
+        instances[:, 3] = self.headings
+        array = self._vdata.modifyArray(1)
+        array.uncleanSetNumRows(len(instances))
+        memoryview(array).cast('B')[:] = instances.tobytes()
+        self.node_path.setInstanceCount(len(instances))
+        # The shared box is tiny, so tell Panda3D what the shader covers.
+        reach = max(self.radius, self.height)
+        low, high = positions.min(axis=0) - reach, positions.max(axis=0) + reach
+        self._node.setBounds(BoundingBox(Point3(*low), Point3(*high)))
+
+    def _wander(self, around: np.ndarray) -> np.ndarray:
+        angles = self._rng.uniform(0, 2 * np.pi, len(around))
+        distances = WANDER_RADIUS * np.sqrt(self._rng.uniform(0, 1,
+                                                              len(around)))
+        return around + np.stack((np.cos(angles), np.sin(angles)), 1) * \
+            distances[:, None]
+
+    def _steer(self, dt: float) -> None:
+        """Turn everybody towards their goal and away from each other."""
+        offsets = self.goals - self.positions[:, :2]
+        distances = np.hypot(offsets[:, 0], offsets[:, 1])
+        arrived = distances < ARRIVAL_DISTANCE
+        if arrived.any():
+            self.goals[arrived] = self._wander(self.positions[arrived, :2])
+            offsets[arrived] = self.goals[arrived] - \
+                self.positions[arrived, :2]
+            distances[arrived] = np.hypot(offsets[arrived, 0],
+                                          offsets[arrived, 1])
+        desired = offsets / np.maximum(distances, 1e-9)[:, None]
+        desired += SEPARATION_WEIGHT * self._separation()
+        length = np.hypot(desired[:, 0], desired[:, 1])
+        desired *= (self.speeds / np.maximum(length, 1e-9))[:, None]
+        blend = min(TURN_RATE * dt, 1.0)
+        self.velocities[:, :2] += (desired - self.velocities[:, :2]) * blend
+        moving = np.hypot(self.velocities[:, 0], self.velocities[:, 1]) > 0.1
+        self.headings[moving] = np.arctan2(self.velocities[moving, 1],
+                                           self.velocities[moving, 0])
+
+    def _separation(self) -> np.ndarray:
+        """Return, for each member, the direction away from the others
+        nearby, up to unit length.
+        """
+        positions = self.positions[:, :2]
+        # Bin everybody into cells as wide as the radius, so each member is
+        # only compared with those in the cells around its own.
+        cells = np.floor(positions / SEPARATION_RADIUS).astype(np.int64)
+        numbers = cells[:, 0] * _CELL_ROW + cells[:, 1]
+        order = np.argsort(numbers)
+        ordered = numbers[order]
+        push = np.zeros_like(positions)
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                target = numbers + dx * _CELL_ROW + dy
+                low = np.searchsorted(ordered, target, 'left')
+                counts = np.searchsorted(ordered, target, 'right') - low
+                members = np.repeat(np.arange(len(positions)), counts)
+                firsts = np.repeat(low - np.cumsum(counts) + counts, counts)
+                others = order[firsts + np.arange(len(members))]
+                offsets = positions[members] - positions[others]
+                squared = np.einsum('ij,ij->i', offsets, offsets)
+                near = (squared < SEPARATION_RADIUS ** 2) & (squared > 0)
+                weights = near / np.maximum(squared, 1e-9)
+                for axis in (0, 1):
+                    push[:, axis] += np.bincount(
+                        members, weights * offsets[:, axis], len(positions))
+        length = np.hypot(push[:, 0], push[:, 1])
+        return push / np.maximum(length, 1.0)[:, None]
+
+    def _solid(self, points: np.ndarray, columns: np.ndarray) -> np.ndarray:
+        """Return which of the `points` are inside voxels or in `columns`
+        of chunks that are not loaded, which members treat as walls.
+        """
+        points = points.reshape(-1, 3)
+        chunks = np.floor_divide(voxel.voxel_keys(points)[:, :2],
+                                 voxel.CHUNK_SIZE)
+        unloaded = ~np.isin(chunks[:, 0] * _CELL_ROW + chunks[:, 1], columns)
+        return (self.world.voxel_ids(points) != 0) | unloaded
+
+    def _loaded_columns(self) -> np.ndarray:
+        keys = np.array([chunk.key for chunk in self.world.chunks],
+                        dtype=np.int64).reshape(-1, 3)
+        return np.unique(keys[:, 0] * _CELL_ROW + keys[:, 1])
+
+    def _move(self, dt: float) -> None:
+        """Move everybody by their velocity, colliding with the voxels."""
+        positions, velocities = self.positions, self.velocities
+        columns = self._loaded_columns()
+        # The blocks next to each body, and the one above its head
+        levels = np.arange(self.height + 1) + 0.5
+        # Along x and y one at a time, so members slide along walls.
+        for axis in (0, 1):
+            step = velocities[:, axis] * dt
+            probes = np.repeat(positions[:, None], len(levels), axis=1)
+            probes[..., axis] += (step + np.sign(step) * self.radius)[:, None]
+            probes[..., 2] += levels
+            solid = self._solid(probes, columns).reshape(probes.shape[:-1])
+            body = solid[:, :self.height]
+            free = ~body.any(axis=1)
+            # Walk up single steps with room above them.
+            climb = self.grounded & body[:, 0] & \
+                ~solid[:, 1:].any(axis=1) & ~free
+            moving = free | climb
+            positions[moving, axis] += step[moving]
+            positions[climb, 2] += 1.0
+            velocities[~moving, axis] = 0.0
+
+        # Then fall, landing on whatever is below and stopping at ceilings.
+        velocities[:, 2] = np.maximum(velocities[:, 2] - GRAVITY * dt,
+                                      -TERMINAL_VELOCITY)
+        positions[:, 2] += velocities[:, 2] * dt
+        feet, head = positions.copy(), positions.copy()
+        feet[:, 2] -= SKIN
+        head[:, 2] += self.height - SKIN
+        solid = self._solid(np.stack((feet, head), 1), columns).reshape(-1, 2)
+        landed = solid[:, 0] & (velocities[:, 2] <= 0)
+        positions[landed, 2] = np.rint(feet[landed, 2]) + 0.5
+        bumped = solid[:, 1] & (velocities[:, 2] > 0)
+        positions[bumped, 2] = np.rint(head[bumped, 2]) - 0.5 - self.height
+        velocities[landed | bumped, 2] = 0.0
+        self.grounded = landed
+
+    def _prepare_node_path(self, parent: NodePath) -> None:
+        box = GeomVertexArrayFormat()
+        box.addColumn("vertex", 3, Geom.NTFloat32, Geom.CPoint)
+        box.addColumn("normal", 3, Geom.NTFloat32, Geom.CNormal)
+        members = GeomVertexArrayFormat()
+        members.addColumn("offset", 4, Geom.NTFloat32, Geom.COther)
+        members.setDivisor(1)
+        vertex_format = GeomVertexFormat()
+        vertex_format.addArray(box)
+        vertex_format.addArray(members)
+        vertex_format = GeomVertexFormat.registerFormat(vertex_format)
+
+        self._vdata = GeomVertexData('crowd', vertex_format, Geom.UH_dynamic)
+        rows = np.concatenate((voxel.make_vertices((0, 0, 0)),
+                               voxel.make_normals()), axis=1)
+        array = self._vdata.modifyArray(0)
+        array.uncleanSetNumRows(len(rows))
+        memoryview(array).cast('B')[:] = rows.astype(np.float32).tobytes()
+        prim = GeomTriangles(Geom.UH_static)
+        for index in voxel.make_indices():
+            prim.addVertex(index)
+        geom = Geom(self._vdata)
+        geom.addPrimitive(prim)
+        self._node = GeomNode('crowd')
+        self._node.addGeom(geom)
+        self._node.setFinal(True)
+        self.node_path = parent.attachNewNode(self._node)
+        self.node_path.setShader(Shader.load(
+            Shader.SL_GLSL, vertex=find_file('shaders/crowd.vert'),
+            fragment=find_file('shaders/crowd.frag')))
+        self.node_path.setShaderInput(
+            'body_size', Vec3(self.radius, 2 * self.radius, self.height))
+        self.node_path.setShaderInput('body_color', Vec4(*BODY_COLOR))
+        self.node_path.hide()
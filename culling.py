@@ -0,0 +1,125 @@
+# coding=utf-8
+"""Skip drawing chunks the camera cannot see.
+
+Panda3D already leaves out chunks outside the view frustum, as every chunk
+has a node of its own. Chunks inside the frustum can still be hidden behind
+solid terrain, like caves seen from the surface. Cave culling finds these
+with a breadth-first search from the camera's chunk: it only passes through
+a chunk between faces its air joins, see `voxel.face_connections()`, and
+never turns back towards the camera. Chunks the search never reaches are
+hidden from the camera.
+"""
+from collections import deque
+from typing import Dict, NamedTuple, Set
+
+from panda3d.core import BoundingBox
+from panda3d.core import BoundingVolume
+from panda3d.core import NodePath
+from panda3d.core import Point3
+
+import voxel
+from voxel import ALL_CONNECTIONS, CHUNK_SIZE, CUBE_SIZE, UNIT_VECTORS, Key
+
+
+class CullStats(NamedTuple):
+    """What the last frame drew, counted by chunks."""
+    chunks: int  # Chunks in the world
+    frustum_culled: int  # Outside the view frustum
+    cave_culled: int  # In the frustum but hidden behind solid terrain
+    draw_calls: int  # One per chunk drawn that shows any faces
+    triangles: int  # In the chunks drawn
+
+
+class ChunkCuller:
+    """Hides the chunks of a world that are hidden behind other chunks from
+    a camera, and counts what is left to draw.
+    """
+    def __init__(self, world: voxel.VoxelWorld, enabled: bool=True):
+        self.world = world
+        self.enabled = enabled
+        self.stats = CullStats(0, 0, 0, 0, 0)
+        self._hidden: Set[voxel.Chunk] = set()
+
+    def toggle(self) -> bool:
+        """Turn cave culling on or off, returning whether it is on."""
+        self.enabled = not self.enabled
+        return self.enabled
+
+    def update(self, camera: NodePath) -> CullStats:
+        """Show the chunks `camera` can see and hide the rest from it. Call
+        this once per frame.
+        """
+        frustum = camera.node().getLens().makeBounds()
+        frustum.xform(camera.getMat(self.world.node_path))
+        eye = camera.getPos(self.world.node_path)
+
+        seen: Dict[Key, bool] = {}
+
+        def in_view(key: Key) -> bool:
+            if key not in seen:
+                seen[key] = frustum.contains(chunk_box(key)) != \
+                    BoundingVolume.IF_no_intersection
+            return seen[key]
+
+        chunks = list(self.world.chunks)
+        visible = self._search(voxel.chunk_key(eye), in_view) \
+            if self.enabled and chunks else None
+        mask = camera.node().getCameraMask()
+        hidden = set()
+        outside = drawn = triangles = 0
+        for chunk in chunks:
+            if not in_view(chunk.key):
+                outside += 1
+            elif visible is None or chunk.key in visible:
+                drawn += bool(chunk.face_count)
+                triangles += 2 * chunk.face_count
+            else:
+                hidden.add(chunk)
+        for chunk in self._hidden - hidden:
+            if self.world.has_chunk(chunk):
+                chunk.node_path.show(mask)
+        for chunk in hidden - self._hidden:
+            chunk.node_path.hide(mask)
+        self._hidden = hidden
+        self.stats = CullStats(len(chunks), outside, len(hidden), drawn,
+                               triangles)
+        return self.stats
+
+    def _search(self, start: Key, in_view) -> Set[Key]:
+        """Return the chunks in view reachable from the chunk `start`
+        through air, within the box around it and the loaded chunks.
+        Missing chunks only hold air.
+        """
+        keys = [chunk.key for chunk in self.world.chunks] + [start]
+        low = [min(k[axis] for k in keys) for axis in range(3)]
+        high = [max(k[axis] for k in keys) for axis in range(3)]
+        # The faces walked through so far, so the search never walks back.
+        queue = deque([(start, None, 0)])
+        reached: Dict[Key, None] = {start: None}
+        while queue:
+            key, entered, walked = queue.popleft()
+            chunk = self.world.chunk_at(key)
+            connections = ALL_CONNECTIONS if chunk is None \
+                else chunk.connections
+            for face, vector in enumerate(UNIT_VECTORS):
+                if walked & 1 << voxel.opposite(face):
+                    continue
+                if entered is not None and not connections & \
+                        1 << len(UNIT_VECTORS) * entered + face:
+                    continue
+                other = tuple(k + d for k, d in zip(key, vector))
+                if other in reached or not all(
+                        l <= o <= h for l, o, h in zip(low, other, high)):
+                    continue
+                if not in_view(other):
+                    continue
+                reached[other] = None
+                queue.append((other, voxel.opposite(face), walked | 1 << face))
+        return set(reached)
+
+
+def chunk_box(key: Key) -> BoundingBox:
+    """Return the box around the chunk at `key`, relative to its world."""
+    s = CUBE_SIZE / 2.0
+    return BoundingBox(Point3(*(k * CHUNK_SIZE - s for k in key)),
+                       Point3(*((k + 1) * CHUNK_SIZE - s for k in key)))
@@ -0,0 +1,403 @@
+# coding=utf-8
+"""Voxels that fall as rigid bodies and turn back into voxels once they land.
+
+Making a Bullet body and loading a model for every falling block is fine for
+a few of them, but it falls over after a few hundred. `Debris` instead makes
+a fixed pool of box bodies up front, all sharing one collision shape, and
+draws every falling prop as an instance of one box, in a single draw call.
+A prop that has kept still for a moment is merged back into the world as a
+static voxel and its body handed back to the pool, so only blocks that are
+actually falling cost anything. Blocks waiting
+for a body stay where they are until one frees up.
+
+No block is ever lost on the way: a prop whose own block was filled while
+it fell settles in the nearest free one, a prop left hanging in the air or
+stuck under the floor after tunnelling through it is snapped onto the
+ground in its column, and one over a column with no voxels at all onto the
+ground it started above. Only a block dropped over the void falls again,
+from the first free block above where it started, and after a few tries
+it stays there.
+"""
+import collections
+from typing import Deque, List, Optional, Sequence, Tuple
+
+import numpy as np
+from panda3d.bullet import BulletBoxShape
+from panda3d.bullet import BulletRigidBodyNode
+from panda3d.bullet import BulletWorld
+from panda3d.core import BoundingBox
+from panda3d.core import Geom
+from panda3d.core import GeomNode
+from panda3d.core import GeomTriangles
+from panda3d.core import GeomVertexArrayFormat
+from panda3d.core import GeomVertexData
+from panda3d.core import GeomVertexFormat
+from panda3d.core import NodePath
+from panda3d.core import Point3
+from panda3d.core import Quat
+from panda3d.core import Shader
+from panda3d.core import Vec3
+
+import editing
+import voxel
+from panda_utils import find_file
+
+POOL_SIZE = 256  # Props falling at once at most, which bounds the physics
+SPAWNS_PER_TICK = 32  # Waiting blocks given a body per tick at most
+MASS = 1.0
+# Bodies are this much smaller than blocks on every side, so neighbours
+# spawned side by side do not start out touching and push each other away.
+SKIN = 0.03
+# Props slower than these for REST_TIME seconds have settled. Bullet waits
+# two seconds before putting bodies to sleep, which is far too long for
+# thousands of them, so props are watched here and settled much sooner.
+LINEAR_SLEEP = 0.5  # Blocks per second
+ANGULAR_SLEEP = 1.0  # Radians per second
+REST_TIME = 0.25
+# Settled props are merged a chunk at a time, the one most of them are in,
+# every MERGE_INTERVAL seconds, as each merge rebuilds that chunk's collider.
+MERGE_INTERVAL = 0.1
+LIFETIME = 10.0  # Seconds before a prop that never keeps still gives up
+SETTLE_SEARCH = 3  # Blocks around a prop's own searched for room to settle
+DROP_RETRIES = 2  # Times a block with no ground anywhere near falls again
+# The blocks around a prop's own, nearest first and upwards before downwards
+# at the same distance, so overlapping props in a pile stack up.
+SETTLE_OFFSETS = sorted(
+    ((dx, dy, dz) for dx in range(-SETTLE_SEARCH, SETTLE_SEARCH + 1)
+     for dy in range(-SETTLE_SEARCH, SETTLE_SEARCH + 1)
+     for dz in range(-SETTLE_SEARCH, SETTLE_SEARCH + 1)),
+    key=lambda d: (d[0] ** 2 + d[1] ** 2 + d[2] ** 2, -d[2]))
+INSTANCE_FLOATS = 14  # Center, rotation and six face layers
+
+
+class Debris:
+    """Falling blocks of a voxel world. Call `snapshot()` before each
+    physics step, `update()` after it and `draw()` once per frame.
+
+    Blocks that settle are placed through `journal`, if there is one, so
+    they can be undone and saved like any other edit. Everything that falls
+    from the moment the debris starts moving until it has all come to rest
+    is undone as one operation.
+    """
+    def __init__(self, world: voxel.VoxelWorld, physics: BulletWorld,
+                 physics_np: NodePath, parent: NodePath,
+                 journal: editing.EditJournal=None, size: int=POOL_SIZE):
+        self.world = world
+        self.physics = physics
+        self.journal = journal
+        self.shape = BulletBoxShape(Vec3(voxel.CUBE_SIZE / 2.0 - SKIN))
+        self._bodies: List[NodePath] = []
+        for i in range(size):
+            node = BulletRigidBodyNode('debris_{}'.format(i))
+            node.setMass(MASS)
+            node.addShape(self.shape)
+            node.setLinearSleepThreshold(LINEAR_SLEEP)
+            node.setAngularSleepThreshold(ANGULAR_SLEEP)
+            self._bodies.append(physics_np.attachNewNode(node))
+        self._free = list(range(size - 1, -1, -1))  # Slots without a prop
+        # Blocks waiting for a body: where, their palette number, whether
+        # they are still a voxel in the world to take away and how often
+        # they fell without finding ground.
+        self._waiting: Deque[Tuple[Tuple[int, int, int], int, bool, int]] = \
+            collections.deque()
+        # The props by slot, and the poses of the last two ticks
+        self.active = np.zeros(size, dtype=bool)
+        self.type_ids = np.zeros(size, dtype=voxel.TYPE_DTYPE)
+        self.ages = np.zeros(size)  # Seconds since each prop was spawned
+        self.resting = np.zeros(size)  # Seconds each prop has kept still
+        self.positions = np.zeros((size, 3))
+        self.origins = np.zeros((size, 3), dtype=np.int64)  # Spawned at
+        self.retries = np.zeros(size, dtype=np.int64)  # Falls without ground
+        self.rotations = np.zeros((size, 4))  # i, j, k, r
+        self.rotations[:, 3] = 1.0
+        self._previous = self.positions.copy()
+        self._previous_rotations = self.rotations.copy()
+        self._since_merge = 0.0
+        self._group = object()  # Journal group of the blocks falling now
+        self._prepare_node_path(parent)
+
+    def __len__(self):
+        """The number of props falling right now."""
+        return int(self.active.sum())
+
+    @property
+    def waiting(self) -> int:
+        """The number of blocks waiting for a body."""
+        return len(self._waiting)
+
+    def drop(self, positions: Sequence, voxel_type) -> None:
+        """Let blocks of `voxel_type` fall from `positions`."""
+        self._start_group()
+        type_id = self.world.palette.id_of(voxel_type)
+        self._waiting.extend((key, type_id, False, 0) for key in map(
+            tuple, voxel.voxel_keys(positions).tolist()))
+
+    def loosen(self, positions: Sequence) -> None:
+        """Make the voxels at `positions` fall, lowest first."""
+        self._start_group()
+        positions = voxel.voxel_keys(positions)
+        type_ids = self.world.voxel_ids(positions)
+        solid = type_ids != 0
+        positions, type_ids = positions[solid], type_ids[solid]
+        order = np.argsort(positions[:, 2], kind='stable')
+        self._waiting.extend(zip(map(tuple, positions[order].tolist()),
+                                 type_ids[order].tolist(),
+                                 [True] * len(order), [0] * len(order)))
+
+    def _start_group(self) -> None:
+        # Blocks joining others still falling are undone along with them.
+        if not len(self) and not self._waiting:
+            self._group = object()
+
+    def snapshot(self) -> None:
+        """Remember where every prop is before a tick, see `draw()`."""
+        self._previous[:] = self.positions
+        self._previous_rotations[:] = self.rotations
+
+    def update(self, dt: float) -> None:
+        """Read back where the bodies went, settle the props that came to
+        rest and give waiting blocks the bodies that freed up.
+        """
+        slots = np.flatnonzero(self.active)
+        if len(slots):
+            poses = np.array([(*body.getPos(), *body.getQuat())
+                              for body in map(self._bodies.__getitem__,
+                                              slots.tolist())])
+            self.positions[slots] = poses[:, :3]
+            self.rotations[slots] = poses[:, [4, 5, 6, 3]]
+            # How fast each prop moved and turned over the tick
+            speeds = np.linalg.norm(
+                self.positions[slots] - self._previous[slots], axis=1) / dt
+            turns = np.abs(np.einsum('ij,ij->i', self.rotations[slots],
+                                     self._previous_rotations[slots]))
+            spins = 2.0 * np.arccos(np.minimum(turns, 1.0)) / dt
+            still = (speeds < LINEAR_SLEEP) & (spins < ANGULAR_SLEEP)
+            self.resting[slots] = np.where(still, self.resting[slots] + dt,
+                                           0.0)
+            self.ages[slots] += dt
+
+        self._since_merge += dt
+        if self._since_merge >= MERGE_INTERVAL:
+            self._since_merge = 0.0
+            # Props that never kept still settle too, see `_settle()`.
+            expired = self.active & (self.ages > LIFETIME)
+            settled = np.flatnonzero(self.active & (
+                (self.resting >= REST_TIME) | expired))
+            if len(settled):
+                chunks = np.floor_divide(voxel.voxel_keys(
+                    self.positions[settled]), voxel.CHUNK_SIZE)
+                keys, members = np.unique(chunks, axis=0,
+                                          return_inverse=True)
+                busiest = np.argmax(np.bincount(members.reshape(-1)))
+                settled = settled[members.reshape(-1) == busiest]
+            if len(settled):
+                self._settle(settled)
+            for slot in settled.tolist():
+                self._release(slot)
+        self._spawn_waiting()
+
+    def draw(self, alpha: float=1.0) -> None:
+        """Draw the props `alpha` of the way from where they were before the
+        last tick to where they are now.
+        """
+        slots = np.flatnonzero(self.active)
+        if not len(slots):
+            self.node_path.hide()
+            return
+        self.node_path.show()
+        positions = self._previous[slots] + \
+            (self.positions[slots] - self._previous[slots]) * alpha
+        before, after = self._previous_rotations[slots], self.rotations[slots]
+        # The same rotation, the short way round
+        after = np.where((np.einsum('ij,ij->i', before, after) < 0)[:, None],
+                         -after, after)
+        rotations = before + (after - before) * alpha
+        rotations /= np.linalg.norm(rotations, axis=1)[:, None]
+        instances = np.empty((len(slots), INSTANCE_FLOATS), dtype=np.float32)
+        instances[:, :3] = positions
+        instances[:, 3] = 1.0
+        instances[:, 4:8] = rotations
+        instances[:, 8:] = self.world.face_layers[self.type_ids[slots]]
+        array = self._vdata.modifyArray(1)
+        array.uncleanSetNumRows(len(instances))
+        memoryview(array).cast('B')[:] = instances.tobytes()
+        self.node_path.setInstanceCount(len(instances))
+        # The shared box is tiny, so tell Panda3D what the shader covers.
+        reach = voxel.CUBE_SIZE
+        low, high = positions.min(axis=0) - reach, positions.max(axis=0) + reach
+        self._node.setBounds(BoundingBox(Point3(*low), Point3(*high)))
+
+    def clear(self) -> None:
+        """Let go of every prop and waiting block, without settling them."""
+        self._waiting.clear()
+        for slot in np.flatnonzero(self.active).tolist():
+            self._release(slot)
+
+    def _spawn_waiting(self) -> None:
+        count = min(len(self._waiting), len(self._free), SPAWNS_PER_TICK)
+        if not count:
+            return
+        blocks = [self._waiting.popleft() for _ in range(count)]
+        # Voxels edited since they were loosened stay where they are.
+        taken = [(position, type_id) for position, type_id, in_world, _
+                 in blocks if in_world]
+        if taken:
+            positions = np.array([p for p, _ in taken], dtype=np.int64)
+            still = self.world.voxel_ids(positions) == \
+                np.array([t for _, t in taken], dtype=voxel.TYPE_DTYPE)
+            self._set_voxels(positions[still], np.zeros(still.sum()))
+            gone = {tuple(p) for p in positions[~still].tolist()}
+            blocks = [b for b in blocks if not (b[2] and b[0] in gone)]
+        for position, type_id, _, retries in blocks:
+            self._spawn(position, type_id, retries)
+
+    def _spawn(self, position: Tuple[int, int, int], type_id: int,
+               retries: int=0) -> None:
+        slot = self._free.pop()
+        body = self._bodies[slot]
+        node = body.node()
+        body.setPosQuat(Point3(*position), Quat.identQuat())
+        node.clearForces()
+        node.setLinearVelocity(Vec3(0, 0, 0))
+        node.setAngularVelocity(Vec3(0, 0, 0))
+        node.setActive(True, True)
+        self.physics.attachRigidBody(node)
+        self.active[slot] = True
+        self.type_ids[slot] = type_id
+        self.ages[slot] = self.resting[slot] = 0.0
+        self.positions[slot] = self._previous[slot] = position
+        self.origins[slot] = position
+        self.retries[slot] = retries
+        self.rotations[slot] = self._previous_rotations[slot] = (0, 0, 0, 1)
+
+    def _release(self, slot: int) -> None:
+        self.physics.removeRigidBody(self._bodies[slot].node())
+        self.active[slot] = False
+        self._free.append(slot)
+
+    def _settle(self, slots: np.ndarray) -> None:
+        """Turn props back into voxels, lowest first so stacks build up.
+        Each goes into the nearest free block around where it came to
+        rest, or onto the ground below if nothing holds that block up.
+        Props with no ground under them at all go onto the ground where
+        they started instead, or failing that fall again, see
+        `DROP_RETRIES`.
+        """
+        slots = slots[np.argsort(self.positions[slots, 2], kind='stable')]
+        targets = voxel.voxel_keys(self.positions[slots])
+        taken = set()
+        columns = {}  # Chunks by their x and y, filled in on first use
+        positions, type_ids = [], []
+        for slot, target in zip(slots.tolist(), map(tuple, targets.tolist())):
+            key = self._nearest_free(target, taken)
+            if key is None or not self._supported(key, taken):
+                key = self._ground(key or target, taken, columns)
+            origin = tuple(self.origins[slot].tolist())
+            if key is None:
+                key = self._ground(origin, taken, columns)
+            if key is None:
+                # Nothing to land on, so start over from the first free
+                # block above the start, as the pile may have filled it.
+                key = origin
+                while not self._is_free(key, taken):
+                    key = (key[0], key[1], key[2] + 1)
+                if self.retries[slot] < DROP_RETRIES:
+                    self._waiting.append((key, int(self.type_ids[slot]),
+                                          False, int(self.retries[slot]) + 1))
+                    continue
+            taken.add(key)
+            positions.append(key)
+            type_ids.append(self.type_ids[slot])
+        if positions:
+            self._set_voxels(np.array(positions, dtype=np.int64), type_ids)
+
+    def _is_free(self, key: voxel.Key, taken: set) -> bool:
+        return key not in taken and not self.world.is_solid(*key)
+
+    def _supported(self, key: voxel.Key, taken: set) -> bool:
+        below = (key[0], key[1], key[2] - 1)
+        return not self._is_free(below, taken)
+
+    def _nearest_free(self, target: voxel.Key,
+                      taken: set) -> Optional[voxel.Key]:
+        """Return the free block nearest `target`, within `SETTLE_SEARCH`
+        blocks of it, or None if they are all full.
+        """
+        x, y, z = target
+        for dx, dy, dz in SETTLE_OFFSETS:
+            key = (x + dx, y + dy, z + dz)
+            if self._is_free(key, taken):
+                return key
+        return None
+
+    def _ground(self, target: voxel.Key, taken: set,
+                columns: dict) -> Optional[voxel.Key]:
+        """Return the first free block above solid ground in the column of
+        `target`: the highest at or below it, or failing that the lowest
+        above it. Returns None if the column holds no voxel at all.
+        """
+        if not columns:
+            for chunk in self.world.chunks:
+                columns.setdefault(chunk.key[:2], []).append(chunk)
+        x, y, z = target
+        lx, ly = x % voxel.CHUNK_SIZE, y % voxel.CHUNK_SIZE
+        heights = [np.array([k[2] for k in taken if k[:2] == (x, y)],
+                            dtype=np.int64)]
+        for chunk in columns.get((x // voxel.CHUNK_SIZE,
+                                  y // voxel.CHUNK_SIZE), ()):
+            heights.append(chunk.key[2] * voxel.CHUNK_SIZE +
+                           np.flatnonzero(chunk.types[lx, ly]))
+        solid = np.unique(np.concatenate(heights))
+        if not len(solid):
+            return None
+        # The blocks right on top of a voxel that are not voxels themselves
+        tops = np.setdiff1d(solid + 1, solid)
+        below = tops[tops <= z]
+        return x, y, int(below[-1] if len(below) else tops[0])
+
+    def _set_voxels(self, positions: np.ndarray, type_ids) -> None:
+        if not len(positions):
+            return
+        if self.journal is not None:
+            self.journal.apply(positions, type_ids, self._group)
+        else:
+            self.world.set_voxels(positions, type_ids)
+
+    def _prepare_node_path(self, parent: NodePath) -> None:
+        box = GeomVertexArrayFormat()
+        box.addColumn("vertex", 3, Geom.NTFloat32, Geom.CPoint)
+        box.addColumn("normal", 3, Geom.NTFloat32, Geom.CNormal)
+        box.addColumn("texcoord", 2, Geom.NTFloat32, Geom.CTexcoord)
+        props = GeomVertexArrayFormat()
+        props.addColumn("offset", 4, Geom.NTFloat32, Geom.COther)
+        props.addColumn("rotation", 4, Geom.NTFloat32, Geom.COther)
+        props.addColumn("layers_a", 3, Geom.NTFloat32, Geom.COther)
+        props.addColumn("layers_b", 3, Geom.NTFloat32, Geom.COther)
+        props.setDivisor(1)
+        vertex_format = GeomVertexFormat()
+        vertex_format.addArray(box)
+        vertex_format.addArray(props)
+        vertex_format = GeomVertexFormat.registerFormat(vertex_format)
+
+        self._vdata = GeomVertexData('debris', vertex_format, Geom.UH_dynamic)
+        rows = np.concatenate((voxel.make_vertices((0, 0, 0)),
+                               voxel.make_normals(),
+                               voxel.make_texcoords()), axis=1)
+        array = self._vdata.modifyArray(0)
+        array.uncleanSetNumRows(len(rows))
+        memoryview(array).cast('B')[:] = rows.astype(np.float32).tobytes()
+        prim = GeomTriangles(Geom.UH_static)
+        for index in voxel.make_indices():
+            prim.addVertex(index)
+        geom = Geom(self._vdata)
+        geom.addPrimitive(prim)
+        self._node = GeomNode('debris')
+        self._node.addGeom(geom)
+        self._node.setFinal(True)
+        self.node_path = parent.attachNewNode(self._node)
+        # The same block images as the voxels
+        self.node_path.setTexture(self.world.node_path.getTexture())
+        self.node_path.setShader(Shader.load(
+            Shader.SL_GLSL, vertex=find_file('shaders/debris.vert'),
+            fragment=find_file('shaders/voxel.frag')))
+        self.node_path.hide()
@@ -0,0 +1,229 @@
+# coding=utf-8
+"""Undoable edits of a voxel world, including operations on whole boxes.
+
+Every change goes through `EditJournal`, which applies it to the world as one
+batch, so each touched chunk is meshed once per operation rather than once
+per voxel. The journal remembers each operation as a compact record of the
+blocks it touched and their palette numbers before and after. Those records
+are all undo and redo need, and the ones made since the last save are what
+`EditJournal.autosave()` appends to the world's journal file, see
+`world_format.append_journal()`.
+"""
+import os
+from typing import Callable, List, NamedTuple, Optional, Sequence
+
+import numpy as np
+
+import voxel
+import world_format
+
+UNDO_LIMIT = 256  # Operations kept for undoing
+
+
+class Edit(NamedTuple):
+    """One operation: the blocks it changed, with their palette numbers
+    before and after, 0 for air.
+    """
+    positions: np.ndarray
+    old: np.ndarray
+    new: np.ndarray
+
+
+class Clipboard(NamedTuple):
+    """Palette numbers copied out of a box, indexed by the offset from its
+    lowest corner. Air is copied too, so pasting clears what was air.
+    """
+    type_ids: np.ndarray
+
+
+def box(corner, other) -> np.ndarray:
+    """Return the position of every block in the box spanning the blocks at
+    two opposite corners.
+    """
+    low, high = np.sort(voxel.voxel_keys((corner, other)), axis=0)
+    axes = (np.arange(a, b + 1) for a, b in zip(low, high))
+    return np.stack(np.meshgrid(*axes, indexing='ij'), -1).reshape(-1, 3)
+
+
+def merge(edit: Edit, later: Edit) -> Edit:
+    """Combine two operations into one, with each block as it was before
+    the first and after the last.
+    """
+    positions = np.concatenate((edit.positions, later.positions))
+    old = np.concatenate((edit.old, later.old))
+    new = np.concatenate((edit.new, later.new))
+    # np.unique sorts the blocks the same way both times.
+    _, first = np.unique(positions, axis=0, return_index=True)
+    _, last = np.unique(positions[::-1], axis=0, return_index=True)
+    last = len(positions) - 1 - last
+    return Edit(positions[first], old[first], new[last])
+
+
+class EditJournal:
+    """Applies edits to a world and keeps them for undo, redo and autosave.
+    """
+    def __init__(self, world: voxel.VoxelWorld, limit: int=UNDO_LIMIT):
+        self.world = world
+        self.limit = limit
+        self._undo: List[Edit] = []
+        self._redo: List[Edit] = []
+        # Changes not in the world file or its journal yet, in order.
+        self._unsaved: List[Edit] = []
+        # What the last operation on the undo stack can be merged with,
+        # see `apply()`.
+        self._group = None
+        # Called with the positions and new palette numbers of every change,
+        # say to pass it on to a server, see `network.WorldClient`.
+        self.on_change: Optional[Callable[[np.ndarray, np.ndarray],
+                                          None]] = None
+        # Also called with every change, say to log it for a replay, see
+        # `recording.InputRecorder`.
+        self.listeners: List[Callable[[np.ndarray, np.ndarray], None]] = []
+
+    @property
+    def can_undo(self) -> bool:
+        """True if there is an operation to undo."""
+        return bool(self._undo)
+
+    @property
+    def can_redo(self) -> bool:
+        """True if there is an undone operation to redo."""
+        return bool(self._redo)
+
+    @property
+    def unsaved(self) -> int:
+        """The number of operations made since the last save."""
+        return len(self._unsaved)
+
+    def place(self, positions: Sequence, voxel_type) -> Optional[Edit]:
+        """Put voxels of `voxel_type` at `positions`, replacing what was
+        there.
+        """
+        type_id = self.world.palette.id_of(voxel_type)
+        return self.apply(positions, np.full(len(positions), type_id))
+
+    def remove(self, positions: Sequence) -> Optional[Edit]:
+        """Remove the voxels at `positions`."""
+        return self.apply(positions, np.zeros(len(positions)))
+
+    def fill(self, corner, other, voxel_type) -> Optional[Edit]:
+        """Fill a box with voxels of `voxel_type`."""
+        return self.place(box(corner, other), voxel_type)
+
+    def hollow(self, corner, other, voxel_type) -> Optional[Edit]:
+        """Build the walls, floor and ceiling of a box out of `voxel_type`,
+        clearing everything inside.
+        """
+        positions = box(corner, other)
+        low, high = np.sort(voxel.voxel_keys((corner, other)), axis=0)
+        sides = ((positions == low) | (positions == high)).any(axis=1)
+        type_ids = np.where(sides, self.world.palette.id_of(voxel_type), 0)
+        return self.apply(positions, type_ids)
+
+    def clear(self, corner, other) -> Optional[Edit]:
+        """Remove every voxel in a box."""
+        return self.remove(box(corner, other))
+
+    def replace(self, corner, other, old_type, new_type) -> Optional[Edit]:
+        """Turn the voxels of `old_type` in a box into `new_type`."""
+        positions = box(corner, other)
+        matches = self.world.voxel_ids(positions) == \
+            self.world.palette.id_of(old_type)
+        return self.place(positions[matches], new_type)
+
+    def copy(self, corner, other) -> Clipboard:
+        """Copy the contents of a box."""
+        low, high = np.sort(voxel.voxel_keys((corner, other)), axis=0)
+        type_ids = self.world.voxel_ids(box(low, high))
+        return Clipboard(type_ids.reshape(tuple(high - low + 1)))
+
+    def paste(self, clipboard: Clipboard, corner) -> Optional[Edit]:
+        """Paste a copied box with its lowest corner at `corner`."""
+        shape = clipboard.type_ids.shape
+        low = voxel.voxel_keys(corner)[0]
+        return self.apply(box(low, low + np.array(shape) - 1),
+                          clipboard.type_ids.reshape(-1))
+
+    def apply(self, positions: Sequence, type_ids: Sequence[int],
+              group=None) -> Optional[Edit]:
+        """Store palette numbers at `positions` as one undoable operation,
+        0 removing the voxel there. Returns the operation, or None if
+        nothing changed.
+
+        Changes with the same `group` as the last operation are merged into
+        it rather than pushed on their own, so that a stream of small
+        changes, such as falling debris settling, is undone in one go.
+        """
+        positions = voxel.voxel_keys(positions)
+        type_ids = np.asarray(type_ids, dtype=voxel.TYPE_DTYPE).reshape(-1)
+        # Only record the blocks that actually change.
+        changed = self.world.voxel_ids(positions) != type_ids
+        if not changed.any():
+            return None
+        positions, type_ids = positions[changed], type_ids[changed]
+        edit = Edit(positions, self.world.set_voxels(positions, type_ids),
+                    type_ids)
+        if group is not None and group is self._group and self._undo:
+            self._undo[-1] = merge(self._undo[-1], edit)
+        else:
+            self._undo.append(edit)
+            del self._undo[:-self.limit]
+        self._group = group
+        self._redo.clear()
+        self._unsaved.append(edit)
+        self._changed(edit.positions, edit.new)
+        return edit
+
+    def undo(self) -> Optional[Edit]:
+        """Revert the last operation, returning it."""
+        if not self._undo:
+            return None
+        edit = self._undo.pop()
+        self._group = None
+        self.world.set_voxels(edit.positions, edit.old)
+        self._redo.append(edit)
+        self._unsaved.append(Edit(edit.positions, edit.new, edit.old))
+        self._changed(edit.positions, edit.old)
+        return edit
+
+    def redo(self) -> Optional[Edit]:
+        """Apply the last undone operation again, returning it."""
+        if not self._redo:
+            return None
+        edit = self._redo.pop()
+        self._group = None
+        self.world.set_voxels(edit.positions, edit.new)
+        self._undo.append(edit)
+        self._unsaved.append(edit)
+        self._changed(edit.positions, edit.new)
+        return edit
+
+    def _changed(self, positions: np.ndarray, type_ids: np.ndarray) -> None:
+        if self.on_change is not None:
+            self.on_change(positions, type_ids)
+        for listener in self.listeners:
+            listener(positions, type_ids)
+
+    def autosave(self, path: str, held=None) -> int:
+        """Append the operations made since the last save to the journal of
+        the world file at `path`, writing the whole world instead if it has
+        no file yet, see `save()`. Returns how many operations were written.
+        """
+        count = len(self._unsaved)
+        if not count:
+            return 0
+        if not os.path.exists(path):
+            self.save(path, held)
+            return count
+        for edit in self._unsaved:
+            world_format.append_journal(path, self.world, edit.positions,
+                                        edit.new)
+        self._unsaved.clear()
+        return count
+
+    def save(self, path: str, held=None) -> None:
+        """Write the whole world to `path`, folding in its journal, along
+        with the `held` chunks of `world_format.save()`.
+        """
+        world_format.save(self.world, path, held)
+        self._unsaved.clear()
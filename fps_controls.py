@@ -20,7 +20,38 @@ class ActionKey(str, enum.Enum):
     Fly = 'tab'
 
 
-class FPSControls:
+class Controls:
+    """Where a `Character` gets its input: which action keys are held down
+    and how far the mouse moved. Subclasses read the keyboard and mouse, or
+    a recording of them, see `recording`.
+    """
+    def tick(self) -> None:
+        """Called at the start of every simulation tick, before the keys
+        are read.
+        """
+
+    def key_pressed(self, key: ActionKey) -> bool:
+        """Returns True if the key bound to the action is currently pressed."""
+        raise NotImplementedError
+
+    def get_mouse_change(self):
+        """Returns how far the mouse moved since it was last asked."""
+        return 0, 0
+
+    def get_movement_direction(self):
+        movement = [0, 0]
+        if self.key_pressed(ActionKey.Left):
+            movement[1] = -1
+        elif self.key_pressed(ActionKey.Right):
+            movement[1] = 1
+        if self.key_pressed(ActionKey.Up):
+            movement[0] = 1
+        elif self.key_pressed(ActionKey.Down):
+            movement[0] = -1
+        return movement
+
+
+class FPSControls(Controls):
     """Takes in Panda3D event handling and translates those to an easily
     usable format.
     """
@@ -40,18 +71,6 @@ class FPSControls:
         self.base.accept(ActionKey.Menu, self.toggle_mouse_capture)
         self.base.accept(ActionKey.Fly, self.toggle_fly)
 
-    def get_movement_direction(self):
-        movement = [0, 0]
-        if self.key_pressed(ActionKey.Left):
-            movement[1] = -1
-        elif self.key_pressed(ActionKey.Right):
-            movement[1] = 1
-        if self.key_pressed(ActionKey.Up):
-            movement[0] = 1
-        elif self.key_pressed(ActionKey.Down):
-            movement[0] = -1
-        return movement
-
     # noinspection PyArgumentList
     def key_pressed(self, key: ActionKey) -> bool:
         """Returns True if the key bound to the action is currently pressed."""
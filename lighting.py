@@ -0,0 +1,111 @@
+# coding=utf-8
+"""Trade lighting quality for GPU time with a few named presets.
+
+Shadow maps are the expensive part of lighting a voxel world: every shadow
+casting light renders the scene again, six times over for a point light. A
+preset picks the shadow map size, which lights cast shadows and how far
+around the player chunks still render into shadow maps. It also decides
+whether ambient occlusion is baked into the chunk meshes, which costs some
+meshing time but nothing on the GPU, and whether light levels flooded
+from the sky and from lamps are baked in as well, see `voxel_light`.
+"""
+from typing import Dict, NamedTuple, Tuple
+
+from panda3d.core import BitMask32
+from panda3d.core import NodePath
+from panda3d.core import PointLight
+
+import voxel
+import voxel_light
+
+# The camera bit of shadow cameras. Chunks too far away to cast shadows are
+# hidden from this bit only.
+SHADOW_MASK = BitMask32.bit(1)
+DEFAULT_PRESET = 'medium'
+
+
+class LightingPreset(NamedTuple):
+    """One step on the scale from cheapest to best looking."""
+    shadow_size: int  # Pixels along each side of a shadow map
+    shadow_casters: Tuple[str, ...]  # Names of the lights casting shadows
+    shadow_radius: int  # Chunks around the focus that cast shadows
+    ambient_occlusion: bool  # Baked into the meshes while meshing
+    light_levels: bool  # Kept by a light engine and baked in as well
+
+
+# In order from cheapest to best looking. No preset lets a point light cast
+# shadows, as that would render the world six more times per frame.
+PRESETS: Dict[str, LightingPreset] = {
+    'flat': LightingPreset(0, (), 0, False, False),
+    'low': LightingPreset(0, (), 0, True, True),
+    'medium': LightingPreset(1024, ('spotlight',), 2, True, True),
+    'high': LightingPreset(2048, ('spotlight',), 4, True, True),
+}
+
+
+class LightingQuality:
+    """Applies lighting presets to a voxel world and its lights, and keeps
+    the set of chunks rendered into shadow maps around a moving focus.
+    """
+    def __init__(self, world: voxel.VoxelWorld, camera: NodePath,
+                 lights: Dict[str, NodePath], preset: str=DEFAULT_PRESET):
+        self.world = world
+        self.lights = lights
+        self.name = None
+        self.preset = None
+        self._casting: Dict[voxel.Chunk, bool] = {}
+        # The main camera ignores the shadow bit, so hiding chunks from it
+        # only takes them out of the shadow maps.
+        node = camera.node()
+        node.setCameraMask(node.getCameraMask() & ~SHADOW_MASK)
+        self.apply(preset)
+
+    def apply(self, name: str) -> None:
+        """Switch to the preset called `name`."""
+        preset = PRESETS[name]
+        for light_name in preset.shadow_casters:
+            if isinstance(self.lights[light_name].node(), PointLight):
+                raise ValueError('Point lights cannot cast shadows on chunks: '
+                                 '{}'.format(light_name))
+        for light_name, node_path in self.lights.items():
+            light = node_path.node()
+            if preset.shadow_size and light_name in preset.shadow_casters:
+                light.setShadowCaster(True, preset.shadow_size,
+                                      preset.shadow_size)
+                light.setCameraMask(SHADOW_MASK)
+            elif light.isShadowCaster():
+                light.setShadowCaster(False)
+        self.world.set_ambient_occlusion(preset.ambient_occlusion)
+        if preset.light_levels != (self.world.light_engine is not None):
+            self.world.set_light_engine(voxel_light.LightEngine(self.world)
+                                        if preset.light_levels else None)
+        self.name, self.preset = name, preset
+        self._casting.clear()  # Decide again for every chunk
+
+    def cycle(self) -> str:
+        """Switch to the next preset, wrapping around, and return its name.
+        """
+        names = list(PRESETS)
+        self.apply(names[(names.index(self.name) + 1) % len(names)])
+        return self.name
+
+    def update(self, focus) -> None:
+        """Let only the chunks within the preset's radius of `focus` render
+        into shadow maps. Call this once per frame.
+        """
+        if not self.preset.shadow_size or not self.preset.shadow_casters:
+            return
+        cx, cy, cz = voxel.chunk_key(focus)
+        radius = self.preset.shadow_radius
+        casting = {}
+        for chunk in self.world.chunks:
+            x, y, z = chunk.key
+            casts = (x - cx) ** 2 + (y - cy) ** 2 + (z - cz) ** 2 <= \
+                radius * radius
+            if self._casting.get(chunk) is not casts:
+                if casts:
+                    chunk.node_path.show(SHADOW_MASK)
+                else:
+                    chunk.node_path.hide(SHADOW_MASK)
+            casting[chunk] = casts
+        self._casting = casting  # Forgetting unloaded chunks
@@ -1,88 +1,209 @@
 # coding=utf-8
 """A prototype editor for `Echoes of the Infinite Multiverse`."""
+import argparse
+import functools
 import math
-import pickle
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Tuple
 
-import tqdm
 from direct.showbase.ShowBase import ShowBase, Fog, Spotlight, Vec4, \
-    AmbientLight, PointLight, Vec2D, Vec3
+    AmbientLight, Vec2D, Vec3
+from direct.gui.OnscreenText import OnscreenText
 from direct.task import Task
-from panda3d.bullet import BulletBoxShape
 from panda3d.bullet import BulletDebugNode
-from panda3d.bullet import BulletRigidBodyNode
+from panda3d.core import PStatClient
+from panda3d.core import TextNode
 from panda3d.core import Vec3D
-from panda3d.bullet import BulletWorld, BulletTriangleMesh, \
-    BulletTriangleMeshShape
+from panda3d.bullet import BulletWorld
 from characters import Character
+from crowd import Crowd
+import culling
+import debris
+import editing
+import lighting
+import network
+import profiling
+import recording
+import simulation
+import terrain
 import voxel
+import voxel_light
+import voxel_physics
+from mesh_scheduler import MeshScheduler
+import world_format
 
-from fps_controls import FPSControls
+from fps_controls import Controls, FPSControls
 from panda_utils import ReticleVoxelPicker
 
 BOUNDARY_BLOCK = None
+BUILDING_BLOCKS = ('brick', 'grass', 'dirt', 'stone', 'gravel',
+                   'lamp')  # Keys 1-6
+LIGHTING_KEY = 'l'  # Cycles through the lighting presets
+CULLING_KEY = 'c'  # Turns cave culling on and off
+STATS_KEY = 'f3'  # Shows and hides the frame statistics
+UNDO_KEY = 'control-z'
+REDO_KEY = 'control-y'
+SAVE_KEY = 'control-s'
+SELECT_KEY = 'b'  # Marks the block in the crosshairs as a corner
+FILL_KEY = 'f'  # Fills the selection with the building block
+HOLLOW_KEY = 'h'  # Builds the sides of the selection, clearing the inside
+CLEAR_KEY = 'x'  # Empties the selection
+REPLACE_KEY = 'r'  # Turns blocks like the one in the crosshairs into the
+                   # building block, inside the selection
+COPY_KEY = 'control-c'
+PASTE_KEY = 'control-v'  # Pastes in front of the block in the crosshairs
+AUTOSAVE_INTERVAL = 30.0  # Seconds between appending edits to the journal
+CROWD_KEY = 'n'  # Adds computer-controlled characters around the player
+CROWD_SPAWN = 50  # Characters added at a time
+CROWD_SPREAD = 8.0  # How far from the player they appear
+DROP_KEY = 'g'  # Drops the building block in front of the crosshairs
+LOOSEN_KEY = 'k'  # Makes the selection, or the block in the crosshairs, fall
 
 
 class RoomEditor(voxel.VoxelWorld):
     """A drawable object."""
-    filepath = "untitled.pkl"
-
-    def __init__(self, window):
-        super().__init__()
+    filepath = "untitled.world"
+
+    def __init__(self, window: ShowBase=None, filepath: str=None,
+                 generator: terrain.TerrainGenerator=None,
+                 ambient_occlusion: bool=False, light_levels: bool=False,
+                 controls: Controls=None, connect: Tuple[str, int]=None):
+        super().__init__(ambient_occlusion=ambient_occlusion)
+        if light_levels:
+            self.set_light_engine(voxel_light.LightEngine(self))
+        if filepath is not None:
+            self.filepath = filepath
+        # Fills in the world around the players, where the file has nothing.
+        self.generator = generator or terrain.RoomGenerator(BOUNDARY_BLOCK)
+        self.streamer = None
+        # Every edit goes through here, so it can be undone and autosaved
+        self.journal = editing.EditJournal(self)
 
         # Initialize Physics
         self.physics = BulletWorld()
         self.physics.setGravity(Vec3(0, 0, -9.81))
-
-        # Load stuff
-        self.load()
+        self.physics_np = render.attachNewNode('physics')
+        # Physics and players move in fixed ticks, drawn in between
+        self.clock = simulation.FixedClock()
+        self.interpolator = simulation.Interpolator()
+        self.substeps = simulation.PHYSICS_SUBSTEPS
+        self.colliders = voxel_physics.ChunkColliders(self.physics,
+                                                      self.physics_np)
+
+        # Mesh chunks in the background as they change
+        self.scheduler = MeshScheduler(self)
+
+        # Load stuff, or share the world of a server at `connect`
+        self.players = []
+        self.client = None
+        if connect is None:
+            self.load()
+        else:
+            self.client = network.WorldClient(self, *connect)
+            self.journal.on_change = self.client.send_edits
 
         # Match the physics to the loaded model
         self.generate_physics()
 
-        # Add players
-        controls = FPSControls(window)
-        self.players = [
-            Character(self, controls, Vec3D(0, 0, 0), Vec2D(0, 0))
-        ]
-
-    def _create_boundary_blocks(self) -> None:
-        n = 10  # 1/2 width and height of world
-        for x in tqdm.tqdm(range(-n, n + 1)):
-            for z in range(-n, n + 1):
-                # create a boundary floor and ceiling
-                self.place_voxel(BOUNDARY_BLOCK, Vec3D(x, -n, z))
-                self.place_voxel(BOUNDARY_BLOCK, Vec3D(x, n+1, z))
-
-                import random
-                self.place_voxel(BOUNDARY_BLOCK, Vec3D(x, random.randint(-n, n+1), z))
-
-                # create outer boundary walls
-                if x in (-n, n) or z in (-n, n):
-                    for dy in range(-n, n + 1):
-                        self.place_voxel(BOUNDARY_BLOCK, Vec3D(x, dy, z))
+        # Computer-controlled characters, simulated together
+        self.crowd = Crowd(self, render)
+        # Falling blocks, which settle back into voxels
+        self.debris = debris.Debris(self, self.physics, self.physics_np,
+                                    render, self.journal)
+
+        # Add players, unless running without a window or any controls,
+        # and look through the eyes of the one at the window
+        if controls is None and window is not None:
+            controls = FPSControls(window)
+        if controls is not None:
+            self.players.append(Character(
+                self, controls, Vec3D(0, 0, 0), Vec2D(0, 0),
+                None if window is None else window.camera))
+
+        # Stand on the server's world from the first tick
+        if self.client is not None:
+            self.client.join(self.focus)
+
+    @property
+    def focus(self) -> Vec3D:
+        """Where the world is streamed around."""
+        if self.players:
+            return self.players[0].position
+        return Vec3D(0, 0, 0)
 
     def update(self, dt):
+        if self.streamer is not None:
+            self.streamer.update(self.focus)
+        if self.client is not None:
+            self.client.update(self.focus)
+        # Distant chunks are drawn coarser, by their distance from the eye
+        eye = self.focus if base.camera is None else \
+            base.camera.getPos(self.node_path)
+        self.update_lod(eye)
+        with profiling.MESHING:
+            self.scheduler.update(base.cam)
+        self.colliders.update()
+        # Looking around first keeps the mouse a frame ahead of the ticks
+        # that walk where the player is looking.
         for player in self.players:
-            player.update(dt, self)
-        self.physics.doPhysics(dt)
+            player.look()
+        for _ in range(self.clock.advance(dt)):
+            self.tick()
+        self.interpolator.update(self.clock.alpha)
+        self.crowd.draw(self.clock.alpha)
+        self.debris.draw(self.clock.alpha)
+        profiling.TRIANGLES.set(self.triangle_count)
+        profiling.VOXELS.set(len(self))
+        profiling.CHUNKS.set(len(self._chunks))
+        profiling.DIRTY_CHUNKS.set(self.scheduler.pending)
+        profiling.end_frame()
+
+    def tick(self):
+        """Advance the players and physics by one fixed step."""
+        step = self.clock.step
+        self.interpolator.snapshot()
+        self.crowd.snapshot()
+        self.debris.snapshot()
+        with profiling.CHARACTERS:
+            for player in self.players:
+                player.update(step, self)
+            self.crowd.update(step)
+        with profiling.PHYSICS:
+            self.physics.doPhysics(step, self.substeps, step / self.substeps)
+            self.debris.update(step)
 
     def load(self) -> None:
         """ Initialize the world by placing all the blocks."""
-        # If loading from a file, pull in those blocks.
-        # if len(sys.argv) > 1:
-        #     self.filepath = sys.argv[1]
-        # try:
-        #     with open(self.filepath, 'rb') as infile:
-        #         self.world = pickle.load(infile)
-        # except FileNotFoundError:
-        #     self._load_default_world()
-        self._create_boundary_blocks()
+        # Generating and meshing the whole world at once is worth spreading
+        # over every core.
+        with ProcessPoolExecutor() as executor:
+            # Chunks saved in the file take the place of generated ones.
+            self.streamer = terrain.ChunkStreamer(self, self.generator)
+            try:
+                world_format.load(self.filepath, self, self.streamer)
+            except FileNotFoundError:
+                pass
+            self.streamer.update(self.focus, everything=True,
+                                 executor=executor)
+            self.scheduler.finish(executor)
+
+    @property
+    def held_chunks(self) -> Dict:
+        """Edited chunks the streamer unloaded, which are saved too."""
+        return {} if self.streamer is None else self.streamer.held
 
     def save(self):
-        """Write the room to a file."""
-        # TODO: I'm borked!
-        with open(self.filepath, 'wb') as outfile:
-            pickle.dump(self, outfile)
+        """Write the room to a file, unless it belongs to a server."""
+        if self.client is None:
+            self.journal.save(self.filepath, self.held_chunks)
+
+    def autosave(self) -> int:
+        """Append the edits made since the last save to the room's file,
+        returning how many there were. The server saves shared rooms.
+        """
+        if self.client is not None:
+            return 0
+        return self.journal.autosave(self.filepath, self.held_chunks)
 
     def hit_test(self, position: Vec3D, vector: Vec3D,
                  max_distance: int=8) -> tuple:
@@ -90,28 +211,18 @@ class RoomEditor(voxel.VoxelWorld):
         intersected it is returned, along with the block previously in the line
         of sight. If no block is found, return None, None.
         """
-        m = 8
-        x, y, z = position
-        dx, dy, dz = vector
-        previous = None
-        for _ in range(max_distance * m):
-            key = voxel.normalize(position)
-            if key != previous and key in self:
-                return key, previous
-            previous = key
-            x, y, z = x + dx / m, y + dy / m, z + dz / m
-        return None, None
+        key, previous, _ = self.raycast(position, vector, max_distance)
+        return key, previous
+
+    def on_chunk_changed(self, chunk: voxel.Chunk) -> None:
+        self.colliders.mark_dirty(chunk)
+
+    def on_chunk_unloaded(self, chunk: voxel.Chunk) -> None:
+        self.colliders.unload(chunk)
 
     def generate_physics(self):
-        mesh = BulletTriangleMesh()
-        mesh.add_geom(self._geom)
-        shape = BulletTriangleMeshShape(mesh, dynamic=True)
-        node = BulletRigidBodyNode('Ground')
-        node.addShape(shape)
-        np = render.attachNewNode(node)
-        np.setPos(0, 0, 0)
-        self.physics_np = np
-        self.physics.attachRigidBody(node)
+        # Every chunk changed while loading, so this builds all of them.
+        self.colliders.update()
 
         # Show debug rendering
         # debugNode = BulletDebugNode('Debug')
@@ -128,20 +239,56 @@ class Window(ShowBase):
     """Implement the code that creates the window."""
     previous_mouse = (0, 0)
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, filepath: str=None,
+                 lighting_preset: str=lighting.DEFAULT_PRESET,
+                 record: str=None, profile: str=None, connect: str=None,
+                 **kwargs):
         super().__init__(*args, **kwargs)
 
         # The crosshairs at the center of the screen.
         self.reticle = None
 
         # Instance of the model that handles the world.
-        self.world = RoomEditor(self)
+        # Mesh the first time round as the lighting preset wants
+        preset = lighting.PRESETS[lighting_preset]
+        # Log the session for `recording.replay()`, if asked to
+        self.recorder = None
+        if record is not None:
+            recording.save_start(filepath or RoomEditor.filepath, record)
+            self.recorder = recording.InputRecorder(
+                FPSControls(self), record, preset=lighting_preset)
+            self.finalExitCallbacks.append(self.recorder.close)
+        self.world = RoomEditor(
+            self, filepath, ambient_occlusion=preset.ambient_occlusion,
+            light_levels=preset.light_levels, controls=self.recorder,
+            connect=None if connect is None else
+            network.parse_address(connect))
+        if self.world.client is not None:
+            self.finalExitCallbacks.append(self.world.client.close)
+        if self.recorder is not None:
+            # Every change to the world, whatever made it
+            self.world.journal.listeners.append(functools.partial(
+                self.recorder.record_changes, self.world.palette))
 
         # Lighting
-        self.build_lighting()
+        self.build_lighting(lighting_preset)
+
+        # Skip chunks hidden behind terrain, and count what is drawn
+        self.culling = culling.ChunkCuller(self.world)
+        self.accept(CULLING_KEY, self.culling.toggle)
+        self.stats_text = OnscreenText(pos=(-1.3, 0.9), scale=0.05,
+                                       fg=(1, 1, 1, 1), align=TextNode.ALeft,
+                                       mayChange=True)
+        self.stats_text.hide()
+        self.accept(STATS_KEY, self.toggle_stats)
+        # Write the hot path timings to a file every few seconds, if asked to
+        self.stats_dump = None
+        if profile is not None:
+            self.stats_dump = profiling.StatsDump(profile)
+            self.finalExitCallbacks.append(self.stats_dump.write)
 
         # Get the picker
-        self.picker = ReticleVoxelPicker(debug=True)
+        self.picker = ReticleVoxelPicker(self.world)
 
         # This call schedules the `update()` method to be called
         # TICKS_PER_SEC. This is the main game event loop.
@@ -150,33 +297,126 @@ class Window(ShowBase):
         self.accept('mouse1', self.add_voxel)
         self.accept('mouse2', self.remove_voxel)
 
+        # The number keys pick the block to build with.
+        self.block = BUILDING_BLOCKS[0]
+        for i, block in enumerate(BUILDING_BLOCKS):
+            self.accept(str(i + 1), setattr, [self, 'block', block])
+
+        # Editing whole regions, and taking edits back
+        self.corners = []  # Up to two opposite corners of the selection
+        self.clipboard = None
+        self.accept(UNDO_KEY, self.world.journal.undo)
+        self.accept(REDO_KEY, self.world.journal.redo)
+        self.accept(SAVE_KEY, self.world.save)
+        self.accept(SELECT_KEY, self.select_corner)
+        self.accept(FILL_KEY, self.fill_selection)
+        self.accept(HOLLOW_KEY, self.fill_selection, [True])
+        self.accept(CLEAR_KEY, self.clear_selection)
+        self.accept(REPLACE_KEY, self.replace_selection)
+        self.accept(COPY_KEY, self.copy_selection)
+        self.accept(PASTE_KEY, self.paste)
+        self.accept(CROWD_KEY, self.spawn_crowd)
+        self.accept(DROP_KEY, self.drop_block)
+        self.accept(LOOSEN_KEY, self.loosen)
+        self.task_mgr.doMethodLater(AUTOSAVE_INTERVAL, self.autosave,
+                                    'autosave_task')
+
     def add_voxel(self):
         prev_pos, next_pos = self.picker.from_reticle()
         if not prev_pos:
             return
 
-        self.world.place_voxel(None, prev_pos)
+        self.world.journal.place([prev_pos], self.block)
+
+    def drop_block(self):
+        """Let a building block fall from in front of the crosshairs."""
+        prev_pos, next_pos = self.picker.from_reticle()
+        if prev_pos:
+            self.world.debris.drop([prev_pos], self.block)
 
-        # shape = BulletBoxShape(Vec3(0.5, 0.5, 0.5))
-        # node = BulletRigidBodyNode('Box')
-        # node.setMass(1.0)
-        # node.addShape(shape)
-        # np = render.attachNewNode(node)
-        # np.setPos(prev_pos)
-        # self.world.physics.attachRigidBody(node)
-        # model = loader.loadModel('models/box.egg')
-        # model.flattenLight()
-        # model.reparentTo(np)
+    def loosen(self):
+        """Make the blocks in the selection fall, or the one in the
+        crosshairs if nothing is selected.
+        """
+        if len(self.corners) == 2:
+            self.world.debris.loosen(editing.box(*self.corners))
+            return
+        prev_pos, next_pos = self.picker.from_reticle()
+        if next_pos:
+            self.world.debris.loosen([next_pos])
 
     def remove_voxel(self):
         prev_pos, next_pos = self.picker.from_reticle()
         if not next_pos:
             return
 
-        self.world.remove_voxel(next_pos)
+        self.world.journal.remove([next_pos])
+
+    def select_corner(self):
+        """Make the block in the crosshairs a corner of the selection,
+        starting a new one once there are two.
+        """
+        prev_pos, next_pos = self.picker.from_reticle()
+        if not next_pos:
+            return
+        if len(self.corners) == 2:
+            self.corners = []
+        self.corners.append(next_pos)
+
+    def fill_selection(self, hollow: bool=False):
+        """Fill the selection with the building block, or only its sides.
+        """
+        if len(self.corners) != 2:
+            return
+        if hollow:
+            self.world.journal.hollow(*self.corners, self.block)
+        else:
+            self.world.journal.fill(*self.corners, self.block)
+
+    def clear_selection(self):
+        if len(self.corners) == 2:
+            self.world.journal.clear(*self.corners)
+
+    def replace_selection(self):
+        """Turn the blocks in the selection that are like the one in the
+        crosshairs into the building block.
+        """
+        prev_pos, next_pos = self.picker.from_reticle()
+        if len(self.corners) != 2 or not next_pos:
+            return
+        old_type = self.world[next_pos].voxel_type
+        self.world.journal.replace(*self.corners, old_type, self.block)
+
+    def copy_selection(self):
+        if len(self.corners) == 2:
+            self.clipboard = self.world.journal.copy(*self.corners)
 
-    def build_lighting(self):
-        """Set up the lighting for the game."""
+    def paste(self):
+        prev_pos, next_pos = self.picker.from_reticle()
+        if self.clipboard is None or not prev_pos:
+            return
+        self.world.journal.paste(self.clipboard, prev_pos)
+
+    def spawn_crowd(self):
+        """Drop a group of computer-controlled characters around the
+        player.
+        """
+        x, y, z = self.world.focus
+        angles = [2 * math.pi * i / CROWD_SPAWN for i in range(CROWD_SPAWN)]
+        self.world.crowd.spawn([(x + CROWD_SPREAD * math.cos(a),
+                                 y + CROWD_SPREAD * math.sin(a), z + 2)
+                                for a in angles])
+
+    def autosave(self, task: Task):
+        self.world.autosave()
+        return task.again
+
+    def build_lighting(self, preset: str=lighting.DEFAULT_PRESET):
+        """Set up the lighting for the game. The preset decides which
+        lights cast shadows, see `lighting.PRESETS`. Lamps and the sky light
+        the world through the light levels baked into the chunks, so only
+        the spotlight is a Panda3D light.
+        """
         self.camLens.setNear(0.01)
 
         # Fog
@@ -189,26 +429,24 @@ class Window(ShowBase):
         # Lights
         spotlight = Spotlight("spotlight")
         spotlight.setColor(Vec4(1, 1, 1, 1))
-        spotlight.setShadowCaster(True, 2048, 2048)
         spotlight_node = self.render.attachNewNode(spotlight)
         spotlight_node.setPos(9, 9, 9)
         spotlight_node.lookAt(0, 0, 0)
         self.render.setLight(spotlight_node)
 
-        point = PointLight("point")
-        point.setColor(Vec4(1, 1, 1, 1))
-        point.setShadowCaster(True, 2048, 2048)
-        point_node = self.render.attachNewNode(point)
-        point_node.set_pos(-9, -9, -9)
-        self.render.setLight(point_node)
-
         ambient_light = AmbientLight("ambientLight")
         ambient_light.setColor(Vec4(.25, .25, .25, 1))
         self.render.setLight(self.render.attachNewNode(ambient_light))
 
-        # Enable the shader generator for the receiving nodes
+        # Enable the shader generator for everything but the chunks, which
+        # have shaders of their own
         self.render.setShaderAuto()
 
+        self.lighting = lighting.LightingQuality(
+            self.world, self.cam,
+            {'spotlight': spotlight_node}, preset)
+        self.accept(LIGHTING_KEY, self.lighting.cycle)
+
     def get_sight_vector(self) -> Vec3D:
         """ Returns the current line of sight vector indicating the direction
         the player is looking.
@@ -230,8 +468,27 @@ class Window(ShowBase):
         # noinspection PyUnresolvedReferences
         dt = globalClock.getDt()
         self.world.update(dt)
+        self.lighting.update(self.world.focus)
+        stats = self.culling.update(self.cam)
+        if not self.stats_text.isHidden():
+            self.stats_text.setText(
+                'draw calls {}  triangles {}\n'
+                'chunks {}  frustum culled {}  cave culled {}{}\n\n{}'.format(
+                    stats.draw_calls, stats.triangles, stats.chunks,
+                    stats.frustum_culled, stats.cave_culled,
+                    '' if self.culling.enabled else ' (off)',
+                    profiling.overlay_text()))
+        if self.stats_dump is not None:
+            self.stats_dump.update()
         return task.cont
 
+    def toggle_stats(self):
+        """Show or hide the frame statistics in the top left corner."""
+        if self.stats_text.isHidden():
+            self.stats_text.show()
+        else:
+            self.stats_text.hide()
+
     def on_mouse_press(self, x: int, y: int, button: int, modifiers: int):
         """ Called when a mouse button is pressed. See pyglet docs for button
         and modifier mappings.
@@ -253,7 +510,21 @@ class Window(ShowBase):
 
 def main():
     """Run the program."""
-    window = Window()
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('filepath', nargs='?', help='the world to edit')
+    parser.add_argument('--record', metavar='LOG',
+                        help='log the session for recording.py to replay')
+    parser.add_argument('--profile', metavar='PATH',
+                        help='write timings to a .csv or JSON lines file')
+    parser.add_argument('--pstats', action='store_true',
+                        help='send timings to a running PStats server')
+    parser.add_argument('--connect', metavar='HOST:PORT',
+                        help='edit the world of a server run by network.py')
+    args = parser.parse_args()
+    if args.pstats:
+        PStatClient.connect()
+    window = Window(filepath=args.filepath, record=args.record,
+                    profile=args.profile, connect=args.connect)
     window.run()
 
 
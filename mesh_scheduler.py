@@ -0,0 +1,121 @@
+# coding=utf-8
+"""Mesh dirty chunks on worker threads and upload the results between frames.
+"""
+import math
+import os
+import time
+from concurrent.futures import Executor, Future, ThreadPoolExecutor, wait
+from typing import Dict, Tuple
+
+from panda3d.core import BoundingVolume
+from panda3d.core import NodePath
+
+import voxel
+
+UPLOAD_BUDGET = 0.004  # Seconds per frame spent swapping in finished meshes
+JOBS_PER_WORKER = 2  # Chunks in flight for each worker thread
+
+
+class MeshScheduler:
+    """Moves chunk meshing off the main thread.
+
+    Dirty chunks are snapshotted on the main thread, meshed with NumPy on a
+    thread pool and swapped into their GeomNodes by `update()`, which stops
+    uploading once the frame's time budget is spent. Chunks in view of the
+    camera are meshed first, nearest first.
+    """
+    def __init__(self, world: voxel.VoxelWorld, workers: int=None,
+                 budget: float=UPLOAD_BUDGET):
+        self.world = world
+        self.budget = budget
+        self.workers = workers or min(4, os.cpu_count() or 1)
+        self._executor = ThreadPoolExecutor(self.workers,
+                                            thread_name_prefix='mesher')
+        # Dictionaries keep the order chunks were queued in.
+        self._queued: Dict[voxel.Chunk, None] = {}
+        self._running: Dict[voxel.Chunk, Future] = {}
+
+    @property
+    def pending(self) -> int:
+        """The number of chunks waiting for or being meshed."""
+        return len(self._queued.keys() | self._running.keys())
+
+    def update(self, camera: NodePath=None) -> None:
+        """Upload finished meshes within the budget, then hand the most
+        important dirty chunks to the workers. Call this once per frame.
+        """
+        self._queued.update(dict.fromkeys(self.world.take_dirty()))
+        self._upload(self.budget)
+        self._submit(camera)
+
+    def finish(self, executor: Executor=None) -> None:
+        """Mesh and upload every dirty chunk, waiting for the workers.
+        Passing a process pool meshes on other processes instead, which
+        sidesteps the GIL when a whole world is loaded at once.
+        """
+        while True:
+            self._queued.update(dict.fromkeys(self.world.take_dirty()))
+            if not self._queued and not self._running:
+                return
+            self._submit(executor=executor, limit=len(self._queued))
+            wait(list(self._running.values()))
+            self._upload(math.inf)
+
+    def shutdown(self) -> None:
+        """Stop the worker threads, dropping any unfinished work."""
+        for future in self._running.values():
+            future.cancel()
+        self._executor.shutdown(wait=True)
+        self._running.clear()
+        self._queued.clear()
+
+    def _upload(self, budget: float) -> None:
+        start = time.perf_counter()
+        for chunk, future in list(self._running.items()):
+            if not future.done():
+                continue
+            del self._running[chunk]
+            if not self.world.upload(chunk, future.result()):
+                # Edited while meshing, or switched to another level of
+                # detail, so the result is already stale.
+                self._queued[chunk] = None
+                continue
+            # Always make progress, however slow a single upload is.
+            if time.perf_counter() - start > budget:
+                return
+
+    def _submit(self, camera: NodePath=None, executor: Executor=None,
+                limit: int=None) -> None:
+        executor = executor or self._executor
+        free = limit or self.workers * JOBS_PER_WORKER - len(self._running)
+        if free <= 0 or not self._queued:
+            return
+        for chunk in [c for c in self._queued if not self.world.has_chunk(c)]:
+            del self._queued[chunk]  # Unloaded since it was queued
+        # Chunks still being meshed wait for their job to come back.
+        ready = [c for c in self._queued if c not in self._running]
+        if camera is not None:
+            priority = self._priority(camera)
+            ready.sort(key=priority)
+        for chunk in ready[:free]:
+            del self._queued[chunk]
+            self._running[chunk] = executor.submit(
+                voxel.build_mesh, *self.world.mesh_job(chunk))
+
+    def _priority(self, camera: NodePath):
+        """Return a sort key putting visible chunks before hidden ones and
+        near chunks before far ones.
+        """
+        relative_to = self.world.node_path
+        frustum = camera.node().getLens().makeBounds()
+        frustum.xform(camera.getMat(relative_to))
+        eye = camera.getPos(relative_to)
+        middle = (voxel.CHUNK_SIZE - voxel.CUBE_SIZE) / 2.0
+
+        def priority(chunk: voxel.Chunk) -> Tuple[bool, float]:
+            hidden = frustum.contains(chunk.bounds) == \
+                BoundingVolume.IF_no_intersection
+            distance = sum((o + middle - e) ** 2
+                           for o, e in zip(chunk.origin, eye))
+            return hidden, distance
+        return priority
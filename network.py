@@ -0,0 +1,506 @@
+# coding=utf-8
+"""Share one voxel world between several editors over TCP.
+
+A `WorldServer` holds the authoritative copy of the world, without drawing
+it, and every editor connects to it with a `WorldClient`. Clients tell the
+server where their player is, and the server streams them the chunks around
+that position: a compressed snapshot of each chunk as it comes into range,
+and an unload message once it is left behind. From then on the server sends
+each client only the voxels changed in the chunks it holds, batched once per
+tick, so the bandwidth of a client grows with what it can see rather than
+with the size of the world.
+
+Edits made on a client are applied right away and sent to the server, which
+applies them in the order they arrive and echoes them to every client that
+holds the chunks, the sender included. When two clients change the same
+block at once they may briefly disagree, but both end up with whatever the
+server applied last.
+
+Every message is a type byte and a payload length, followed by the payload.
+Voxel types are sent once per connection, see `PALETTE`, and referred to by
+their palette number after that, so each side keeps its own palette.
+
+    python network.py room.world --port 7777
+    python main.py --connect localhost:7777
+"""
+import argparse
+import json
+import socket
+import struct
+import time
+import zlib
+from typing import Iterator, List, Optional, Set, Tuple
+
+import numpy as np
+
+import editing
+import simulation
+import terrain
+import voxel
+import world_format
+
+MAGIC = b'ENET'
+VERSION = 1
+DEFAULT_PORT = 7777
+FRAME = struct.Struct('<BI')  # message type, payload length
+WELCOME = struct.Struct('<4sHH')  # magic, version, chunk size
+KEY = struct.Struct('<iii')  # chunk key
+TICK = struct.Struct('<I')  # the server tick an edit batch belongs to
+POSITION = struct.Struct('<ddd')  # where a client's player is
+CHANGE = world_format.CHANGE
+COMPRESSION = 6  # zlib level of chunk snapshots and edit batches
+RECEIVE_SIZE = 1 << 16  # Bytes read from a socket at a time
+# The longest payload taken from the other end, compressed or not. Anything
+# longer closes the connection rather than being buffered.
+MAX_PAYLOAD = 1 << 24
+# What garbled messages from a client raise, which only drops that client
+MALFORMED = (zlib.error, struct.error, ValueError, IndexError, KeyError)
+SAVE_INTERVAL = 30.0  # Seconds between appending edits to the journal
+
+# Message types
+(WELCOME_MESSAGE,  # Server to client, first thing on a connection
+ PALETTE,  # Voxel types the receiver has not been sent yet, as JSON
+ CHUNK,  # Server to client: a chunk key and its run-length encoded voxels
+ UNLOAD,  # Server to client: drop the chunk with this key
+ EDITS,  # Changed voxels, see `encode_changes()`
+ MOVE,  # Client to server: where the client's player is now
+ READY,  # Server to client: every chunk around the player has been sent
+ ) = range(1, 8)
+
+Key = Tuple[int, int, int]
+
+
+def encode_changes(positions: np.ndarray, type_ids: np.ndarray) -> bytes:
+    """Compress a batch of changed voxels. Positions are stored as the
+    difference from the one before, which is mostly small numbers for the
+    boxes and lines edits come in, and those compress well.
+    """
+    changes = np.empty(len(positions), dtype=CHANGE)
+    changes['position'] = np.diff(positions, axis=0, prepend=np.zeros((1, 3),
+                                                                 np.int64))
+    changes['value'] = type_ids
+    return zlib.compress(changes.tobytes(), COMPRESSION)
+
+
+def decode_changes(data) -> Tuple[np.ndarray, np.ndarray]:
+    """Expand the positions and palette numbers of `encode_changes()`."""
+    decompressor = zlib.decompressobj()
+    data = decompressor.decompress(data, MAX_PAYLOAD)
+    if decompressor.unconsumed_tail:
+        raise ValueError('Edit batch larger than {} bytes'.format(
+            MAX_PAYLOAD))
+    changes = np.frombuffer(data, dtype=CHANGE)
+    positions = np.cumsum(changes['position'].astype(np.int64), axis=0)
+    return positions, changes['value'].astype(voxel.TYPE_DTYPE)
+
+
+class Connection:
+    """A socket sending and receiving whole messages without blocking.
+
+    It also keeps the palettes of both ends: how many of our voxel types
+    were sent, and the other end's types with our numbers for them.
+    """
+    def __init__(self, sock: socket.socket):
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.socket = sock
+        self.closed = False
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self._incoming = bytearray()
+        self._outgoing = bytearray()
+        self._palette_sent = 0  # Our voxel types the other end knows
+        self.remote_palette: List = []  # The other end's types, in order
+        self._lookup = np.zeros(1, dtype=voxel.TYPE_DTYPE)  # Theirs to ours
+
+    def send(self, message: int, payload: bytes=b'') -> None:
+        """Queue a message, see `flush()`."""
+        self._outgoing += FRAME.pack(message, len(payload))
+        self._outgoing += payload
+
+    def send_palette(self, palette: voxel.Palette) -> None:
+        """Send the voxel types added to `palette` since the last call, so
+        palette numbers sent afterwards can be understood.
+        """
+        if len(palette) - 1 > self._palette_sent:
+            types = list(palette)[self._palette_sent:]
+            self.send(PALETTE, json.dumps(types).encode('utf-8'))
+            self._palette_sent += len(types)
+
+    def receive_palette(self, payload: bytes, palette: voxel.Palette) -> None:
+        """Take in voxel types from `send_palette()` at the other end."""
+        types = json.loads(payload.decode('utf-8'))
+        # Names, or None for the plain block of `terrain.RoomGenerator`
+        if not isinstance(types, list) or \
+                not all(isinstance(t, (str, type(None))) for t in types):
+            raise ValueError('Voxel types must be a list of names')
+        self.remote_palette.extend(types)
+        self._lookup = np.concatenate((self._lookup, np.array(
+            [palette.id_of(t) for t in types], dtype=voxel.TYPE_DTYPE)))
+
+    def local_ids(self, type_ids: np.ndarray) -> np.ndarray:
+        """Turn palette numbers of the other end into ours."""
+        return self._lookup[type_ids]
+
+    def flush(self) -> None:
+        """Send as much of the queued messages as the socket takes."""
+        if self.closed or not self._outgoing:
+            return
+        try:
+            sent = self.socket.send(self._outgoing)
+        except BlockingIOError:
+            return
+        except OSError:
+            self.close()
+            return
+        self.bytes_sent += sent
+        del self._outgoing[:sent]
+
+    def receive(self) -> Iterator[Tuple[int, bytes]]:
+        """Read what has arrived and yield the messages completed by it."""
+        while not self.closed:
+            try:
+                data = self.socket.recv(RECEIVE_SIZE)
+            except BlockingIOError:
+                break
+            except OSError:
+                data = b''
+            if not data:
+                self.close()
+                break
+            self.bytes_received += len(data)
+            self._incoming += data
+        offset = 0
+        while offset + FRAME.size <= len(self._incoming):
+            message, length = FRAME.unpack_from(self._incoming, offset)
+            if length > MAX_PAYLOAD:
+                self.close()
+                self._incoming.clear()
+                return
+            end = offset + FRAME.size + length
+            if end > len(self._incoming):
+                break
+            yield message, bytes(self._incoming[offset + FRAME.size:end])
+            offset = end
+        del self._incoming[:offset]
+
+    def close(self) -> None:
+        self.closed = True
+        self.socket.close()
+
+
+class ClientState:
+    """What the server knows about one client."""
+    def __init__(self, connection: Connection):
+        self.connection = connection
+        self.focus: Optional[Key] = None  # The chunk the player is in
+        self.known: Set[Key] = set()  # Chunks the client holds, or air
+        self.ready = False  # Sent everything around the player once
+
+
+class WorldServer:
+    """Owns the shared world and keeps every client's copy of the parts
+    around its player current. Call `update()` once per tick.
+
+    Without a file, chunks are generated as clients come near them.
+    """
+    def __init__(self, world: voxel.VoxelWorld, host: str='localhost',
+                 port: int=DEFAULT_PORT, filepath: str=None,
+                 generator: terrain.TerrainGenerator=None,
+                 radius: int=terrain.LOAD_RADIUS,
+                 height: int=terrain.LOAD_HEIGHT,
+                 per_update: int=terrain.CHUNKS_PER_UPDATE):
+        self.world = world
+        self.filepath = filepath
+        self.generator = generator
+        self.radius = radius
+        self.height = height
+        self.per_update = per_update  # Chunk snapshots per client and tick
+        self.journal = editing.EditJournal(world)
+        self.tick = 0
+        self.clients: List[ClientState] = []
+        self._generated: Set[Key] = set()
+        self._edits: List[editing.Edit] = []  # Applied this tick
+        # Offsets of the chunks each client holds, nearest first.
+        self._offsets: List[Key] = sorted(
+            ((dx, dy, dz)
+             for dx in range(-radius, radius + 1)
+             for dy in range(-radius, radius + 1)
+             for dz in range(-height, height + 1)
+             if dx * dx + dy * dy <= radius * radius),
+            key=lambda o: o[0] * o[0] + o[1] * o[1] + o[2] * o[2])
+
+        self._listener = socket.create_server((host, port))
+        self._listener.setblocking(False)
+        self.address = self._listener.getsockname()[:2]
+
+    def update(self) -> None:
+        """Take in new clients and their messages, then send every client
+        the edits of this tick and the chunks it is missing.
+        """
+        self._accept()
+        for client in self.clients:
+            try:
+                for message, payload in client.connection.receive():
+                    self._handle(client, message, payload)
+            except MALFORMED:
+                client.connection.close()  # The others carry on
+        self.clients = [c for c in self.clients if not c.connection.closed]
+
+        edits, self._edits = self._edits, []
+        for client in self.clients:
+            self._send_edits(client, edits)
+            self._stream(client)
+            client.connection.flush()
+        self.tick += 1
+
+    def apply(self, positions, type_ids) -> Optional[editing.Edit]:
+        """Edit the world on the server, passing it on to the clients."""
+        edit = self.journal.apply(positions, type_ids)
+        if edit is not None:
+            self._edits.append(edit)
+        return edit
+
+    def save(self) -> None:
+        """Append the edits since the last save to the world's journal."""
+        if self.filepath is not None:
+            self.journal.autosave(self.filepath)
+
+    def close(self) -> None:
+        """Disconnect every client and stop listening."""
+        for client in self.clients:
+            client.connection.flush()
+            client.connection.close()
+        self.clients = []
+        self._listener.close()
+
+    def _accept(self) -> None:
+        while True:
+            try:
+                sock, _ = self._listener.accept()
+            except BlockingIOError:
+                return
+            connection = Connection(sock)
+            connection.send(WELCOME_MESSAGE, WELCOME.pack(
+                MAGIC, VERSION, voxel.CHUNK_SIZE))
+            self.clients.append(ClientState(connection))
+
+    def _handle(self, client: ClientState, message: int,
+                payload: bytes) -> None:
+        connection = client.connection
+        if message == PALETTE:
+            connection.receive_palette(payload, self.world.palette)
+        elif message == MOVE:
+            client.focus = voxel.chunk_key(POSITION.unpack(payload))
+        elif message == EDITS:
+            positions, type_ids = decode_changes(payload[TICK.size:])
+            self.apply(positions, connection.local_ids(type_ids))
+        else:
+            connection.close()  # Not something clients send
+
+    def _send_edits(self, client: ClientState,
+                    edits: List[editing.Edit]) -> None:
+        if not edits or not client.known:
+            return
+        positions = np.concatenate([edit.positions for edit in edits])
+        type_ids = np.concatenate([edit.new for edit in edits])
+        # Blocks changed more than once this tick are sent as they ended up.
+        _, last = np.unique(positions[::-1], axis=0, return_index=True)
+        last = len(positions) - 1 - last
+        positions, type_ids = positions[last], type_ids[last]
+        # Only the chunks the client holds; it gets the others whole later.
+        keys, members = np.unique(np.floor_divide(positions, voxel.CHUNK_SIZE),
+                                  axis=0, return_inverse=True)
+        held = np.array([key in client.known for key in map(tuple,
+                                                            keys.tolist())])
+        held = held[members.reshape(-1)]
+        if not held.any():
+            return
+        client.connection.send_palette(self.world.palette)
+        client.connection.send(EDITS, TICK.pack(self.tick) + encode_changes(
+            positions[held], type_ids[held]))
+
+    def _stream(self, client: ClientState) -> None:
+        """Unload the chunks a client left behind and send the nearest
+        missing ones.
+        """
+        if client.focus is None:
+            return
+        cx, cy, cz = client.focus
+        connection = client.connection
+        # Unload a chunk further out than it is sent, so that walking back
+        # and forth over a chunk border does not resend it.
+        reach = self.radius + 1
+        for key in list(client.known):
+            dx, dy, dz = key[0] - cx, key[1] - cy, key[2] - cz
+            if dx * dx + dy * dy > reach * reach or abs(dz) > self.height + 1:
+                client.known.discard(key)
+                connection.send(UNLOAD, KEY.pack(*key))
+
+        budget = self.per_update  # Chunks generated or sent
+        for dx, dy, dz in self._offsets:
+            key = (cx + dx, cy + dy, cz + dz)
+            if key in client.known:
+                continue
+            if not budget:
+                return
+            client.known.add(key)
+            if self.generator is not None and key not in self._generated:
+                self._generated.add(key)
+                budget -= 1
+                if self.world.set_chunk(key, self.generator.generate(key),
+                                        self.generator.voxel_types) is None:
+                    continue
+            chunk = self.world.get_chunk(np.array(key) * voxel.CHUNK_SIZE)
+            if chunk is None or not len(chunk):
+                continue  # The client has air there already
+            connection.send_palette(self.world.palette)
+            connection.send(CHUNK, KEY.pack(*key) + zlib.compress(
+                world_format.encode_runs(chunk.cells), COMPRESSION))
+            budget -= 1
+        if not client.ready:
+            client.ready = True
+            connection.send(READY)
+
+
+class WorldClient:
+    """Keeps a local world in step with a `WorldServer`. Call `update()`
+    once per tick with where the player is, and pass local edits on with
+    `send_edits()`.
+    """
+    def __init__(self, world: voxel.VoxelWorld, host: str='localhost',
+                 port: int=DEFAULT_PORT):
+        self.world = world
+        self.connection = Connection(socket.create_connection((host, port)))
+        self.welcomed = False
+        self.ready = False  # Holds every chunk around the player
+        self.tick = 0  # The last server tick edits arrived from
+        self._position: Optional[Tuple[float, ...]] = None
+
+    @property
+    def connected(self) -> bool:
+        return not self.connection.closed
+
+    def update(self, position=None) -> None:
+        """Report where the player is and apply what the server sent."""
+        if position is not None:
+            position = tuple(float(c) for c in position)
+            if position != self._position:
+                self._position = position
+                self.connection.send(MOVE, POSITION.pack(*position))
+        self.connection.flush()
+        for message, payload in self.connection.receive():
+            self._handle(message, payload)
+
+    def join(self, position=None, timeout: float=10.0) -> bool:
+        """Wait until every chunk around `position` has arrived, returning
+        False if that took longer than `timeout` seconds.
+        """
+        deadline = time.perf_counter() + timeout
+        while not self.ready and self.connected:
+            if time.perf_counter() > deadline:
+                return False
+            self.update(position)
+            time.sleep(0.001)
+        return self.ready
+
+    def send_edits(self, positions: np.ndarray, type_ids: np.ndarray) -> None:
+        """Tell the server about voxels changed in the local world."""
+        self.connection.send_palette(self.world.palette)
+        self.connection.send(EDITS, TICK.pack(self.tick) +
+                             encode_changes(positions, type_ids))
+
+    def close(self) -> None:
+        self.connection.flush()
+        self.connection.close()
+
+    def _handle(self, message: int, payload: bytes) -> None:
+        if message == WELCOME_MESSAGE:
+            magic, version, chunk_size = WELCOME.unpack(payload)
+            if magic != MAGIC:
+                raise ValueError('Not a world server')
+            if version != VERSION:
+                raise ValueError('Unsupported server version {}'.format(
+                    version))
+            if chunk_size != voxel.CHUNK_SIZE:
+                raise ValueError('The server uses chunks of {} blocks'.format(
+                    chunk_size))
+            self.welcomed = True
+        elif message == PALETTE:
+            self.connection.receive_palette(payload, self.world.palette)
+        elif message == CHUNK:
+            key = KEY.unpack_from(payload)
+            cells = world_format.decode_runs(
+                zlib.decompress(payload[KEY.size:]), voxel.CHUNK_SIZE ** 3)
+            self.world.set_chunk(key, cells.reshape((voxel.CHUNK_SIZE,) * 3),
+                                 self.connection.remote_palette)
+        elif message == UNLOAD:
+            self.world.unload_chunk(KEY.unpack(payload))
+        elif message == EDITS:
+            self.tick, = TICK.unpack_from(payload)
+            positions, type_ids = decode_changes(payload[TICK.size:])
+            type_ids = self.connection.local_ids(type_ids)
+            # Our own edits come back too, and need no remeshing.
+            changed = self.world.voxel_ids(positions) != type_ids
+            if changed.any():
+                self.world.set_voxels(positions[changed], type_ids[changed])
+        elif message == READY:
+            self.ready = True
+
+
+def parse_address(address: str) -> Tuple[str, int]:
+    """Split HOST:PORT, with the default port if there is none."""
+    host, _, port = address.rpartition(':')
+    if not host:
+        return port, DEFAULT_PORT
+    return host, int(port)
+
+
+def main(args: Optional[List[str]]=None):
+    """Serve a world to editors connecting with main.py --connect."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('filepath', nargs='?',
+                        help='the world to serve, generated if missing')
+    parser.add_argument('--host', default='', help='the address to listen on')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    args = parser.parse_args(args)
+
+    from panda3d.core import loadPrcFileData
+    loadPrcFileData('', 'window-type none\naudio-library-name null')
+    from direct.showbase.ShowBase import ShowBase
+    ShowBase()
+
+    world = voxel.VoxelWorld()
+    # Rooms without a file are generated around the players as they go.
+    generator = terrain.RoomGenerator()
+    if args.filepath is not None:
+        try:
+            world_format.load(args.filepath, world)
+            generator = None
+        except FileNotFoundError:
+            pass
+    server = WorldServer(world, args.host, args.port, args.filepath,
+                         generator)
+    print('Serving on {}:{}'.format(*server.address))
+
+    clock = simulation.FixedClock()
+    last = last_save = time.perf_counter()
+    try:
+        while True:
+            now = time.perf_counter()
+            for _ in range(clock.advance(now - last)):
+                server.update()
+            last = now
+            if now - last_save > SAVE_INTERVAL:
+                server.save()
+                last_save = now
+            time.sleep(clock.step / 4)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.save()
+        server.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,34 @@
 # coding=utf-8
 """Some useful utility classes and functions for Panda3D."""
+import os
 from typing import Callable, Any
 
 from panda3d.core import CollisionRay, CollisionTraverser, GeomNode, \
     CollisionNode, CollisionHandlerQueue
+from panda3d.core import DSearchPath
+from panda3d.core import Filename
 from panda3d.core import Vec3
+from panda3d.core import VirtualFileSystem
+from panda3d.core import getModelPath
+
+import profiling
 
 
 Filter = Callable[[Any], bool]
 
 
+def find_file(path: str) -> Filename:
+    """Look up a file along the model path like the loader does, and then
+    next to these modules, where the game's assets live.
+    """
+    search_path = DSearchPath(getModelPath().getValue())
+    search_path.appendDirectory(
+        Filename.fromOsSpecific(os.path.dirname(os.path.abspath(__file__))))
+    filename = Filename(path)
+    VirtualFileSystem.getGlobalPtr().resolveFilename(filename, search_path)
+    return filename
+
+
 class RayPicker:
     _parent = None
 
@@ -36,6 +55,7 @@ class RayPicker:
     def _iterate(self, condition: Filter):
         # TODO: Move condition to the constructor
         # Iterate over the collisions and pick one
+        profiling.RAYS.add()
         self._traverser.traverse(render)
 
         # Go closest to farthest
@@ -74,19 +94,24 @@ class MouseRayPicker(RayPicker):
         return self._iterate(condition)[0]
 
 
-class ReticleVoxelPicker(RayPicker):
-    """A ray picker that uses the center of the screen to pick a voxel location.
+class ReticleVoxelPicker:
+    """A picker that uses the center of the screen to pick a voxel location.
+    Instead of colliding against the scene graph it walks the voxel grid, so
+    the cost only depends on how far away the picked voxel is.
     """
-    def __init__(self, debug: bool=False):
-        self._parent = camera
-        super().__init__(debug=debug)
+    def __init__(self, world, max_distance: float=32.0):
+        self.world = world
+        self.max_distance = max_distance
 
-    def from_reticle(self, condition: Filter=None) -> (Vec3, Vec3):
+    @profiling.PICKING
+    def from_reticle(self) -> (Vec3, Vec3):
         """Return both the previous and next voxel locations that the
-        center of the screen is looking at.
+        center of the screen is looking at, or None, None.
         """
-        self._ray.setFromLens(base.camNode, 0, 0)
-        hit_pos, hit_normal = self._iterate(condition)
-        hit_pos -= hit_normal * 0.5
-        rounded = Vec3(round(hit_pos.x), round(hit_pos.y), round(hit_pos.z))
-        return rounded + hit_normal, rounded
+        origin = camera.getPos(render)
+        direction = render.getRelativeVector(camera, Vec3(0, 1, 0))
+        hit, previous, _ = self.world.raycast(origin, direction,
+                                              self.max_distance)
+        if hit is None:
+            return None, None
+        return previous, hit
@@ -0,0 +1,174 @@
+# coding=utf-8
+"""Time the voxel hot paths and count the work they do.
+
+Every `Timer` and `Counter` here reports to a Panda3D `PStatCollector`, so
+the numbers show up in PStats when the game runs with `want-pstats 1`. They
+also keep their own totals, which `end_frame()` turns into per-frame
+averages for the in-game overlay and for `StatsDump`, so sessions without a
+PStats server can show where frame time goes too.
+
+    with profiling.PHYSICS:
+        physics.doPhysics(dt)
+    profiling.VERTICES.add(len(rows))
+"""
+import collections
+import csv
+import functools
+import json
+import time
+from typing import Callable, Deque, Dict, List
+
+from panda3d.core import PStatCollector
+
+FRAME_HISTORY = 60  # Frames averaged by `averages()`
+DUMP_INTERVAL = 5.0  # Seconds between the rows of a `StatsDump`
+
+_timers: List['Timer'] = []
+_counters: List['Counter'] = []
+_history: Deque[Dict[str, float]] = collections.deque(maxlen=FRAME_HISTORY)
+
+
+class Timer:
+    """Times a piece of code with a PStats collector, and the seconds it
+    took this frame. Use it as a context manager or a decorator.
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self.collector = PStatCollector('App:' + name)
+        self.seconds = 0.0  # This frame
+        self.calls = 0
+        self._start = 0.0
+        self._depth = 0  # Only the outermost of nested uses is timed
+        _timers.append(self)
+
+    def __enter__(self):
+        self._depth += 1
+        if self._depth == 1:
+            self.collector.start()
+            self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._depth -= 1
+        if not self._depth:
+            self.seconds += time.perf_counter() - self._start
+            self.calls += 1
+            self.collector.stop()
+
+    def __call__(self, function: Callable) -> Callable:
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            with self:
+                return function(*args, **kwargs)
+        return timed
+
+
+class Counter:
+    """Counts something with a PStats level collector. Counters that are
+    `per_frame` start from 0 every frame; the others hold a level until it
+    is set again.
+    """
+    def __init__(self, name: str, per_frame: bool=True):
+        self.name = name
+        self.collector = PStatCollector(name)
+        self.per_frame = per_frame
+        self.value = 0
+        _counters.append(self)
+
+    def add(self, amount: int=1) -> None:
+        self.value += amount
+
+    def set(self, value: int) -> None:
+        self.value = value
+
+
+# Frame time
+EDITS = Timer('Voxels:Edit')
+UPLOAD = Timer('Voxels:Upload')
+MESHING = Timer('Voxels:Mesh scheduling')
+RAYCASTS = Timer('Voxels:Raycast')
+PICKING = Timer('Picking')
+PHYSICS = Timer('Physics')
+CHARACTERS = Timer('Characters')
+
+# Work done every frame
+VERTICES = Counter('Vertices written')  # Buffer rows, one per packed quad
+UPLOAD_BYTES = Counter('Mesh upload bytes')
+RAYS = Counter('Raycasts')
+VOXELS_EDITED = Counter('Voxels edited')
+
+# The state of the world
+TRIANGLES = Counter('Chunk triangles', per_frame=False)
+VOXELS = Counter('Voxels', per_frame=False)
+CHUNKS = Counter('Chunks', per_frame=False)
+DIRTY_CHUNKS = Counter('Dirty chunks', per_frame=False)
+
+
+def end_frame() -> Dict[str, float]:
+    """Hand this frame's numbers to PStats and the history, and start the
+    next frame. Returns the frame's numbers, with times in milliseconds.
+    """
+    frame = {}
+    for timer in _timers:
+        frame[timer.name + ' ms'] = timer.seconds * 1000.0
+        frame[timer.name + ' calls'] = timer.calls
+        timer.seconds, timer.calls = 0.0, 0
+    for counter in _counters:
+        frame[counter.name] = counter.value
+        counter.collector.setLevel(counter.value)
+        if counter.per_frame:
+            counter.value = 0
+    _history.append(frame)
+    return frame
+
+
+def averages() -> Dict[str, float]:
+    """Return the average of every number over the last few frames."""
+    if not _history:
+        return {}
+    return {name: sum(frame[name] for frame in _history) / len(_history)
+            for name in _history[-1]}
+
+
+def overlay_text(limit: int=5) -> str:
+    """Describe the slowest timers and every counter, for the overlay."""
+    numbers = averages()
+    timers = sorted(_timers, key=lambda t: -numbers.get(t.name + ' ms', 0))
+    lines = ['{} {:.2f} ms'.format(timer.name, numbers[timer.name + ' ms'])
+             for timer in timers[:limit] if timer.name + ' ms' in numbers]
+    lines.extend('{} {:.0f}'.format(counter.name, numbers[counter.name])
+                 for counter in _counters if counter.name in numbers)
+    return '\n'.join(lines)
+
+
+class StatsDump:
+    """Appends the averages of every number to a file every few seconds,
+    for sessions without a window or a PStats server. Files ending in .csv
+    get a row per dump, anything else a line of JSON.
+    """
+    def __init__(self, path: str, interval: float=DUMP_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self._last = time.perf_counter()
+        self._header = not path.endswith('.csv')  # JSON needs none
+
+    def update(self) -> None:
+        """Call once per frame, after `end_frame()`."""
+        now = time.perf_counter()
+        if now - self._last < self.interval:
+            return
+        self._last = now
+        self.write()
+
+    def write(self) -> None:
+        """Append the current averages to the file now."""
+        numbers = dict(averages(), time=time.time())
+        with open(self.path, 'a', newline='') as outfile:
+            if self.path.endswith('.csv'):
+                writer = csv.DictWriter(outfile, sorted(numbers))
+                if not self._header:
+                    writer.writeheader()
+                    self._header = True
+                writer.writerow(numbers)
+            else:
+                outfile.write(json.dumps(numbers, sort_keys=True) + '\n')
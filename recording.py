@@ -0,0 +1,304 @@
+# coding=utf-8
+"""Record play sessions and replay them without a window.
+
+An `InputRecorder` sits between a player and their `FPSControls` and writes
+one record per simulation tick: the action keys held down during the tick,
+how far the mouse moved since the tick before, and the voxels changed in
+between. Changes are taken from the `editing.EditJournal`, so box edits,
+pastes, undo and redo and settling debris are all in the log. Because the
+simulation only moves in fixed ticks, see `simulation`, feeding those
+records back through `ReplayControls` plays the session out the same way
+again, as fast as the machine allows, which turns a captured session into a
+benchmark:
+
+    python recording.py session.rec --output timings.json
+
+Falling debris is not simulated again on replay, only the voxels it took
+away and where they settled.
+
+A log starts with a header holding the tick rate and the lighting preset the
+session started with, followed by the ticks. Each tick is a bit mask of the
+keys held, the mouse movement and the number of edits, followed by the
+edits themselves: the voxel types they use as JSON, and the changed blocks
+in the format of `world_format.CHANGE`.
+"""
+import argparse
+import json
+import os
+import shutil
+import struct
+import time
+from typing import BinaryIO, Iterator, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from fps_controls import ActionKey, Controls
+import lighting
+import profiling
+import simulation
+import voxel
+import world_format
+
+MAGIC = b'EREC'
+VERSION = 2
+HEADER = struct.Struct('<4sHHH')  # magic, version, tick rate, preset length
+TICK = struct.Struct('<HddH')  # keys held, mouse movement, edits
+EDIT = struct.Struct('<II')  # changed blocks, voxel types length
+CHANGE = world_format.CHANGE
+WORLD_SUFFIX = '.world'  # The world a session started from, next to its log
+KEY_BITS = {key: 1 << i for i, key in enumerate(ActionKey)}
+
+
+class Edit(NamedTuple):
+    """Blocks changed by one operation between two ticks, and what each of
+    them holds now: 0 for air, or one more than an index into
+    `voxel_types`.
+    """
+    positions: np.ndarray
+    values: np.ndarray
+    voxel_types: List
+
+
+class Tick(NamedTuple):
+    """Everything the player did during one simulation tick."""
+    keys: int
+    mouse: Tuple[float, float]
+    edits: List[Edit]
+
+
+class InputRecorder(Controls):
+    """Passes input from other controls on to a player, writing it to a log
+    at `path` tick by tick.
+    """
+    def __init__(self, controls: Controls, path: str,
+                 tick_rate: int=simulation.TICK_RATE,
+                 preset: str=lighting.DEFAULT_PRESET):
+        self.controls = controls
+        self._file: BinaryIO = open(path, 'wb')
+        preset = preset.encode('utf-8')
+        self._file.write(HEADER.pack(MAGIC, VERSION, tick_rate, len(preset)))
+        self._file.write(preset)
+        self._keys = 0  # Held during the current tick
+        self._mouse = [0.0, 0.0]  # Moved since the last tick
+        self._edits: List[Edit] = []  # Made since the last tick
+
+    def __getattr__(self, name):
+        # Everything else, like capturing the mouse, is up to the controls.
+        return getattr(self.controls, name)
+
+    def tick(self) -> None:
+        self.controls.tick()
+        self._keys = sum(bit for key, bit in KEY_BITS.items()
+                         if self.controls.key_pressed(key))
+        write_tick(self._file, Tick(self._keys, tuple(self._mouse),
+                                    self._edits))
+        self._mouse = [0.0, 0.0]
+        self._edits = []
+
+    def key_pressed(self, key: ActionKey) -> bool:
+        return bool(self._keys & KEY_BITS[key])
+
+    def get_mouse_change(self):
+        dx, dy = self.controls.get_mouse_change()
+        self._mouse[0] += dx
+        self._mouse[1] += dy
+        return dx, dy
+
+    def record_changes(self, palette: voxel.Palette, positions: np.ndarray,
+                       type_ids: np.ndarray) -> None:
+        """Record that the blocks at `positions` now hold the numbers
+        `type_ids` of `palette`, which replays apply before the next tick.
+        Add it to the `listeners` of the world's `editing.EditJournal`.
+        """
+        used, values = np.unique(type_ids, return_inverse=True)
+        voxel_types = [palette[i] for i in used.tolist() if i]
+        if len(used) and used[0]:  # No air, so every index is one too low
+            values = values + 1
+        self._edits.append(Edit(np.array(positions), values.reshape(-1),
+                                voxel_types))
+
+    def close(self) -> None:
+        """Finish the log."""
+        self._file.close()
+
+
+class ReplayControls(Controls):
+    """Plays back the input of one recorded tick at a time, see
+    `next_tick()`.
+    """
+    def __init__(self):
+        self._tick = Tick(0, (0.0, 0.0), [])
+        self._mouse = (0.0, 0.0)
+
+    def next_tick(self, tick: Tick) -> None:
+        """Play back `tick` next."""
+        self._tick = tick
+        self._mouse = tick.mouse
+
+    def key_pressed(self, key: ActionKey) -> bool:
+        return bool(self._tick.keys & KEY_BITS[key])
+
+    def get_mouse_change(self):
+        # The movement of a tick is only seen once.
+        change, self._mouse = self._mouse, (0.0, 0.0)
+        return change
+
+
+def write_tick(outfile: BinaryIO, tick: Tick) -> None:
+    """Append a tick to a log."""
+    parts = [TICK.pack(tick.keys, *tick.mouse, len(tick.edits))]
+    for edit in tick.edits:
+        voxel_types = json.dumps(edit.voxel_types).encode('utf-8')
+        changes = np.empty(len(edit.positions), dtype=CHANGE)
+        changes['position'] = edit.positions
+        changes['value'] = edit.values
+        parts.append(EDIT.pack(len(changes), len(voxel_types)))
+        parts.append(voxel_types)
+        parts.append(changes.tobytes())
+    outfile.write(b''.join(parts))
+
+
+def read_log(path: str) -> Tuple[int, str, Iterator[Tick]]:
+    """Return the tick rate of the log at `path`, the lighting preset its
+    session started with and its ticks. A tick cut short, say by a crash
+    while it was written, ends the log.
+    """
+    with open(path, 'rb') as infile:
+        data = infile.read()
+    if len(data) < HEADER.size:
+        raise ValueError('{} is not an input log'.format(path))
+    magic, version, tick_rate, preset_length = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError('{} is not an input log'.format(path))
+    if version != VERSION:
+        raise ValueError('Unsupported input log version {}'.format(version))
+    start = HEADER.size + preset_length
+    preset = data[HEADER.size:start].decode('utf-8')
+
+    def ticks() -> Iterator[Tick]:
+        offset = start
+        while offset + TICK.size <= len(data):
+            keys, dx, dy, count = TICK.unpack_from(data, offset)
+            offset += TICK.size
+            edits = []
+            for _ in range(count):
+                if offset + EDIT.size > len(data):
+                    return
+                blocks, length = EDIT.unpack_from(data, offset)
+                offset += EDIT.size
+                end = offset + length + blocks * CHANGE.itemsize
+                if end > len(data):
+                    return
+                voxel_types = json.loads(
+                    data[offset:offset + length].decode('utf-8'))
+                changes = np.frombuffer(data, dtype=CHANGE, count=blocks,
+                                        offset=offset + length)
+                edits.append(Edit(changes['position'].astype(np.int64),
+                                  changes['value'], voxel_types))
+                offset = end
+            yield Tick(keys, (dx, dy), edits)
+    return tick_rate, preset, ticks()
+
+
+def save_start(world_path: str, log_path: str) -> None:
+    """Keep a copy of the world a recorded session starts from next to its
+    log, with the journal of edits that goes with it.
+    """
+    for suffix in ('', world_format.JOURNAL_SUFFIX):
+        copy = log_path + WORLD_SUFFIX + suffix
+        if os.path.exists(world_path + suffix):
+            shutil.copyfile(world_path + suffix, copy)
+        elif os.path.exists(copy):
+            os.remove(copy)  # Left over from an older recording
+
+
+def replay(path: str, stats_dump: profiling.StatsDump=None
+           ) -> Tuple['main.RoomEditor', np.ndarray]:
+    """Play the session logged at `path` back in a `main.RoomEditor`
+    without a window, one tick per update and as fast as possible. Returns
+    the editor and how many seconds each tick took. The `stats_dump`, if
+    any, is updated after every tick.
+
+    The editor starts from the world saved next to the log by
+    `save_start()`, or the generated one if there was no world file, and
+    meshes it the way the session's lighting preset did.
+    """
+    from main import RoomEditor  # Which imports this module
+
+    tick_rate, preset, ticks = read_log(path)
+    preset = lighting.PRESETS[preset]
+    controls = ReplayControls()
+    editor = RoomEditor(filepath=path + WORLD_SUFFIX, controls=controls,
+                        ambient_occlusion=preset.ambient_occlusion,
+                        light_levels=preset.light_levels)
+    editor.clock = simulation.FixedClock(tick_rate)
+    step = editor.clock.step
+    seconds = []
+    for tick in ticks:
+        controls.next_tick(tick)
+        start = time.perf_counter()
+        for edit in tick.edits:
+            lookup = np.array([0] + [editor.palette.id_of(t)
+                                     for t in edit.voxel_types],
+                              dtype=voxel.TYPE_DTYPE)
+            editor.journal.apply(edit.positions, lookup[edit.values])
+        editor.update(step)
+        seconds.append(time.perf_counter() - start)
+        if stats_dump is not None:
+            stats_dump.update()
+    if stats_dump is not None:
+        stats_dump.write()
+    return editor, np.array(seconds)
+
+
+def summarize(seconds: np.ndarray) -> dict:
+    """Describe the tick times returned by `replay()` in plain numbers."""
+    if not len(seconds):
+        return {'ticks': 0}
+    return {
+        'ticks': len(seconds),
+        'total_seconds': float(seconds.sum()),
+        'mean_seconds': float(seconds.mean()),
+        'median_seconds': float(np.median(seconds)),
+        'p95_seconds': float(np.percentile(seconds, 95)),
+        'p99_seconds': float(np.percentile(seconds, 99)),
+        'max_seconds': float(seconds.max()),
+    }
+
+
+def main(args: Optional[List[str]]=None):
+    """Replay a recorded session and print or save its tick times as JSON.
+    """
+    parser = argparse.ArgumentParser(description=main.__doc__.splitlines()[0])
+    parser.add_argument('log', help='the input log to replay')
+    parser.add_argument('--output', help='write the JSON results here')
+    parser.add_argument('--ticks', action='store_true',
+                        help='include the time of every tick')
+    parser.add_argument('--profile', metavar='PATH',
+                        help='write hot path timings to a .csv or JSON '
+                             'lines file every few seconds')
+    args = parser.parse_args(args)
+
+    from panda3d.core import loadPrcFileData
+    loadPrcFileData('', 'window-type none\naudio-library-name null')
+    from direct.showbase.ShowBase import ShowBase
+    ShowBase()
+
+    stats_dump = None
+    if args.profile:
+        stats_dump = profiling.StatsDump(args.profile)
+    editor, seconds = replay(args.log, stats_dump)
+    editor.scheduler.shutdown()
+    result = summarize(seconds)
+    if args.ticks:
+        result['tick_seconds'] = seconds.tolist()
+    text = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            outfile.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
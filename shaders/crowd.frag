@@ -0,0 +1,42 @@
+#version 150
+// Lights the members of a crowd with ambient light and diffuse light from
+// the first few lights, without shadows, then fogs them like the voxels.
+
+const int LIGHTS = 4;
+
+uniform vec4 body_color;
+
+uniform struct p3d_LightModelParameters {
+    vec4 ambient;
+} p3d_LightModel;
+
+uniform struct p3d_LightSourceParameters {
+    vec4 color;
+    vec4 position;  // In view space, w is 0 for directional lights
+} p3d_LightSource[LIGHTS];
+
+uniform struct p3d_FogParameters {
+    vec4 color;
+    float density;
+} p3d_Fog;
+
+in vec3 view_position;
+in vec3 view_normal;
+
+out vec4 p3d_FragColor;
+
+void main() {
+    vec3 light = p3d_LightModel.ambient.rgb;
+    for (int i = 0; i < LIGHTS; ++i) {
+        vec4 source = p3d_LightSource[i].position;
+        vec3 direction = source.xyz - view_position * source.w;
+        if (dot(direction, direction) > 0.0) {
+            light += p3d_LightSource[i].color.rgb *
+                max(dot(normalize(view_normal), normalize(direction)), 0.0);
+        }
+    }
+    vec4 color = vec4(body_color.rgb * light, body_color.a);
+    float fog = exp(-p3d_Fog.density * length(view_position));
+    color.rgb = mix(p3d_Fog.color.rgb, color.rgb, clamp(fog, 0.0, 1.0));
+    p3d_FragColor = color;
+}
@@ -0,0 +1,28 @@
+#version 150
+// Draws every member of a crowd.Crowd as one instance of a shared unit box,
+// stood on the member's feet and turned to face where it is heading.
+
+uniform mat4 p3d_ModelViewProjectionMatrix;
+uniform mat4 p3d_ModelViewMatrix;
+uniform mat3 p3d_NormalMatrix;
+
+uniform vec3 body_size;  // Depth, width and height of the box
+
+in vec4 p3d_Vertex;  // A corner of the unit box around the origin
+in vec3 p3d_Normal;
+in vec4 offset;  // Where the feet are, and the heading in radians from +x
+
+out vec3 view_position;
+out vec3 view_normal;
+
+void main() {
+    mat2 turn = mat2(cos(offset.w), sin(offset.w),
+                     -sin(offset.w), cos(offset.w));
+    vec3 local = (p3d_Vertex.xyz + vec3(0.0, 0.0, 0.5)) * body_size;
+    vec4 vertex = vec4(vec3(turn * local.xy, local.z) + offset.xyz, 1.0);
+    vec3 normal = vec3(turn * p3d_Normal.xy, p3d_Normal.z);
+
+    view_position = (p3d_ModelViewMatrix * vertex).xyz;
+    view_normal = normalize(p3d_NormalMatrix * normal);
+    gl_Position = p3d_ModelViewProjectionMatrix * vertex;
+}
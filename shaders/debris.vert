@@ -0,0 +1,39 @@
+#version 150
+// Draws every prop of a debris.Debris as one instance of a shared unit box,
+// turned and placed like its rigid body, and textured like the voxel it
+// came from. The lighting is voxel.frag's, unshaded.
+
+uniform mat4 p3d_ModelViewProjectionMatrix;
+uniform mat4 p3d_ModelViewMatrix;
+uniform mat3 p3d_NormalMatrix;
+
+in vec4 p3d_Vertex;  // A corner of the unit box around the origin
+in vec3 p3d_Normal;
+in vec2 p3d_MultiTexCoord0;
+in vec4 offset;  // The center of the prop
+in vec4 rotation;  // A quaternion, with the real part in w
+in vec3 layers_a;  // The texture layers of faces 0-2
+in vec3 layers_b;  // The texture layers of faces 3-5
+
+out vec3 texcoord;
+out vec3 view_position;
+out vec3 view_normal;
+out vec2 baked;
+
+vec3 rotate(vec3 v) {
+    return v + 2.0 * cross(rotation.xyz, cross(rotation.xyz, v) +
+                                         rotation.w * v);
+}
+
+void main() {
+    // The box has four vertices per face, in face order.
+    int face = gl_VertexID / 4;
+    float layer = face < 3 ? layers_a[face] : layers_b[face - 3];
+    texcoord = vec3(p3d_MultiTexCoord0, layer);
+    baked = vec2(1.0, 1.0);
+
+    vec4 vertex = vec4(rotate(p3d_Vertex.xyz) + offset.xyz, 1.0);
+    view_position = (p3d_ModelViewMatrix * vertex).xyz;
+    view_normal = normalize(p3d_NormalMatrix * rotate(p3d_Normal));
+    gl_Position = p3d_ModelViewProjectionMatrix * vertex;
+}
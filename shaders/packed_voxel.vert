@@ -0,0 +1,49 @@
+#version 150
+// Unpacks the faces written by voxel.pack_quads. Every face is one instance
+// of a unit quad, so the vertex data is a pair of uint32s per face.
+
+uniform mat4 p3d_ModelViewProjectionMatrix;
+uniform mat4 p3d_ModelViewMatrix;
+uniform mat3 p3d_NormalMatrix;
+
+// One entry per face, numbered like voxel.UNIT_VECTORS
+uniform vec3 face_origin[6];
+uniform vec3 face_u[6];
+uniform vec3 face_v[6];
+uniform vec3 face_normal[6];
+uniform float face_flip[6];
+
+in vec4 p3d_Vertex;  // A corner of the unit quad in x and y
+in uint face;
+in uint shades;  // 6 bits per corner, see voxel.face_shades
+
+out vec3 texcoord;
+out vec3 view_position;
+out vec3 view_normal;
+out vec2 baked;
+
+void main() {
+    uint index = (face >> 12u) & 7u;
+    if (index > 5u) {
+        // Hidden faces collapse into a point and are never rasterized.
+        gl_Position = vec4(0.0);
+        texcoord = vec3(0.0);
+        view_position = vec3(0.0);
+        view_normal = vec3(0.0);
+        baked = vec2(0.0);
+        return;
+    }
+    vec3 position = vec3(face & 15u, (face >> 4u) & 15u, (face >> 8u) & 15u);
+    vec2 size = vec2((face >> 15u) & 15u, (face >> 19u) & 15u) + 1.0;
+    vec2 corner = face_flip[index] > 0.5 ? p3d_Vertex.yx : p3d_Vertex.xy;
+    vec3 vertex = position + face_origin[index]
+        + corner.x * size.x * face_u[index]
+        + corner.y * size.y * face_v[index];
+
+    texcoord = vec3(corner * size, float(face >> 23u));
+    uint bits = shades >> (6u * (uint(corner.x) + 2u * uint(corner.y)));
+    baked = vec2(float(bits & 3u) / 3.0, float((bits >> 2u) & 15u) / 15.0);
+    view_position = (p3d_ModelViewMatrix * vec4(vertex, 1.0)).xyz;
+    view_normal = normalize(p3d_NormalMatrix * face_normal[index]);
+    gl_Position = p3d_ModelViewProjectionMatrix * vec4(vertex, 1.0);
+}
@@ -0,0 +1,58 @@
+#version 150
+// Lights voxel faces roughly like the shader generator would: ambient light
+// darkened by the baked ambient occlusion, plus diffuse light from the first
+// few lights, shadowed by those that cast shadows. Everything is scaled by
+// the baked light level, then fogged.
+
+const int LIGHTS = 4;
+const float OCCLUDED = 0.35;  // Ambient light reaching the darkest corners
+const float FALLOFF = 0.8;  // Brightness kept by each step down in level
+const float SHADOW_OFFSET = 0.05;  // Along the normal, against shadow acne
+
+uniform sampler2DArray p3d_Texture0;
+
+uniform struct p3d_LightModelParameters {
+    vec4 ambient;
+} p3d_LightModel;
+
+// Lights that cast no shadows get a shadow map that never shadows.
+uniform struct p3d_LightSourceParameters {
+    vec4 color;
+    vec4 position;  // In view space, w is 0 for directional lights
+    sampler2DShadow shadowMap;
+    mat4 shadowViewMatrix;
+} p3d_LightSource[LIGHTS];
+
+uniform struct p3d_FogParameters {
+    vec4 color;
+    float density;
+} p3d_Fog;
+
+in vec3 texcoord;
+in vec3 view_position;
+in vec3 view_normal;
+in vec2 baked;  // Ambient occlusion and light level, both from 0 to 1
+
+out vec4 p3d_FragColor;
+
+void main() {
+    vec4 color = texture(p3d_Texture0, texcoord);
+    vec3 light = p3d_LightModel.ambient.rgb * mix(OCCLUDED, 1.0, baked.x);
+    vec4 offset = vec4(view_position + view_normal * SHADOW_OFFSET, 1.0);
+    for (int i = 0; i < LIGHTS; ++i) {
+        vec4 source = p3d_LightSource[i].position;
+        vec3 direction = source.xyz - view_position * source.w;
+        if (dot(direction, direction) > 0.0) {
+            float lambert = max(dot(view_normal, normalize(direction)), 0.0);
+            vec4 shadow = p3d_LightSource[i].shadowViewMatrix * offset;
+            if (lambert > 0.0 && shadow.w > 0.0) {
+                lambert *= textureProj(p3d_LightSource[i].shadowMap, shadow);
+            }
+            light += p3d_LightSource[i].color.rgb * lambert;
+        }
+    }
+    color.rgb *= light * pow(FALLOFF, 15.0 * (1.0 - baked.y));
+    float fog = exp(-p3d_Fog.density * length(view_position));
+    color.rgb = mix(p3d_Fog.color.rgb, color.rgb, clamp(fog, 0.0, 1.0));
+    p3d_FragColor = color;
+}
@@ -0,0 +1,26 @@
+#version 150
+// Passes full chunk vertices through to voxel.frag. The third texcoord is
+// the layer of the block texture array, and the shade holds the baked
+// ambient occlusion and light level.
+
+uniform mat4 p3d_ModelViewProjectionMatrix;
+uniform mat4 p3d_ModelViewMatrix;
+uniform mat3 p3d_NormalMatrix;
+
+in vec4 p3d_Vertex;
+in vec3 p3d_Normal;
+in vec3 p3d_MultiTexCoord0;
+in vec2 shade;
+
+out vec3 texcoord;
+out vec3 view_position;
+out vec3 view_normal;
+out vec2 baked;
+
+void main() {
+    texcoord = p3d_MultiTexCoord0;
+    baked = shade;
+    view_position = (p3d_ModelViewMatrix * p3d_Vertex).xyz;
+    view_normal = normalize(p3d_NormalMatrix * p3d_Normal);
+    gl_Position = p3d_ModelViewProjectionMatrix * p3d_Vertex;
+}
@@ -0,0 +1,93 @@
+# coding=utf-8
+"""Step the simulation at a fixed rate, however fast frames are drawn.
+
+Physics and characters advance in ticks of exactly 1 / TICK_RATE seconds.
+A slow frame, say one spent compiling shaders, runs a few ticks to catch up
+rather than one huge step that lets bodies tunnel through walls, and a fast
+machine does not spend its time on tiny steps: the simulation costs the same
+per second at any frame rate. Frames draw the moving nodes between their
+last two ticks, see `Interpolator`.
+"""
+from typing import List
+
+from panda3d.core import NodePath
+
+TICK_RATE = 60  # Simulation steps per second
+MAX_TICKS = 5  # Ticks a frame runs at most; time beyond them is dropped
+PHYSICS_SUBSTEPS = 2  # Bullet steps per tick
+
+
+class FixedClock:
+    """Turns frame times into a whole number of fixed ticks."""
+    def __init__(self, tick_rate: int=TICK_RATE, max_ticks: int=MAX_TICKS):
+        self.step = 1.0 / tick_rate
+        self.max_ticks = max_ticks
+        self.ticks = 0  # Ticks run so far
+        self.dropped = 0.0  # Seconds given up on to keep frames bounded
+        self._accumulator = 0.0  # Frame time not simulated yet
+
+    @property
+    def alpha(self) -> float:
+        """How far the current frame is from the last tick to the next one,
+        from 0 to 1.
+        """
+        return min(self._accumulator / self.step, 1.0)
+
+    def advance(self, dt: float) -> int:
+        """Add a frame lasting `dt` seconds, and return how many ticks to
+        run for it.
+        """
+        self._accumulator += max(dt, 0.0)
+        # Leave some room for rounding, so frames of exactly one step always
+        # run a tick.
+        ticks = int(self._accumulator / self.step + 1e-6)
+        if ticks > self.max_ticks:
+            self.dropped += (ticks - self.max_ticks) * self.step
+            ticks = self.max_ticks
+            self._accumulator = ticks * self.step
+        self._accumulator = max(self._accumulator - ticks * self.step, 0.0)
+        self.ticks += ticks
+        return ticks
+
+
+class Interpolator:
+    """Draws nodes moved by the simulation between their last two ticks.
+
+    Each simulated node is followed by a stand-in sharing its parent, which
+    is what the camera and models hang off. Call `snapshot()` before every
+    tick and `update()` once per frame.
+    """
+    def __init__(self):
+        self._nodes: List[List] = []  # Simulated node, stand-in, last pose
+
+    def add(self, node_path: NodePath, name: str=None) -> NodePath:
+        """Return a stand-in that follows `node_path` smoothly."""
+        follower = node_path.getParent().attachNewNode(
+            name or node_path.getName() + ' view')
+        follower.setPosQuat(node_path.getPos(), node_path.getQuat())
+        self._nodes.append([node_path, follower, node_path.getPos(),
+                            node_path.getQuat()])
+        return follower
+
+    def remove(self, follower: NodePath) -> None:
+        """Stop moving a stand-in returned by `add()`."""
+        self._nodes = [entry for entry in self._nodes
+                       if entry[1] != follower]
+
+    def snapshot(self) -> None:
+        """Remember where every simulated node is before a tick."""
+        for entry in self._nodes:
+            entry[2], entry[3] = entry[0].getPos(), entry[0].getQuat()
+
+    def update(self, alpha: float) -> None:
+        """Move the stand-ins `alpha` of the way from where their nodes were
+        before the last tick to where they are now.
+        """
+        for node_path, follower, position, quat in self._nodes:
+            follower.setPos(position + (node_path.getPos() - position) * alpha)
+            current = node_path.getQuat()
+            if quat.dot(current) < 0:
+                current = -current  # The same rotation, the short way round
+            rotation = quat * (1.0 - alpha) + current * alpha
+            rotation.normalize()
+            follower.setQuat(rotation)
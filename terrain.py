@@ -0,0 +1,264 @@
+# coding=utf-8
+"""Generate voxel worlds a chunk at a time and stream them around a player.
+
+A generator turns a chunk key into a whole chunk of voxels at once, as a
+NumPy array where 0 is air and any other number is one more than an index
+into the generator's `voxel_types`. Generators must be deterministic, so a
+chunk that is unloaded and generated again comes back the same.
+"""
+from concurrent.futures import Executor
+from itertools import repeat
+from typing import Dict, Iterator, List, Sequence, Set, Tuple
+
+import numpy as np
+
+import voxel
+from voxel import CHUNK_SIZE, Key
+
+LOAD_RADIUS = 4  # Chunks generated around the player horizontally
+LOAD_HEIGHT = 2  # Chunks generated above and below the player
+CHUNKS_PER_UPDATE = 4  # Chunks generated per frame while streaming
+GENERATE_BATCH = 16  # Chunks generated per job by worker processes
+
+
+def lattice_values(seed: int, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """Return a repeatable random number in [0, 1) for every pair of integer
+    coordinates, by hashing them with the SplitMix64 finalizer.
+    """
+    x = np.ascontiguousarray(x, dtype=np.int64).view(np.uint64)
+    y = np.ascontiguousarray(y, dtype=np.int64).view(np.uint64)
+    h = x * np.uint64(0x9E3779B97F4A7C15) + y * np.uint64(0xC2B2AE3D27D4EB4F)
+    h += np.uint64(seed & 0xFFFFFFFFFFFFFFFF) * np.uint64(0x165667B19E3779F9)
+    h ^= h >> np.uint64(30)
+    h *= np.uint64(0xBF58476D1CE4E5B9)
+    h ^= h >> np.uint64(27)
+    h *= np.uint64(0x94D049BB133111EB)
+    h ^= h >> np.uint64(31)
+    return (h >> np.uint64(11)).astype(np.float64) / float(1 << 53)
+
+
+def value_noise(seed: int, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """Smoothly interpolate `lattice_values` between integer coordinates."""
+    x0, y0 = np.floor(x), np.floor(y)
+    fx, fy = x - x0, y - y0
+    fx, fy = fx * fx * (3 - 2 * fx), fy * fy * (3 - 2 * fy)
+    ix, iy = x0.astype(np.int64), y0.astype(np.int64)
+    bottom = (lattice_values(seed, ix, iy) * (1 - fx) +
+              lattice_values(seed, ix + 1, iy) * fx)
+    top = (lattice_values(seed, ix, iy + 1) * (1 - fx) +
+           lattice_values(seed, ix + 1, iy + 1) * fx)
+    return bottom * (1 - fy) + top * fy
+
+
+def chunk_grid(key: Key) -> np.ndarray:
+    """Return the world x, y and z of every cell of the chunk at `key`,
+    stacked along the first axis.
+    """
+    return np.indices((CHUNK_SIZE,) * 3) + \
+        (np.array(key) * CHUNK_SIZE).reshape(3, 1, 1, 1)
+
+
+class TerrainGenerator:
+    """Fills whole chunks. Subclasses implement `generate()`."""
+    voxel_types: Sequence = (None,)
+
+    def generate(self, key: Key) -> np.ndarray:
+        """Return the voxels of the chunk at `key` as a CHUNK_SIZE³ array."""
+        raise NotImplementedError
+
+
+class RoomGenerator(TerrainGenerator):
+    """The editor's default room: a walled box with a floor, a ceiling and
+    one floating block above every floor block. Lamps are set into the
+    floor, the ceiling and the walls on a grid `lamp_spacing` blocks wide,
+    or nowhere if it is 0.
+    """
+    def __init__(self, voxel_type=None, half_width: int=10, seed: int=0,
+                 lamp_spacing: int=5):
+        self.voxel_types = (voxel_type, 'lamp')
+        self.half_width = half_width
+        self.seed = seed
+        self.lamp_spacing = lamp_spacing
+
+    def generate(self, key: Key) -> np.ndarray:
+        n = self.half_width
+        x, y, z = chunk_grid(key)
+        inside = (abs(x) <= n) & (abs(z) <= n)
+        floor = (y == -n) | (y == n + 1)
+        walls = ((abs(x) == n) | (abs(z) == n)) & (abs(y) <= n)
+        heights = np.floor(lattice_values(self.seed, x[:, 0], z[:, 0]) *
+                           (2 * n + 2)).astype(np.int64) - n
+        floating = y == heights[:, None, :]
+        types = (inside & (floor | walls | floating)).astype(voxel.TYPE_DTYPE)
+        if self.lamp_spacing:
+            s = self.lamp_spacing
+            lamps = (floor & (x % s == 0) & (z % s == 0)) | \
+                ((abs(x) == n) & (y % s == 0) & (z % s == 0)) | \
+                ((abs(z) == n) & (x % s == 0) & (y % s == 0))
+            types[(types == 1) & lamps] = 2
+        return types
+
+
+class HeightmapGenerator(TerrainGenerator):
+    """Rolling hills of grass over dirt over stone, from fractal value noise.
+    Heights run along z, matching the physics.
+    """
+    voxel_types = ('grass', 'dirt', 'stone')
+
+    def __init__(self, seed: int=0, base_height: int=-4,
+                 amplitude: float=16.0, scale: float=48.0, octaves: int=4,
+                 dirt_depth: int=3):
+        self.seed = seed
+        self.base_height = base_height
+        self.amplitude = amplitude
+        self.scale = scale
+        self.octaves = octaves
+        self.dirt_depth = dirt_depth
+
+    def heights(self, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+        """Return the height of the surface above each x and y."""
+        total = np.zeros(np.shape(x))
+        frequency, weight = 1.0 / self.scale, 1.0
+        for octave in range(self.octaves):
+            total += weight * value_noise(self.seed + octave,
+                                          x * frequency, y * frequency)
+            frequency, weight = frequency * 2, weight / 2
+        normalized = total / (2 - 2 ** (1 - self.octaves))  # Back to [0, 1)
+        return self.base_height + self.amplitude * normalized
+
+    def generate(self, key: Key) -> np.ndarray:
+        x, y, z = chunk_grid(key)
+        surface = np.floor(self.heights(x[:, :, 0], y[:, :, 0]))
+        depth = surface[:, :, None] - z  # 0 for the top voxel of a column
+        types = np.zeros(depth.shape, dtype=voxel.TYPE_DTYPE)
+        types[depth >= 0] = 3
+        types[(depth >= 0) & (depth < self.dirt_depth)] = 2
+        types[depth == 0] = 1
+        return types
+
+
+def _generate_batch(generator: TerrainGenerator, keys: List[Key]) -> bytes:
+    """Generate chunks in a worker process, packed into one buffer so that
+    they cross back to the main process in a single piece.
+    """
+    return b''.join(generator.generate(key).astype(voxel.TYPE_DTYPE).tobytes()
+                    for key in keys)
+
+
+def generate_chunks(generator: TerrainGenerator, keys: List[Key],
+                    executor: Executor=None) -> Iterator[Tuple[Key, np.ndarray]]:
+    """Yield the generated voxels of each key in order. With an executor,
+    batches of chunks are generated in parallel and their buffers are
+    viewed as arrays without copying them again.
+    """
+    if executor is None:
+        for key in keys:
+            yield key, generator.generate(key)
+        return
+    batches = [keys[i:i + GENERATE_BATCH]
+               for i in range(0, len(keys), GENERATE_BATCH)]
+    buffers = executor.map(_generate_batch, repeat(generator), batches)
+    for batch, buffer in zip(batches, buffers):
+        arrays = np.frombuffer(buffer, dtype=voxel.TYPE_DTYPE)
+        yield from zip(batch, arrays.reshape((-1,) + (CHUNK_SIZE,) * 3))
+
+
+class ChunkStreamer:
+    """Keeps the chunks around a moving position generated and unloads the
+    ones left behind, so memory and draw calls stay bounded.
+
+    Chunks that were edited are remembered when they are unloaded and come
+    back with the edits when the player returns.
+    """
+    def __init__(self, world: voxel.VoxelWorld, generator: TerrainGenerator,
+                 radius: int=LOAD_RADIUS, height: int=LOAD_HEIGHT,
+                 per_update: int=CHUNKS_PER_UPDATE):
+        self.world = world
+        self.generator = generator
+        self.radius = radius
+        self.height = height
+        self.per_update = per_update
+        self._loaded: Set[Key] = set()  # Including chunks that are all air
+        self._edits: Dict[Key, np.ndarray] = {}  # By palette number
+        # Offsets of the chunks to keep, nearest first.
+        self._offsets: List[Key] = sorted(
+            ((dx, dy, dz)
+             for dx in range(-radius, radius + 1)
+             for dy in range(-radius, radius + 1)
+             for dz in range(-height, height + 1)
+             if dx * dx + dy * dy <= radius * radius),
+            key=lambda o: o[0] * o[0] + o[1] * o[1] + o[2] * o[2])
+
+    def __contains__(self, key: Key):
+        return key in self._loaded
+
+    @property
+    def held(self) -> Dict[Key, np.ndarray]:
+        """The edited chunks that are unloaded, by key, as arrays of palette
+        numbers. They have to be saved along with the world's chunks.
+        """
+        return self._edits
+
+    def hold(self, key: Key, types: np.ndarray) -> None:
+        """Load the palette numbers `types` at `key` instead of generating
+        the chunk there, say to restore it from a saved world.
+        """
+        if key in self._loaded:
+            self.world.set_chunk(key, types, list(self.world.palette))
+        else:
+            self._edits[key] = types
+
+    def update(self, position, everything: bool=False,
+               executor: Executor=None) -> None:
+        """Unload chunks that are out of range of `position` and generate
+        the nearest missing ones, a few per call unless `everything` is set.
+        An executor, usually a process pool, spreads out the generation.
+        """
+        cx, cy, cz = voxel.chunk_key(position)
+        # Unload a chunk further out than it is loaded, so that walking
+        # back and forth over a chunk border does not thrash.
+        reach = self.radius + 1
+        for key in list(self._loaded):
+            dx, dy, dz = key[0] - cx, key[1] - cy, key[2] - cz
+            if dx * dx + dy * dy > reach * reach or abs(dz) > self.height + 1:
+                self.unload(key)
+
+        missing = [key for key in ((cx + dx, cy + dy, cz + dz)
+                                   for dx, dy, dz in self._offsets)
+                   if key not in self._loaded]
+        if not everything:
+            missing = missing[:self.per_update]
+        fresh = []
+        for key in missing:
+            if key in self._edits:
+                self.load(key)
+            else:
+                fresh.append(key)
+        for key, types in generate_chunks(self.generator, fresh, executor):
+            self._add(key, types)
+
+    def load(self, key: Key) -> None:
+        """Generate the chunk at `key`, or restore its edits."""
+        edited = self._edits.pop(key, None)
+        if edited is not None:
+            self._loaded.add(key)
+            self.world.set_chunk(key, edited, list(self.world.palette))
+        else:
+            self._add(key, self.generator.generate(key))
+
+    def _add(self, key: Key, types: np.ndarray) -> None:
+        self._loaded.add(key)
+        self.world.set_chunk(key, types, self.generator.voxel_types)
+
+    def unload(self, key: Key) -> None:
+        """Drop the chunk at `key`, remembering it if it was edited."""
+        self._loaded.discard(key)
+        chunk = self.world.unload_chunk(key)
+        if chunk is None:
+            return
+        lookup = np.array([0] + [self.world.palette.id_of(t)
+                                 for t in self.generator.voxel_types],
+                          dtype=voxel.TYPE_DTYPE)
+        if not np.array_equal(chunk.types,
+                              lookup[self.generator.generate(key)]):
+            self._edits[key] = chunk.types
@@ -1,18 +1,43 @@
 # coding=utf-8
 """Expose utility classes and functions for handling voxel-based worlds."""
-from typing import Tuple, Dict
+import enum
+import functools
+import math
+from collections import OrderedDict
+from typing import Callable, Tuple, Dict, Iterator, List, Optional, Set, \
+    Sequence
 
+import numpy as np
+from panda3d.core import BoundingBox
 from panda3d.core import Geom
+from panda3d.core import GeomVertexArrayFormat
 from panda3d.core import GeomNode
 from panda3d.core import GeomTriangles
 from panda3d.core import GeomVertexData
 from panda3d.core import GeomVertexFormat
 from panda3d.core import GeomVertexWriter
-from panda3d.core import SamplerState
+from panda3d.core import LVecBase3f
+from panda3d.core import NodePath
+from panda3d.core import Point3
+from panda3d.core import PTA_float
+from panda3d.core import PTA_LVecBase3f
+from panda3d.core import Shader
 from panda3d.core import Vec3D
 
+from blocks import BlockRegistry, default_registry
+from panda_utils import find_file
+import profiling
+
 
 CUBE_SIZE = 1.0
+CHUNK_SIZE = 16  # Voxels along each edge of a chunk
+CHUNK_VOLUME = CHUNK_SIZE ** 3
+COMPACT_THRESHOLD = 0.5  # Fraction of free face slots that forces a compaction
+# Distances in blocks from the camera beyond which chunks are meshed at half,
+# then a quarter of their resolution along each axis.
+LOD_DISTANCES = (48, 96)
+LOD_MARGIN = 8  # How much closer a chunk must come to get its detail back
+MESH_CACHE_BYTES = 64 << 20  # Meshes kept for switching detail levels
 UNIT_VECTORS = [
     (0, 1, 0),
     (0, -1, 0),
@@ -21,6 +46,50 @@ UNIT_VECTORS = [
     (0, 0, 1),
     (0, 0, -1),
 ]
+# Every chunk touching a chunk, including along its edges and corners.
+NEIGHBOR_OFFSETS = tuple((dx, dy, dz) for dx in (-1, 0, 1)
+                         for dy in (-1, 0, 1) for dz in (-1, 0, 1)
+                         if dx or dy or dz)
+FACE_INDICES = (0, 1, 2, 3, 2, 1)  # Two triangles per quad
+# Floats per vertex: position, normal, texcoord u, v and texture layer, and
+# the baked ambient occlusion and light level.
+ROW_FLOATS = 11
+# A packed face that the shader collapses, as face number 7 does not exist.
+HIDDEN_FACE = 0xFFFFFFFF
+MAX_PACKED_LAYERS = 1 << 9
+MAX_LIGHT = 15  # The light level of open air in full daylight
+LIGHT_DTYPE = np.uint8  # Sunlight in the high four bits, block light below
+SKY_LIGHT = MAX_LIGHT << 4  # Full sunlight and no block light, as in open air
+# Bits per corner of a shade: 2 of ambient occlusion, 4 of light level.
+SHADE_BITS = 6
+FULL_SHADE = (1 << 4 * SHADE_BITS) - 1  # Four unoccluded, fully lit corners
+# The instance data of a packed quad that draws nothing.
+# Every face of a chunk sees every other face through it, as through air.
+ALL_CONNECTIONS = (1 << len(UNIT_VECTORS) ** 2) - 1
+HIDDEN_QUAD = np.array([[HIDDEN_FACE, FULL_SHADE]], dtype=np.uint32)
+TYPE_DTYPE = np.uint16  # How chunks store the palette number of each voxel
+_AIR = object()  # Holds palette number 0, which is never a voxel type
+_KEY_RANGE = 1 << 20  # Chunks along each axis that batches of voxels can span
+_KEY_OFFSET = _KEY_RANGE // 2
+
+Key = Tuple[int, int, int]
+
+
+class Mesher(str, enum.Enum):
+    """The ways a world can turn its voxels into triangles."""
+    Naive = 'naive'  # One quad per visible face, edited in place
+    Greedy = 'greedy'  # Coplanar faces merged, chunks rebuilt after edits
+
+
+class RenderMode(str, enum.Enum):
+    """The ways chunks can store and draw their quads."""
+    Vertices = 'vertices'  # Four full vertices and six indices per quad
+    Packed = 'packed'  # 32 bits per quad, unpacked by a GLSL vertex shader
+
+
+def opposite(face: int) -> int:
+    """Return the face pointing the other way, eg. top for bottom."""
+    return face ^ 1
 
 
 def normalize(position: Vec3D) -> Vec3D:
@@ -31,71 +100,715 @@ def normalize(position: Vec3D) -> Vec3D:
     return Vec3D(int(round(x)), int(round(y)), int(round(z)))
 
 
+def voxel_key(position) -> Key:
+    """Return the integer coordinates of the block containing `position`.
+    These are the canonical keys of a `VoxelWorld`.
+    """
+    x, y, z = position
+    return int(round(x)), int(round(y)), int(round(z))
+
+
+def voxel_keys(positions: Sequence) -> np.ndarray:
+    """Return the integer coordinates of the blocks containing each of the
+    `positions`, as an array with a row per position.
+    """
+    positions = np.rint(np.asarray(positions, dtype=np.float64))
+    return positions.astype(np.int64).reshape(-1, 3)
+
+
+def chunk_key(position) -> Key:
+    """Return the coordinates of the chunk containing the block `position`."""
+    x, y, z = voxel_key(position)
+    return x // CHUNK_SIZE, y // CHUNK_SIZE, z // CHUNK_SIZE
+
+
+def cell_index(x: int, y: int, z: int) -> int:
+    """Return where the block at integer world coordinates is stored in the
+    flat arrays of its chunk.
+    """
+    return ((x % CHUNK_SIZE) * CHUNK_SIZE + y % CHUNK_SIZE) * CHUNK_SIZE \
+        + z % CHUNK_SIZE
+
+
 class Voxel:
-    """A container to remember all the memory locations of the graphics data.
+    """A snapshot of a single voxel. Chunks store voxels in arrays, so these
+    records are only made when somebody asks for one.
     """
-    def __init__(self, position, initial_index):
-        # TODO: Is position necessary? Rotation will be someday.
+    __slots__ = ('position', 'voxel_type')
+
+    def __init__(self, position: Key, voxel_type=None):
         self.position = position
-        self.index = initial_index
+        self.voxel_type = voxel_type
 
 
-class VoxelWorld:
-    """A container for many voxels."""
+class Palette:
+    """Numbers the voxel types of a world, so that chunks can store them as
+    small integers. Number 0 is reserved for air.
+    """
     def __init__(self):
+        self._types: List = [_AIR]
+        self._ids: Dict = {}
+
+    def __len__(self):
+        return len(self._types)
+
+    def __iter__(self):
+        """Iterate over the voxel types in the order of their numbers."""
+        return iter(self._types[1:])
+
+    def __getitem__(self, type_id: int):
+        return self._types[type_id]
+
+    def id_of(self, voxel_type) -> int:
+        """Return the number of `voxel_type`, assigning one if necessary."""
+        type_id = self._ids.get(voxel_type)
+        if type_id is None:
+            if len(self._types) > np.iinfo(TYPE_DTYPE).max:
+                raise ValueError('Too many voxel types')
+            type_id = self._ids[voxel_type] = len(self._types)
+            self._types.append(voxel_type)
+        return type_id
+
+
+class ChunkMesh:
+    """The finished buffers of a chunk, built without touching Panda3D so
+    that meshing can happen away from the main thread.
+    """
+    __slots__ = ('version', 'rows', 'indices', 'cells', 'faces',
+                 'connections', 'lod')
+
+    def __init__(self, version: int, rows: np.ndarray, indices: np.ndarray,
+                 cells: np.ndarray=None, faces: np.ndarray=None):
+        self.version = version  # The chunk version this mesh was built from
+        # Vertex rows of ROW_FLOATS floats and uint32 triangle indices, or
+        # a row of two packed uint32s per quad and no indices.
+        self.rows = rows
+        self.indices = indices
+        # The naive mesher also records which face each quad shows, so the
+        # chunk can keep editing it in place.
+        self.cells = cells
+        self.faces = faces
+        # Which faces of the chunk see each other, see `face_connections()`
+        self.connections: Optional[int] = None
+        self.lod = 0  # The level of detail, see `build_mesh()`
+
+    @property
+    def byte_size(self) -> int:
+        """Roughly how much memory the arrays of this mesh take."""
+        return sum(array.nbytes for array in (self.rows, self.indices,
+                                              self.cells, self.faces)
+                   if array is not None)
+
+    @property
+    def quad_count(self) -> int:
+        if self.indices is None:
+            return len(self.rows)
+        return len(self.indices) // len(FACE_INDICES)
+
+
+class MeshCache:
+    """Keeps the meshes chunks were last drawn with at each level of
+    detail, so a chunk switching back to a level needs no meshing as long as
+    it has not changed since. The least recently used meshes are dropped
+    once they take more than `limit` bytes.
+    """
+    def __init__(self, limit: int=MESH_CACHE_BYTES):
+        self.limit = limit
+        self.size = 0
+        self._meshes: OrderedDict = OrderedDict()
+
+    def __len__(self):
+        return len(self._meshes)
+
+    def get(self, chunk: 'Chunk', lod: int) -> Optional[ChunkMesh]:
+        """Return the mesh of `chunk` at level `lod`, if it is still
+        current.
+        """
+        mesh = self._meshes.get((chunk, lod))
+        if mesh is None:
+            return None
+        if mesh.version != chunk.version:
+            self._drop((chunk, lod))
+            return None
+        self._meshes.move_to_end((chunk, lod))
+        return mesh
+
+    def put(self, chunk: 'Chunk', mesh: ChunkMesh) -> None:
+        """Remember a mesh just uploaded to `chunk`."""
+        self._drop((chunk, mesh.lod))
+        self._meshes[chunk, mesh.lod] = mesh
+        self.size += mesh.byte_size
+        while self.size > self.limit:
+            self._drop(next(iter(self._meshes)))
+
+    def discard(self, chunk: 'Chunk') -> None:
+        """Forget every mesh of `chunk`."""
+        for key in [key for key in self._meshes if key[0] is chunk]:
+            self._drop(key)
+
+    def _drop(self, key: Tuple) -> None:
+        mesh = self._meshes.pop(key, None)
+        if mesh is not None:
+            self.size -= mesh.byte_size
+
+
+class Chunk:
+    """A cube of CHUNK_SIZE³ voxels owning its own buffers and GeomNode.
+
+    Voxel types are kept in a flat array indexed by their local coordinates,
+    so lookups never hash a position and edits only ever touch this chunk's
+    vertex data.
+    """
+    render_mode = RenderMode.Vertices
+
+    def __init__(self, key: Key, parent: NodePath,
+                 vertex_format: GeomVertexFormat):
+        self.key = key
+        self.origin = Vec3D(*(k * CHUNK_SIZE for k in key))
+        # Palette numbers indexed by local x, y and z, 0 for air.
+        self.types = np.zeros((CHUNK_SIZE,) * 3, dtype=TYPE_DTYPE)
+        self.cells = self.types.reshape(-1)  # The same numbers by cell index
+        # The light in every cell, see `voxel_light`. A new chunk only holds
+        # air, so it starts out open to the sky.
+        self.light = np.full((CHUNK_SIZE,) * 3, SKY_LIGHT, dtype=LIGHT_DTYPE)
+        self.light_cells = self.light.reshape(-1)
+        self.count = 0
+        # Bumped on every change, so meshes built from an older snapshot of
+        # this chunk can be recognised and thrown away.
+        self.version = 0
+        self.face_count = 0  # Faces currently shown
+        # The level of detail this chunk should be drawn at, and the one of
+        # the mesh in its buffers, see `build_mesh()`.
+        self.lod = 0
+        self.shown_lod = 0
+        # Which faces see each other through air, and the version it is for
+        self._connections = ALL_CONNECTIONS
+        self._connections_version = 0
+        # The slot of each shown face by cell and face, -1 for hidden faces.
+        # Only the naive mesher needs these, so they are made on demand.
+        self.face_slots: Optional[np.ndarray] = None
+        self._slots = 0  # Face slots written to the buffers so far
+        self._free: List[int] = []  # Slots of hidden faces, ready for reuse
+
+        # Panda3D setup
+        self._prepare_buffers(vertex_format)
+        self._prepare_node_path(parent)
+
+    def __iter__(self) -> Iterator[Key]:
+        """Iterate over the world positions of the voxels in this chunk."""
+        ox, oy, oz = (k * CHUNK_SIZE for k in self.key)
+        for x, y, z in np.argwhere(self.types).tolist():
+            yield ox + x, oy + y, oz + z
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def occupied(self) -> np.ndarray:
+        """Which blocks hold a voxel, indexed by local x, y and z."""
+        return self.types != 0
+
+    @property
+    def bounds(self) -> BoundingBox:
+        """The box around every voxel this chunk can hold, relative to the
+        world's node path.
+        """
+        s = CUBE_SIZE / 2.0
+        return BoundingBox(Point3(*(o - s for o in self.origin)),
+                           Point3(*(o + CHUNK_SIZE - s for o in self.origin)))
+
+    @property
+    def connections(self) -> int:
+        """Which faces of this chunk see each other through its air, see
+        `face_connections()`.
+        """
+        if self._connections_version != self.version:
+            self._connections = face_connections(self.types)
+            self._connections_version = self.version
+        return self._connections
+
+    @property
+    def buffer_bytes(self) -> int:
+        """The size of this chunk's vertex and index data."""
+        arrays = [self._vdata.getArray(i)
+                  for i in range(self._vdata.getNumArrays())]
+        arrays.append(self._prim.getVertices())
+        return sum(array.getDataSizeBytes() for array in arrays)
+
+    @property
+    def fragmentation(self) -> float:
+        """The fraction of face slots in the buffers that are unused."""
+        return len(self._free) / self._slots if self._slots else 0.0
+
+    def set_type(self, cell: int, type_id: int) -> None:
+        """Store a palette number at a cell, or 0 to remove its voxel."""
+        self.count += bool(type_id) - bool(self.cells[cell])
+        self.cells[cell] = type_id
+        self.version += 1
+
+    def add_voxels(self, cells: np.ndarray, type_ids: np.ndarray) -> None:
+        """Store palette numbers in each of the given cells that is empty."""
+        empty = self.cells[cells] == 0
+        self.cells[cells[empty]] = type_ids[empty]
+        self.count = int(np.count_nonzero(self.cells))
+        self.version += 1
+
+    def set_cells(self, cells: np.ndarray, type_ids: np.ndarray) -> None:
+        """Store palette numbers in each of the given cells, 0 for air."""
+        self.cells[cells] = type_ids
+        self.count = int(np.count_nonzero(self.cells))
+        self.version += 1
+
+    def set_types(self, types: np.ndarray) -> None:
+        """Replace the palette numbers of every cell at once."""
+        self.types[...] = types
+        self.count = int(np.count_nonzero(self.cells))
+        self.version += 1
+
+    def _prepare_buffers(self, vertex_format: GeomVertexFormat):
+        self._vdata = GeomVertexData('chunk', vertex_format, Geom.UH_dynamic)
+        self._prepare_writers()
+
+    def _prepare_writers(self):
+        self._vertex_w = GeomVertexWriter(self._vdata, 'vertex')
+        self._normal_w = GeomVertexWriter(self._vdata, 'normal')
+        self._texcoord_w = GeomVertexWriter(self._vdata, 'texcoord')
+        self._shade_w = GeomVertexWriter(self._vdata, 'shade')
+
+    def _prepare_node_path(self, parent: NodePath):
+        """Create the node path holding this chunk's geometry."""
+        # Add the indexes to a primitive -> geom -> node -> node path
+        self._prim = GeomTriangles(Geom.UHStatic)
+        # A full chunk needs more rows than 16 bit indices can address.
+        self._prim.setIndexType(Geom.NT_uint32)
+        self.geom = Geom(self._vdata)
+        self.geom.addPrimitive(self._prim)
+        self._node = GeomNode('chunk_{}_{}_{}'.format(*self.key))
+        self._node.addGeom(self.geom)
+        self.node_path = parent.attachNewNode(self._node)
+        self.node_path.setPos(*self.origin)
+
+    def _ensure_face_slots(self) -> np.ndarray:
+        if self.face_slots is None:
+            self.face_slots = np.full((CHUNK_VOLUME, len(UNIT_VECTORS)), -1,
+                                      dtype=np.int32)
+        return self.face_slots
+
+    def show_face(self, cell: int, face: int, layer: float=0.0):
+        """Write the quad for one face of the voxel in `cell` to the buffers,
+        textured with the given layer of the texture array.
+        """
+        face_slots = self._ensure_face_slots()
+        if face_slots[cell, face] >= 0:
+            return
+        slot = self._allocate()
+        face_slots[cell, face] = slot
+        self.face_count += 1
+        self.version += 1
+        # Vertices are relative to the chunk's origin.
+        x, rest = divmod(cell, CHUNK_SIZE * CHUNK_SIZE)
+        self._write_quad(slot, face, (x, *divmod(rest, CHUNK_SIZE)),
+                         layer=layer)
+
+    def set_faces(self, cells: np.ndarray, faces: np.ndarray,
+                  layers: np.ndarray=None) -> None:
+        """Replace the buffers with one quad for each of the given faces of
+        the voxels in `cells`.
+        """
+        self.upload(faces_mesh(cells, faces, layers, None, self.version,
+                               self.render_mode))
+
+    def set_quads(self, faces: np.ndarray, positions: np.ndarray,
+                  sizes: np.ndarray, layers: np.ndarray=None) -> None:
+        """Replace the buffers with quads covering `sizes` voxels from the
+        local blocks `positions`, all written in one go.
+        """
+        self.upload(quads_mesh(faces, positions, sizes, layers, None,
+                               self.version, self.render_mode))
+
+    @profiling.UPLOAD
+    def upload(self, mesh: ChunkMesh) -> None:
+        """Swap a finished mesh into the buffers. This touches Panda3D
+        objects, so it must happen on the main thread.
+        """
+        self._write_buffers(mesh)
+        profiling.VERTICES.add(len(mesh.rows))
+        profiling.UPLOAD_BYTES.add(mesh.rows.nbytes + (
+            mesh.indices.nbytes if mesh.indices is not None else 0))
+        if self.face_slots is not None:
+            self.face_slots.fill(-1)
+        if mesh.cells is not None:
+            self._ensure_face_slots()[mesh.cells, mesh.faces] = \
+                np.arange(len(mesh.cells))
+        self.face_count = self._slots = mesh.quad_count
+        self._free.clear()
+        self.shown_lod = mesh.lod
+        if mesh.connections is not None:
+            self._connections = mesh.connections
+            self._connections_version = mesh.version
+
+    def _write_buffers(self, mesh: ChunkMesh):
+        self._vdata.uncleanSetNumRows(len(mesh.rows))
+        memoryview(self._vdata.modifyArray(0)).cast('B')[:] = \
+            mesh.rows.tobytes()
+        index_array = self._prim.modifyVertices()
+        index_array.uncleanSetNumRows(len(mesh.indices))
+        memoryview(index_array).cast('B')[:] = mesh.indices.tobytes()
+        self._prepare_writers()
+
+    def clear(self) -> None:
+        """Remove every quad from the buffers."""
+        empty = np.zeros((0, 3), dtype=np.int64)
+        self.set_quads(np.zeros(0, dtype=np.int64), empty, empty)
+
+    def _write_quad(self, slot: int, face: int, position: Key,
+                    size: Tuple=(1, 1, 1), layer: float=0.0):
+        rows = slice(face * 4, face * 4 + 4)
+        for w in (self._vertex_w, self._normal_w, self._texcoord_w,
+                  self._shade_w):
+            w.setRow(slot * 4)
+        for v in make_quad_vertices(position, face, size):
+            self._vertex_w.addData3f(*v)
+        for v in make_normals()[rows]:
+            self._normal_w.addData3f(*v)
+        for tex in make_quad_texcoords(face, size):
+            self._texcoord_w.addData3f(*tex, layer)
+        for _ in range(4):
+            self._shade_w.addData2f(1.0, 1.0)  # Edited faces are unshaded
+        self._write_indices(slot, make_face_indices(start=slot * 4))
+        profiling.VERTICES.add(4)
+
+    def hide_face(self, cell: int, face: int):
+        """Collapse the quad for one face of the voxel in `cell` so nothing
+        is drawn.
+        """
+        if self.face_slots is None or self.face_slots[cell, face] < 0:
+            return
+        slot = int(self.face_slots[cell, face])
+        self.face_slots[cell, face] = -1
+        self.face_count -= 1
+        self.version += 1
+        self._erase(slot)
+        self._free.append(slot)
+        if self.fragmentation > COMPACT_THRESHOLD:
+            self.compact()
+
+    def compact(self) -> None:
+        """Rewrite all shown faces next to each other, dropping free slots."""
+        face_slots = self._ensure_face_slots()
+        cells, faces = np.nonzero(face_slots >= 0)
+        # Keep the texture layers already written for each face.
+        self.set_faces(cells, faces, self._layers(face_slots[cells, faces]))
+
+    def _erase(self, slot: int):
+        # Degenerate triangles are discarded before rasterization.
+        self._write_indices(slot, (slot * 4,) * len(FACE_INDICES))
+
+    def _layers(self, slots: np.ndarray) -> np.ndarray:
+        """Read back the texture layers of the quads in `slots`."""
+        rows = np.frombuffer(memoryview(self._vdata.getArray(0)).cast('B'),
+                             dtype=np.float32).reshape(-1, ROW_FLOATS)
+        return rows[slots * 4, 8]  # The third texcoord
+
+    def _allocate(self) -> int:
+        """Return a free face slot, growing the buffers if there is none."""
+        if self._free:
+            return self._free.pop()
+        self._slots += 1
+        return self._slots - 1
+
+    def _write_indices(self, slot: int, indices: Tuple):
+        writer = GeomVertexWriter(self._prim.modifyVertices(), 0)
+        writer.setRow(slot * len(FACE_INDICES))
+        for i in indices:
+            writer.addData1i(i)
+
+
+class PackedChunk(Chunk):
+    """A chunk for `RenderMode.Packed`. Every quad is one instance of a
+    shared unit quad, described by a pair of uint32s from `pack_quads()`
+    that the voxel shader turns back into positions, normals, texcoords and
+    shading.
+    """
+    render_mode = RenderMode.Packed
+
+    def _prepare_buffers(self, vertex_format: GeomVertexFormat):
+        self._vdata = GeomVertexData('chunk', vertex_format, Geom.UH_dynamic)
+        # The corners of the shared quad, in the order of `make_texcoords`
+        corners = np.array(make_texcoords()[:4], dtype=np.float32)
+        corners = np.pad(corners, ((0, 0), (0, 1)))
+        corner_array = self._vdata.modifyArray(0)
+        corner_array.uncleanSetNumRows(len(corners))
+        memoryview(corner_array).cast('B')[:] = corners.tobytes()
+
+    def _prepare_node_path(self, parent: NodePath):
+        super()._prepare_node_path(parent)
+        self._write_indices(0, FACE_INDICES)
+        # The shared quad is tiny, so tell Panda3D what the shader covers.
+        self._node.setFinal(True)
+        self._fit_bounds(everything=True)
+        self._set_faces(HIDDEN_QUAD)
+
+    def _fit_bounds(self, everything: bool=False):
+        """Bound the node by the voxels of this chunk, or by the whole
+        chunk, so Panda3D can cull it as tightly as a chunk of vertices.
+        """
+        s = CUBE_SIZE / 2.0
+        low, high = np.zeros(3), np.full(3, CHUNK_SIZE)
+        if not everything:
+            occupied = np.nonzero(self.types)
+            if len(occupied[0]):
+                low = np.array([axis.min() for axis in occupied])
+                high = np.array([axis.max() + 1 for axis in occupied])
+        self._node.setBounds(BoundingBox(Point3(*(low - s)),
+                                          Point3(*(high - s))))
+
+    def _set_faces(self, packed: np.ndarray):
+        instances = self._vdata.modifyArray(1)
+        instances.uncleanSetNumRows(len(packed))
+        memoryview(instances).cast('B')[:] = packed.tobytes()
+        self.node_path.setInstanceCount(len(packed))
+
+    def _write_buffers(self, mesh: ChunkMesh):
+        if not len(mesh.rows):
+            # An instance count of 0 would turn instancing off instead.
+            self._set_faces(HIDDEN_QUAD)
+        else:
+            self._set_faces(mesh.rows)
+        self._fit_bounds()
+
+    def _write_quad(self, slot: int, face: int, position: Key,
+                    size: Tuple=(1, 1, 1), layer: float=0.0):
+        instances = self._vdata.modifyArray(1)
+        self._fit_bounds(everything=True)  # Until the next full upload
+        if slot >= instances.getNumRows():
+            instances.setNumRows(slot + 1)
+            self.node_path.setInstanceCount(slot + 1)
+        packed = pack_quads(np.array([face]), np.array([position]),
+                            np.array([size]), np.array([layer]))
+        view = memoryview(instances).cast('B').cast('I')
+        view[slot * 2], view[slot * 2 + 1] = (int(v) for v in packed[0])
+        profiling.VERTICES.add(1)
+
+    def _erase(self, slot: int):
+        memoryview(self._vdata.modifyArray(1)).cast('B').cast('I')[
+            slot * 2] = HIDDEN_FACE
+
+    def _layers(self, slots: np.ndarray) -> np.ndarray:
+        packed = np.frombuffer(memoryview(self._vdata.getArray(1)).cast('B'),
+                               dtype=np.uint32).reshape(-1, 2)
+        return (packed[slots, 0] >> 23).astype(np.float32)
+
+
+class VoxelWorld:
+    """A container for many voxels, split into chunks."""
+    def __init__(self, mesher: Mesher=Mesher.Naive,
+                 blocks: BlockRegistry=None,
+                 render_mode: RenderMode=RenderMode.Vertices,
+                 ambient_occlusion: bool=False):
         # State setup
-        self._voxels: Dict[Vec3D, Voxel] = {}
+        self.mesher = mesher
+        self.render_mode = render_mode
+        # Darken the corners of faces next to other voxels while meshing.
+        self.ambient_occlusion = ambient_occlusion
+        # Keeps the light levels of the chunks current, see `voxel_light`.
+        self.light_engine = None
+        self.blocks = blocks or default_registry()
+        self.palette = Palette()
+        self._face_layers = np.zeros((0, len(UNIT_VECTORS)), dtype=np.float32)
+        self._chunks: Dict[Key, Chunk] = {}
+        self.mesh_cache = MeshCache()
+        self._dirty: Set[Chunk] = set()  # Chunks waiting to be meshed
 
         # Panda3D setup
         self._prepare_format()
         self._prepare_node_path()
         self._prepare_texture()
 
-    def __iter__(self):
-        return iter(self._voxels)
+    def __iter__(self) -> Iterator[Key]:
+        for chunk in self._chunks.values():
+            yield from chunk
+
+    def __len__(self):
+        return sum(len(chunk) for chunk in self._chunks.values())
+
+    def __contains__(self, position):
+        return self.is_solid(*voxel_key(position))
+
+    def __setitem__(self, position, voxel: Voxel):
+        key = voxel_key(position)
+        self.get_chunk(key, create=True).set_type(
+            cell_index(*key), self.palette.id_of(voxel.voxel_type))
+
+    def __getitem__(self, position) -> Voxel:
+        key = voxel_key(position)
+        chunk, cell = self._locate(key)
+        type_id = chunk.cells[cell] if chunk is not None else 0
+        if not type_id:
+            raise KeyError(position)
+        return Voxel(key, self.palette[type_id])
+
+    @property
+    def chunks(self) -> Iterator[Chunk]:
+        """All chunks that have been created so far."""
+        return iter(self._chunks.values())
+
+    @property
+    def face_layers(self) -> np.ndarray:
+        """The texture layer of each face of each voxel type, indexed by
+        palette number and face.
+        """
+        if len(self._face_layers) != len(self.palette):
+            self._face_layers = self.blocks.layer_table(self.palette)
+        return self._face_layers
+
+    @property
+    def edits_in_place(self) -> bool:
+        """True if single voxel edits rewrite faces in the buffers, rather
+        than queueing whole chunks for meshing. Only unshaded naive meshes
+        can be edited in place, as a voxel changes the shading of faces all
+        around it.
+        """
+        return self.mesher == Mesher.Naive and not self.shaded
+
+    @property
+    def shaded(self) -> bool:
+        """True if ambient occlusion or light levels are baked into the
+        meshes.
+        """
+        return self.ambient_occlusion or self.light_engine is not None
+
+    @property
+    def neighbor_offsets(self) -> Sequence[Key]:
+        """The chunks, relative to a chunk, whose meshes depend on the
+        voxels along its sides.
+        """
+        return NEIGHBOR_OFFSETS if self.shaded else UNIT_VECTORS
+
+    def set_ambient_occlusion(self, enabled: bool) -> None:
+        """Turn ambient occlusion on or off, remeshing every chunk."""
+        if enabled == self.ambient_occlusion:
+            return
+        self.ambient_occlusion = enabled
+        for chunk in self._chunks.values():
+            self._queue(chunk)
+
+    def set_light_engine(self, engine) -> None:
+        """Start baking the light levels kept by a `voxel_light.LightEngine`
+        into the meshes, or stop with None. Every chunk is lit and remeshed.
+        """
+        self.light_engine = engine
+        for chunk in self._chunks.values():
+            if engine is not None:
+                engine.chunk_changed(chunk)
+            self._queue(chunk)
+
+    def chunk_at(self, key: Key) -> Optional[Chunk]:
+        """Return the chunk with the given chunk coordinates, if any."""
+        return self._chunks.get(key)
+
+    def has_chunk(self, chunk: Chunk) -> bool:
+        """Return True if `chunk` is still part of this world."""
+        return self._chunks.get(chunk.key) is chunk
+
+    def _locate(self, key: Key) -> Tuple[Optional[Chunk], int]:
+        """Return the chunk holding the block `key` and its cell index."""
+        x, y, z = key
+        chunk = self._chunks.get(
+            (x // CHUNK_SIZE, y // CHUNK_SIZE, z // CHUNK_SIZE))
+        return chunk, cell_index(x, y, z)
+
+    def is_solid(self, x: int, y: int, z: int) -> bool:
+        """Return True if the block at integer coordinates holds a voxel."""
+        chunk = self._chunks.get(
+            (x // CHUNK_SIZE, y // CHUNK_SIZE, z // CHUNK_SIZE))
+        return chunk is not None and chunk.cells[cell_index(x, y, z)] != 0
+
+    @profiling.RAYCASTS
+    def raycast(self, origin, direction,
+                max_distance: float=8.0) -> Tuple[Optional[Key], ...]:
+        """Walk the blocks along a ray, one block boundary at a time, using
+        the Amanatides-Woo traversal. Returns the first voxel hit, the empty
+        block just before it and the normal of the face that was hit. Returns
+        None, None, None if no voxel is within `max_distance`.
+        """
+        profiling.RAYS.add()
+        length = math.sqrt(sum(d * d for d in direction))
+        if not length:
+            return None, None, None
+        # Shift by half a block so that block `i` spans [i, i + 1).
+        start = [c + CUBE_SIZE / 2.0 for c in origin]
+        cell = [math.floor(c) for c in start]
+        step, t_max, t_delta = [0] * 3, [math.inf] * 3, [math.inf] * 3
+        for axis, d in enumerate(direction):
+            d /= length
+            if d > 0:
+                step[axis] = 1
+                t_max[axis] = (cell[axis] + 1 - start[axis]) / d
+            elif d < 0:
+                step[axis] = -1
+                t_max[axis] = (cell[axis] - start[axis]) / d
+            if d:
+                t_delta[axis] = abs(1 / d)
 
-    def __setitem__(self, key, value):
-        self._voxels[key] = value
+        previous, normal = None, None
+        distance = 0.0
+        while distance <= max_distance:
+            if self.is_solid(*cell):
+                return tuple(cell), previous, normal
+            previous = tuple(cell)
+            axis = t_max.index(min(t_max))
+            distance = t_max[axis]
+            cell[axis] += step[axis]
+            t_max[axis] += t_delta[axis]
+            normal = [0, 0, 0]
+            normal[axis] = -step[axis]
+            normal = tuple(normal)
+        return None, None, None
 
-    def __getitem__(self, item):
-        return self._voxels[item]
+    def get_chunk(self, position, create: bool=False) -> Chunk:
+        """Return the chunk containing `position`, optionally creating it."""
+        key = chunk_key(position)
+        chunk = self._chunks.get(key)
+        if chunk is None and create:
+            cls = PackedChunk if self.render_mode == RenderMode.Packed \
+                else Chunk
+            chunk = self._chunks[key] = cls(key, self.node_path, self._format)
+        return chunk
 
     def _prepare_format(self):
         # TODO: Get normal mapping working
-        # array = GeomVertexArrayFormat()
-        # array.addColumn("vertex", 3, Geom.NTFloat32, Geom.CPoint)
-        # array.addColumn("normal", 3, Geom.NTFloat32, Geom.CPoint)
         # array.addColumn("tangent", 3, Geom.NTFloat32, Geom.CPoint)
         # array.addColumn("binormal", 3, Geom.NTFloat32, Geom.CPoint)
-        # array.addColumn("texcoord", 2, Geom.NTFloat32, Geom.CTexcoord)
-        # vertex_format = GeomVertexFormat()
-        # vertex_format.add_array(array)
-        # vertex_format.registerFormat(vertex_format)
-
-        self._format = GeomVertexFormat.get_v3n3t2()
-        self._vdata = GeomVertexData('cube', self._format, Geom.UH_dynamic)
-        # self.vertex_data.setNumRows(4)  # TODO: For performance
-        self._vertex_w = GeomVertexWriter(self._vdata, 'vertex')
-        self._normal_w = GeomVertexWriter(self._vdata, 'normal')
-        self._texcoord_w = GeomVertexWriter(self._vdata, 'texcoord')
+
+        if self.render_mode == RenderMode.Packed:
+            self._format = make_packed_format()
+            return
+
+        # The third texcoord picks the layer of the block texture array.
+        array = GeomVertexArrayFormat()
+        array.addColumn("vertex", 3, Geom.NTFloat32, Geom.CPoint)
+        array.addColumn("normal", 3, Geom.NTFloat32, Geom.CNormal)
+        array.addColumn("texcoord", 3, Geom.NTFloat32, Geom.CTexcoord)
+        array.addColumn("shade", 2, Geom.NTFloat32, Geom.COther)
+        vertex_format = GeomVertexFormat()
+        vertex_format.addArray(array)
+        self._format = GeomVertexFormat.registerFormat(vertex_format)
 
     def _prepare_node_path(self):
         """Create the publicly accessible node path needed for rendering."""
-        # Add the indexes to a primitive -> geom -> node -> node path
-        self._prim = GeomTriangles(Geom.UHStatic)
-        self._geom = Geom(self._vdata)
-        self._geom.addPrimitive(self._prim)
-        self._node = GeomNode('geom_node')
-        self._node.addGeom(self._geom)
-        self.node_path = render.attachNewNode(self._node)  # TODO: ew, linting
+        # Every chunk attaches its own GeomNode below this one.
+        self.node_path = render.attachNewNode('voxel_world')  # TODO: ew, linting
 
     def _prepare_texture(self):
         """Load and set texture stages for the node path."""
-        # Set Texture
-        dungeon_tex = loader.loadTexture("diffuse.png")  # TODO: ew, linting
-        dungeon_tex.setMagfilter(SamplerState.FT_nearest)
-        dungeon_tex.setMinfilter(SamplerState.FT_nearest)
-        self.node_path.setTexture(dungeon_tex)
+        # Set Texture, one layer per block image for every chunk to share
+        self.node_path.setTexture(self.blocks.make_texture())
+        # Texture arrays can only be sampled by shaders.
+        if self.render_mode == RenderMode.Packed and \
+                self.blocks.layer_count > MAX_PACKED_LAYERS:
+            raise ValueError('Too many block images to pack')
+        apply_voxel_shader(self.node_path, self.render_mode)
 
         # TODO: Set Normal Map
         # normal_tex = self.loader.loadTexture("normal_rocks.png")
@@ -103,54 +816,341 @@ class VoxelWorld:
         # ts.setMode(TextureStage.MNormal)
         # node_path.setTexture(ts, normal_tex)
 
+    @profiling.EDITS
     def place_voxel(self, voxel_type, position: Vec3D) -> None:
         """Create or replace a voxel with a new one."""
-        # TODO: Needs if self.exposed(position) in there somewhere.
-        if position in self:
+        key = voxel_key(position)
+        if self.is_solid(*key):
             return  # TODO: Replace instead!
-        start_index = len(self._voxels) * 24
-        # TODO: We need to recycle vertex indices that have been disabled.
-        self._voxels[position] = Voxel(position, start_index)
-        self.add_data(self._voxels[position])
+        profiling.VOXELS_EDITED.add()
+        chunk = self.get_chunk(key, create=True)
+        chunk.set_type(cell_index(*key), self.palette.id_of(voxel_type))
+        self.on_chunk_changed(chunk)
+        if self.light_engine is not None:
+            self.light_engine.voxel_changed(key, 0)
+        if not self.edits_in_place:
+            self.mark_dirty(key)
+            return
+        for face in range(len(UNIT_VECTORS)):
+            self.update_face(key, face)
+        self.check_neighbors(key)
+
+    @profiling.EDITS
+    def place_voxels(self, positions: Sequence,
+                     voxel_types: Sequence=None) -> None:
+        """Place many voxels at once, meshing each touched chunk only once.
+        Positions that already hold a voxel are left alone. The chunks are
+        only queued for meshing, see `take_dirty()` and `flush()`.
+        """
+        positions = voxel_keys(positions)
+        if voxel_types is None:
+            voxel_types = [None] * len(positions)
+        type_ids = np.array([self.palette.id_of(t) for t in voxel_types],
+                            dtype=TYPE_DTYPE)
+        profiling.VOXELS_EDITED.add(len(positions))
+
+        for key, members, local in _by_chunk(positions):
+            chunk = self.get_chunk(np.array(key) * CHUNK_SIZE, create=True)
+            chunk.add_voxels(np.ravel_multi_index(local.T, chunk.types.shape),
+                             type_ids[members])
+            self._changed_cells(chunk, local)
+
+    @profiling.EDITS
+    def set_voxels(self, positions: Sequence,
+                   type_ids: Sequence[int]) -> np.ndarray:
+        """Store a palette number at each of the `positions`, 0 removing
+        the voxel there, and return the numbers they held before. Like
+        `place_voxels()`, each touched chunk is only queued for meshing
+        once. A single voxel goes through `remove_voxel()` and
+        `place_voxel()` instead, which can edit meshes in place.
+        """
+        positions = voxel_keys(positions)
+        type_ids = np.asarray(type_ids, dtype=TYPE_DTYPE).reshape(-1)
+        old = self.voxel_ids(positions)
+        if len(positions) == 1:
+            position = tuple(positions[0].tolist())
+            if old[0]:
+                self.remove_voxel(position)
+            if type_ids[0]:
+                self.place_voxel(self.palette[type_ids[0]], position)
+            return old
+
+        profiling.VOXELS_EDITED.add(len(positions))
+        for key, members, local in _by_chunk(positions):
+            chunk = self._chunks.get(key)
+            if chunk is None:
+                if not type_ids[members].any():
+                    continue  # Air stays air
+                chunk = self.get_chunk(np.array(key) * CHUNK_SIZE, create=True)
+            chunk.set_cells(np.ravel_multi_index(local.T, chunk.types.shape),
+                            type_ids[members])
+            self._changed_cells(chunk, local)
+        return old
+
+    def voxel_ids(self, positions: Sequence) -> np.ndarray:
+        """Return the palette number at each of the `positions`, 0 for air.
+        """
+        positions = voxel_keys(positions)
+        type_ids = np.zeros(len(positions), dtype=TYPE_DTYPE)
+        for key, members, local in _by_chunk(positions):
+            chunk = self._chunks.get(key)
+            if chunk is not None:
+                type_ids[members] = chunk.types[tuple(local.T)]
+        return type_ids
+
+    def _changed_cells(self, chunk: Chunk, local: np.ndarray) -> None:
+        self.on_chunk_changed(chunk)
+        if self.light_engine is not None:
+            self.light_engine.chunk_changed(chunk)
+        self.queue_cells(chunk, local)
 
+    def queue_cells(self, chunk: Chunk, local: np.ndarray) -> None:
+        """Queue `chunk` for meshing after the cells at the `local`
+        coordinates changed, along with the neighbours that can see them.
+        """
+        self._queue(chunk)
+        # Cells on the chunk's edge can change faces of the next chunk.
+        local = np.asarray(local).reshape(-1, 3)
+        edges = {(axis, side): (local[:, axis] == edge).any()
+                 for axis in range(3)
+                 for side, edge in ((-1, 0), (1, CHUNK_SIZE - 1))}
+        for offset in self.neighbor_offsets:
+            if all(edges[axis, d] for axis, d in enumerate(offset) if d):
+                other = self._chunks.get(tuple(
+                    k + d for k, d in zip(chunk.key, offset)))
+                if other is not None:
+                    self._queue(other)
+
+    def set_chunk(self, key: Key, types: np.ndarray,
+                  voxel_types: Sequence) -> Optional[Chunk]:
+        """Fill the chunk at `key` with a whole array of voxels, where each
+        number is 0 for air or one more than an index into `voxel_types`.
+        Returns the chunk, or None if it would only hold air and does not
+        exist yet.
+        """
+        chunk = self._chunks.get(key)
+        if chunk is None:
+            if not types.any():
+                return None
+            chunk = self.get_chunk(np.array(key) * CHUNK_SIZE, create=True)
+        lookup = np.array([0] + [self.palette.id_of(t) for t in voxel_types],
+                          dtype=TYPE_DTYPE)
+        chunk.set_types(lookup[types])
+        self.on_chunk_changed(chunk)
+        if self.light_engine is not None:
+            self.light_engine.chunk_changed(chunk)
+        self._queue(chunk)
+        self._queue_neighbors(key)
+        return chunk
+
+    def unload_chunk(self, key: Key) -> Optional[Chunk]:
+        """Drop the chunk at `key` and its geometry, returning it."""
+        chunk = self._chunks.pop(key, None)
+        if chunk is None:
+            return None
+        self._dirty.discard(chunk)
+        chunk.version += 1  # Throw away meshes still being built
+        chunk.node_path.removeNode()
+        self.mesh_cache.discard(chunk)
+        if self.light_engine is not None:
+            self.light_engine.chunk_unloaded(chunk)
+        self.on_chunk_unloaded(chunk)
+        self._queue_neighbors(key)
+        return chunk
+
+    @profiling.EDITS
     def remove_voxel(self, position: Vec3D) -> None:
         """Remove the voxel at the given position."""
-        # TODO: Implement me
+        key = voxel_key(position)
+        chunk, cell = self._locate(key)
+        if chunk is None or not chunk.cells[cell]:
+            return
+        profiling.VOXELS_EDITED.add()
+        type_id = chunk.cells[cell]
+        chunk.set_type(cell, 0)
+        self.on_chunk_changed(chunk)
+        if self.light_engine is not None:
+            self.light_engine.voxel_changed(key, type_id)
+        # Faces of coarser meshes cover many voxels and have no slots to
+        # hide, so those chunks are meshed again too.
+        if not self.edits_in_place or chunk.lod or chunk.shown_lod:
+            self.mark_dirty(key)
+            return
+        for face in range(len(UNIT_VECTORS)):
+            chunk.hide_face(cell, face)
+        self.check_neighbors(key)
+
+    def on_chunk_changed(self, chunk: Chunk) -> None:
+        """Called whenever voxels are added to or removed from `chunk`.
+        Subclasses can override this to keep derived state in sync.
+        """
+
+    def on_chunk_unloaded(self, chunk: Chunk) -> None:
+        """Called after `chunk` has been dropped by `unload_chunk()`."""
 
-        # del self.world[position]
-        # if position in self._shown:
-        #     self.hide_block(position)
-        # self.check_neighbors(position)
-        raise NotImplementedError()
+    def check_neighbors(self, position: Vec3D) -> None:
+        """Ensure the faces of all blocks touching `position` are current.
+        Any single voxel change only affects the face of each adjacent voxel
+        that points back at it, so this is at most six face updates.
+        """
+        for face in range(len(UNIT_VECTORS)):
+            key = neighbor(position, face)
+            if self.is_solid(*key):
+                self.update_face(key, opposite(face))
+
+    def update_face(self, position: Vec3D, face: int) -> None:
+        """Show the `face` of the voxel at `position` if it borders air and
+        hide it otherwise.
+        """
+        chunk, cell = self._locate(voxel_key(position))
+        if chunk.lod or chunk.shown_lod:
+            # Faces of coarser meshes cover many voxels, so mesh it again.
+            self._queue(chunk)
+            return
+        if self.is_solid(*neighbor(position, face)):
+            chunk.hide_face(cell, face)
+        else:
+            chunk.show_face(cell, face,
+                            self.face_layers[chunk.cells[cell], face])
+
+    def mark_dirty(self, position: Vec3D) -> None:
+        """Queue every chunk whose mesh depends on `position` for a rebuild.
+        """
+        self._queue(self.get_chunk(position))
+        x, y, z = voxel_key(position)
+        for dx, dy, dz in self.neighbor_offsets:
+            chunk = self.get_chunk((x + dx, y + dy, z + dz))
+            if chunk is not None:
+                self._queue(chunk)
+
+    def _queue(self, chunk: Chunk) -> None:
+        # A mesh already being built for this chunk is now out of date.
+        chunk.version += 1
+        self._dirty.add(chunk)
 
-    # TODO: Calculate which faces to show and hide every time there's a voxel
-    # change. Luckily any single voxel change only affects adjacent voxels
-    # (plus voxels around adjacent, transparent voxels)
+    def _queue_neighbors(self, key: Key) -> None:
+        # Their faces bordering the chunk at `key` may have changed.
+        for vector in self.neighbor_offsets:
+            other = self._chunks.get(tuple(k + d for k, d in zip(key, vector)))
+            if other is not None:
+                self._queue(other)
+
+    def take_dirty(self) -> Set[Chunk]:
+        """Return the chunks queued for meshing and forget about them.
+        Chunks waiting to be lit are lit first.
+        """
+        if self.light_engine is not None:
+            self.light_engine.update()
+        dirty, self._dirty = self._dirty, set()
+        return dirty
+
+    def padded_types(self, chunk: Chunk, width: int=1) -> np.ndarray:
+        """Return a copy of the palette numbers of `chunk`, surrounded by
+        the touching layers, edges and corners of its neighbours, `width`
+        blocks thick. This is everything meshing needs to know about the
+        world.
+        """
+        return self._padded(chunk, 'types', np.pad(chunk.types, width),
+                            width)
+
+    def padded_light(self, chunk: Chunk) -> np.ndarray:
+        """Return a copy of the light of `chunk` and around it, like
+        `padded_types()`. Missing chunks only hold air open to the sky.
+        """
+        return self._padded(chunk, 'light',
+                            np.pad(chunk.light, 1, constant_values=SKY_LIGHT))
+
+    def _padded(self, chunk: Chunk, name: str, padded: np.ndarray,
+                width: int=1) -> np.ndarray:
+        n, w = CHUNK_SIZE, width
+        for offset in self.neighbor_offsets:
+            other = self._chunks.get(tuple(k + d for k, d in
+                                           zip(chunk.key, offset)))
+            if other is None:
+                continue
+            source = tuple(slice(None) if not d else
+                           slice(0, w) if d > 0 else slice(n - w, n)
+                           for d in offset)
+            target = tuple(slice(w, n + w) if not d else
+                           slice(n + w, n + 2 * w) if d > 0 else slice(0, w)
+                           for d in offset)
+            padded[target] = getattr(other, name)[source]
+        return padded
+
+    def mesh_job(self, chunk: Chunk) -> Tuple:
+        """Snapshot everything needed to mesh `chunk`, as the arguments of
+        `build_mesh()`.
+        """
+        light = None
+        if self.light_engine is not None:
+            light = light_levels(self.padded_light(chunk))
+        return (self.mesher, self.padded_types(chunk, 1 << chunk.lod),
+                self.face_layers,
+                chunk.version, self.render_mode, self.ambient_occlusion,
+                light, chunk.lod)
+
+    def upload(self, chunk: Chunk, mesh: ChunkMesh) -> bool:
+        """Swap a mesh built from `mesh_job()` into `chunk` and keep it
+        for later. Returns False, leaving the chunk alone, if the chunk
+        changed or switched detail levels since the job was made.
+        """
+        if mesh.version != chunk.version or mesh.lod != chunk.lod:
+            return False
+        chunk.upload(mesh)
+        self.mesh_cache.put(chunk, mesh)
+        return True
+
+    def flush(self) -> None:
+        """Rebuild the meshes of all queued chunks right away."""
+        for chunk in self.take_dirty():
+            self.upload(chunk, build_mesh(*self.mesh_job(chunk)))
+
+    def update_lod(self, eye, distances: Sequence[float]=LOD_DISTANCES
+                   ) -> None:
+        """Pick the level of detail of every chunk by its distance from
+        `eye`, going one level coarser past each of the `distances`. Chunks
+        switching to a level they have a current mesh for show it right
+        away; the others are queued for meshing and keep their old mesh
+        until then.
+        """
+        middle = (CHUNK_SIZE - CUBE_SIZE) / 2.0
+        for chunk in self._chunks.values():
+            distance = math.sqrt(sum((o + middle - e) ** 2
+                                     for o, e in zip(chunk.origin, eye)))
+            # Only come back to finer levels well inside their distance, so
+            # chunks on a boundary do not keep switching.
+            lod = sum(distance > limit - (LOD_MARGIN if level < chunk.lod
+                                          else 0)
+                      for level, limit in enumerate(distances))
+            if lod == chunk.lod:
+                continue
+            chunk.lod = lod
+            mesh = self.mesh_cache.get(chunk, lod)
+            if mesh is not None:
+                chunk.upload(mesh)
+            else:
+                self._dirty.add(chunk)
+
+    @property
+    def triangle_count(self) -> int:
+        """The number of triangles drawn for the whole world."""
+        return 2 * sum(chunk.face_count for chunk in self._chunks.values())
+
+    @property
+    def buffer_bytes(self) -> int:
+        """The size of the vertex and index data of every chunk."""
+        return sum(chunk.buffer_bytes for chunk in self._chunks.values())
 
     def exposed(self, position: Vec3D) -> bool:
         """Returns a boolean specifying if the given voxel is visible from any
         angle (because it is NOT completely surrounded by opaque voxels.
         """
-        x, y, z = position
+        x, y, z = voxel_key(position)
         for dx, dy, dz in UNIT_VECTORS:
-            if Vec3D(x + dx, y + dy, z + dz) not in self._voxels:
+            if not self.is_solid(x + dx, y + dy, z + dz):
                 return True
         return False
 
-    def add_data(self, voxel: Voxel):
-        """Write vertex and other data to the buffers."""
-        # Write data to the buffers
-        for v in make_vertices(voxel.position):
-            self._vertex_w.addData3f(*v)
-        for v in make_normals():
-            self._normal_w.addData3f(*v)
-        for tex in make_texcoords():
-            self._texcoord_w.addData2f(*tex)
-        # TODO: Optimize make_indices by combining similar points across voxels
-        for i in make_indices(start=voxel.index):
-            self._prim.addVertex(i)
-            self._prim.modifyVertices()
-
 
 def make_vertices(position: Vec3D) -> Tuple:
     """ Return the vertices of a 2-unit cube centered at the origin."""
@@ -190,6 +1190,148 @@ def make_vertices(position: Vec3D) -> Tuple:
     )
 
 
+# Which corners of the unit cube each face's vertices sit on.
+FACE_CORNERS = tuple(
+    tuple(tuple(int(c > 0) for c in v)
+          for v in make_vertices((0, 0, 0))[face * 4:face * 4 + 4])
+    for face in range(len(UNIT_VECTORS))
+)
+# The axes along which each face's texture u and v coordinates increase.
+FACE_AXES = tuple(
+    tuple([a != b for a, b in zip(corners[0], corners[k])].index(True)
+          for k in (2, 1))
+    for corners in FACE_CORNERS
+)
+# Which corner of a shade each vertex of a face takes: 1 if it is on the
+# high side of the face's u axis, plus 2 if it is on the high side of v.
+CORNER_SIDES = tuple(
+    tuple(corner[u] + 2 * corner[v] for corner in corners)
+    for corners, (u, v) in zip(FACE_CORNERS, FACE_AXES)
+)
+
+
+def make_quad_vertices(position: Vec3D, face: int, size: Tuple) -> Tuple:
+    """Return the vertices of a face stretched across `size` voxels, where
+    `position` is the lowest voxel covered.
+    """
+    s = CUBE_SIZE / 2.0
+    return tuple(
+        tuple(p - s + c * (n - 1 + CUBE_SIZE)
+              for p, c, n in zip(position, corner, size))
+        for corner in FACE_CORNERS[face]
+    )
+
+
+def make_quad_texcoords(face: int, size: Tuple) -> Tuple:
+    """Return texcoords that repeat the texture once per voxel of a face
+    stretched across `size` voxels.
+    """
+    u, v = FACE_AXES[face]
+    return tuple((tu * size[u], tv * size[v])
+                 for tu, tv in make_texcoords()[face * 4:face * 4 + 4])
+
+
+def make_quad_arrays(faces: np.ndarray, positions: np.ndarray,
+                     sizes: np.ndarray, layers: np.ndarray=None,
+                     shades: np.ndarray=None
+                     ) -> Tuple[np.ndarray, np.ndarray]:
+    """Vectorized `make_quad_vertices` and friends for many quads at once,
+    textured with the given texture array layers and shaded as described by
+    `face_shades()`. Returns the vertex rows and the uint32 indices of the
+    triangles.
+    """
+    if layers is None:
+        layers = np.zeros(len(faces), dtype=np.float32)
+    if shades is None:
+        shades = np.full(len(faces), FULL_SHADE, dtype=np.uint32)
+    s = CUBE_SIZE / 2.0
+    corners = np.array(FACE_CORNERS, dtype=np.float32)[faces]
+    spans = (sizes - 1 + CUBE_SIZE).astype(np.float32)[:, None, :]
+    vertices = positions.astype(np.float32)[:, None, :] - s + corners * spans
+    normals = np.array(make_normals(), dtype=np.float32).reshape(-1, 4, 3)
+    texcoords = np.array(make_texcoords(), dtype=np.float32).reshape(-1, 4, 2)
+    axes = np.array(FACE_AXES)[faces]
+    repeats = np.take_along_axis(sizes, axes, axis=1).astype(np.float32)
+    layers = np.broadcast_to(
+        np.asarray(layers, dtype=np.float32)[:, None, None], (len(faces), 4, 1))
+    shifts = np.array(CORNER_SIDES, dtype=np.uint32)[faces] * SHADE_BITS
+    shade = np.asarray(shades, dtype=np.uint32)[:, None] >> shifts
+    shading = np.stack((shade & 3, shade >> 2 & MAX_LIGHT), axis=2)
+    shading = shading.astype(np.float32) / np.array([3, MAX_LIGHT],
+                                                     dtype=np.float32)
+    rows = np.concatenate((vertices, normals[faces],
+                           texcoords[faces] * repeats[:, None, :], layers,
+                           shading), axis=2)
+    starts = np.arange(len(faces), dtype=np.uint32)[:, None] * 4
+    indices = starts + np.array(FACE_INDICES, dtype=np.uint32)
+    return rows.reshape(-1, ROW_FLOATS), indices.ravel()
+
+
+def make_packed_format() -> GeomVertexFormat:
+    """Return the vertex format of a `PackedChunk`: the corners of one
+    shared quad, and a packed face and shade for each instance of it.
+    """
+    corners = GeomVertexArrayFormat()
+    corners.addColumn("vertex", 3, Geom.NTFloat32, Geom.CPoint)
+    faces = GeomVertexArrayFormat()
+    faces.addColumn("face", 1, Geom.NTUint32, Geom.COther)
+    faces.addColumn("shades", 1, Geom.NTUint32, Geom.COther)
+    faces.setDivisor(1)
+    vertex_format = GeomVertexFormat()
+    vertex_format.addArray(corners)
+    vertex_format.addArray(faces)
+    return GeomVertexFormat.registerFormat(vertex_format)
+
+
+def packed_face_tables() -> Dict[str, List]:
+    """Describe each face to the packed voxel shader: the lowest corner of
+    its quad relative to the voxel's center, unit vectors along its u and v
+    axes, its normal, and whether the shared quad has to be mirrored to wind
+    the same way as `make_vertices`.
+    """
+    tables = {name: [] for name in ('face_origin', 'face_u', 'face_v',
+                                    'face_normal', 'face_flip')}
+    axes = np.eye(3)
+    for face, normal in enumerate(UNIT_VECTORS):
+        corners = np.array(FACE_CORNERS[face], dtype=np.float64)
+        u, v = (axes[a] for a in FACE_AXES[face])
+        a, b, c = (corners[i] for i in FACE_INDICES[:3])
+        winding = np.dot(np.cross(b - a, c - a), normal)
+        # The shared quad's first triangle runs (0, 0), (0, 1), (1, 0).
+        tables['face_origin'].append(corners.min(axis=0) - CUBE_SIZE / 2.0)
+        tables['face_u'].append(u)
+        tables['face_v'].append(v)
+        tables['face_normal'].append(np.array(normal, dtype=np.float64))
+        tables['face_flip'].append(
+            float(np.sign(np.dot(np.cross(v, u), normal)) != np.sign(winding)))
+    return tables
+
+
+def apply_voxel_shader(node_path: NodePath,
+                       render_mode: RenderMode=RenderMode.Vertices) -> None:
+    """Draw the chunks below `node_path` with the voxel shaders, which
+    sample the block texture array.
+    """
+    vertex = 'shaders/voxel.vert'
+    if render_mode == RenderMode.Packed:
+        vertex = 'shaders/packed_voxel.vert'
+    node_path.setShader(Shader.load(
+        Shader.SL_GLSL, vertex=find_file(vertex),
+        fragment=find_file('shaders/voxel.frag')))
+    if render_mode != RenderMode.Packed:
+        return
+    for name, values in packed_face_tables().items():
+        if name == 'face_flip':
+            array = PTA_float.emptyArray(0)
+            for value in values:
+                array.pushBack(value)
+        else:
+            array = PTA_LVecBase3f.emptyArray(0)
+            for value in values:
+                array.pushBack(LVecBase3f(*value))
+        node_path.setShaderInput(name, array)
+
+
 def make_normals() -> Tuple:
     """Return the normals for the vertices of a cube."""
     return (
@@ -237,6 +1379,371 @@ def make_texcoords() -> Tuple:
     ) * 6  # We're just cheating here.
 
 
+def light_levels(light: np.ndarray) -> np.ndarray:
+    """Return the brighter of the sunlight and block light of each cell.
+    """
+    return np.maximum(light >> 4, light & MAX_LIGHT)
+
+
+def pad(types: np.ndarray) -> np.ndarray:
+    """Surround the palette numbers of a chunk with a layer of air."""
+    return np.pad(types, 1)
+
+
+def pack_quads(faces: np.ndarray, positions: np.ndarray, sizes: np.ndarray,
+               layers: np.ndarray=None, shades: np.ndarray=None
+               ) -> np.ndarray:
+    """Pack each quad into two uint32s for `RenderMode.Packed`. The first
+    holds, from the low bits up: local x, y and z (4 bits each), face (3
+    bits), size along the face's u and v axes minus one (4 bits each) and
+    texture layer (9 bits). The second is the quad's shade from
+    `face_shades()`.
+
+    The shader only knows the face of a quad, so quads thicker than a voxel
+    start from the voxel the face is drawn on.
+    """
+    axes = np.array(FACE_AXES, dtype=np.int64).reshape(-1, 2)[faces]
+    spans = np.take_along_axis(np.asarray(sizes), axes, axis=1) - 1
+    outward = np.maximum(np.array(UNIT_VECTORS, dtype=np.int64), 0)[faces]
+    positions = positions + outward * (np.asarray(sizes) - 1)
+    if layers is None:
+        layers = np.zeros(len(faces))
+    fields = (positions[:, 0], positions[:, 1], positions[:, 2], faces,
+              spans[:, 0], spans[:, 1], layers)
+    packed = np.zeros((len(faces), 2), dtype=np.uint32)
+    for value, shift in zip(fields, (0, 4, 8, 12, 15, 19, 23)):
+        packed[:, 0] |= np.asarray(value).astype(np.uint32) << np.uint32(shift)
+    packed[:, 1] = FULL_SHADE if shades is None else shades
+    return packed
+
+
+def quads_mesh(faces: np.ndarray, positions: np.ndarray, sizes: np.ndarray,
+               layers: np.ndarray=None, shades: np.ndarray=None,
+               version: int=0,
+               render_mode: RenderMode=RenderMode.Vertices) -> ChunkMesh:
+    """Build a mesh of quads covering `sizes` voxels from the local blocks
+    `positions`.
+    """
+    if render_mode == RenderMode.Packed:
+        return ChunkMesh(version, pack_quads(faces, positions, sizes, layers,
+                                             shades), None)
+    return ChunkMesh(version, *make_quad_arrays(faces, positions, sizes,
+                                                layers, shades))
+
+
+def faces_mesh(cells: np.ndarray, faces: np.ndarray, layers: np.ndarray=None,
+               shades: np.ndarray=None, version: int=0,
+               render_mode: RenderMode=RenderMode.Vertices) -> ChunkMesh:
+    """Build a mesh with one quad for each of the given faces of the voxels
+    in `cells`.
+    """
+    positions = np.stack(np.unravel_index(cells, (CHUNK_SIZE,) * 3), 1)
+    mesh = quads_mesh(faces, positions, np.ones_like(positions), layers,
+                      shades, version, render_mode)
+    mesh.cells, mesh.faces = cells, faces
+    return mesh
+
+
+def build_mesh(mesher: Mesher, padded: np.ndarray,
+               face_layers: np.ndarray=None, version: int=0,
+               render_mode: RenderMode=RenderMode.Vertices,
+               occlusion: bool=False, light: np.ndarray=None,
+               lod: int=0) -> ChunkMesh:
+    """Mesh a chunk from the snapshot returned by `padded_types()`,
+    looking up texture layers in a `VoxelWorld.face_layers` table. Ambient
+    occlusion and the light levels of the air cells in a padded `light`
+    array are baked into the corners of the faces. The mesh also records
+    which faces of the chunk see each other. Only the arguments are read,
+    so this is safe to call from worker threads.
+
+    A level of detail `lod` above 0 meshes the chunk `2 ** lod` times
+    coarser along each axis, from types padded as thick as that, see
+    `downsample()`.
+    """
+    scale = 1 << lod
+    connections = face_connections(padded[scale:-scale, scale:-scale,
+                                          scale:-scale])
+    if lod:
+        padded = downsample(padded, scale)
+        if light is not None:
+            light = np.pad(downsample(light[1:-1, 1:-1, 1:-1], scale, True),
+                           1, constant_values=MAX_LIGHT)
+    shades = None
+    if occlusion or light is not None:
+        shades = face_shades(padded, occlusion, light)
+    if mesher == Mesher.Greedy:
+        faces, positions, sizes, types, shades = greedy_quads(padded, shades)
+    else:
+        faces, *cell = np.nonzero(exposed_faces(padded))
+        positions = np.stack(cell, 1)
+        sizes = np.ones_like(positions)
+        types = padded[1:-1, 1:-1, 1:-1][tuple(cell)]
+        if shades is not None:
+            shades = shades[(faces, *cell)]
+    layers = None if face_layers is None else face_layers[types, faces]
+    mesh = quads_mesh(faces, positions * scale, sizes * scale, layers, shades,
+                      version, render_mode)
+    if mesher == Mesher.Naive and not lod:
+        # Recorded so that the chunk can go on editing the faces in place.
+        mesh.cells = np.ravel_multi_index(positions.T, (CHUNK_SIZE,) * 3)
+        mesh.faces = faces
+    mesh.connections = connections
+    mesh.lod = lod
+    return mesh
+
+
+def downsample(padded: np.ndarray, scale: int, brightest: bool=False
+               ) -> np.ndarray:
+    """Shrink the palette numbers of a chunk padded `scale` blocks thick
+    `scale` times along each axis, keeping one block of padding.
+
+    A coarse block of the chunk holds a voxel if any of the voxels it covers
+    does, taking the type of the highest one, which is what shows from
+    above. A coarse block of the padding only holds a voxel if all of them
+    do. The coarse mesh then covers the voxels of the chunk and closes
+    itself off wherever a neighbour might show air, so there are no gaps
+    where it meets chunks meshed at other levels of detail.
+
+    With `brightest`, shrink an unpadded array of light levels instead,
+    keeping the brightest.
+    """
+    n = len(padded) // scale
+    blocks = padded.reshape(n, scale, n, scale, n, scale)
+    if brightest:
+        return blocks.max(axis=(1, 3, 5))
+    # Each block's voxels from the top down.
+    blocks = blocks.transpose(0, 2, 4, 5, 1, 3)[:, :, :, ::-1]
+    blocks = blocks.reshape(n, n, n, -1)
+    highest = np.argmax(blocks != 0, axis=-1)[..., None]
+    coarse = np.take_along_axis(blocks, highest, axis=-1)[..., 0]
+    full = blocks.all(axis=-1)
+    full[1:-1, 1:-1, 1:-1] = True
+    return np.where(full, coarse, 0).astype(padded.dtype)
+
+
+def face_connections(types: np.ndarray) -> int:
+    """Return which faces of a chunk can see each other through the air
+    inside it, as a bit mask with bit `6 * a + b` set if faces `a` and `b`
+    are joined. Used for cave culling, see `culling`.
+    """
+    air = types == 0
+    if air.all():
+        return ALL_CONNECTIONS
+    sides = []
+    for face, vector in enumerate(UNIT_VECTORS):
+        axis = _normal_axis(face)
+        side = [slice(None)] * 3
+        side[axis] = CHUNK_SIZE - 1 if vector[axis] > 0 else 0
+        sides.append(tuple(side))
+    connections = 0
+    for face, side in enumerate(sides):
+        reached = np.zeros_like(air)
+        reached[side] = air[side]
+        if not reached.any():
+            continue
+        # Grow through the air one block at a time until it stops.
+        while True:
+            grown = reached.copy()
+            grown[1:] |= reached[:-1]
+            grown[:-1] |= reached[1:]
+            grown[:, 1:] |= reached[:, :-1]
+            grown[:, :-1] |= reached[:, 1:]
+            grown[:, :, 1:] |= reached[:, :, :-1]
+            grown[:, :, :-1] |= reached[:, :, 1:]
+            grown &= air
+            if np.array_equal(grown, reached):
+                break
+            reached = grown
+        for other, other_side in enumerate(sides):
+            if reached[other_side].any():
+                connections |= 1 << len(UNIT_VECTORS) * face + other
+    return connections
+
+
+def exposed_faces(padded: np.ndarray) -> np.ndarray:
+    """Return which faces of the voxels in a padded chunk border air,
+    indexed by face and then local x, y and z.
+    """
+    n = len(padded) - 2
+    solid = padded != 0
+    occupied = solid[1:-1, 1:-1, 1:-1]
+    exposed = np.empty((len(UNIT_VECTORS),) + occupied.shape, dtype=bool)
+    for face, (dx, dy, dz) in enumerate(UNIT_VECTORS):
+        beside = solid[1 + dx:n + 1 + dx, 1 + dy:n + 1 + dy, 1 + dz:n + 1 + dz]
+        np.logical_and(occupied, ~beside, out=exposed[face])
+    return exposed
+
+
+def face_shades(padded: np.ndarray, occlusion: bool=True,
+                light: np.ndarray=None) -> np.ndarray:
+    """Return the shade of every face of the voxels in a padded chunk,
+    indexed like `exposed_faces()`.
+
+    A shade packs SHADE_BITS for each corner of the face, numbered by
+    `CORNER_SIDES`: the ambient occlusion from 0, in a crevice, to 3, in the
+    open, and above it the light level averaged over the air around the
+    corner. Without a `light` array every corner is fully lit.
+    """
+    n = len(padded) - 2
+    solid = (padded != 0).astype(np.uint32)
+    if light is not None:
+        light = light.astype(np.uint32)
+
+    def around(array: np.ndarray, offset: np.ndarray) -> np.ndarray:
+        dx, dy, dz = offset
+        return array[1 + dx:n + 1 + dx, 1 + dy:n + 1 + dy, 1 + dz:n + 1 + dz]
+
+    axes = np.eye(3, dtype=np.int64)
+    shades = np.zeros((len(UNIT_VECTORS),) + (n,) * 3, dtype=np.uint32)
+    for face, normal in enumerate(UNIT_VECTORS):
+        normal = np.array(normal)
+        u, v = (axes[a] for a in FACE_AXES[face])
+        for corner in range(4):
+            su, sv = (corner & 1) * 2 - 1, (corner >> 1) * 2 - 1
+            # The air in front of the face, beside it along u and v, and
+            # diagonally across the corner.
+            offsets = (normal, normal + su * u, normal + sv * v,
+                       normal + su * u + sv * v)
+            ao = 3
+            if occlusion:
+                side_u, side_v, diagonal = (around(solid, o)
+                                            for o in offsets[1:])
+                ao = np.where(side_u & side_v, 0,
+                              3 - side_u - side_v - diagonal)
+            level = MAX_LIGHT
+            if light is not None:
+                total = count = 0
+                for offset in offsets:
+                    air = 1 - around(solid, offset)
+                    total = total + around(light, offset) * air
+                    count = count + air
+                level = (total + count // 2) // np.maximum(count, 1)
+            shades[face] |= (ao | level << 2) << (corner * SHADE_BITS)
+    return shades
+
+
+def greedy_quads(padded: np.ndarray, shades: np.ndarray=None
+                 ) -> Tuple[np.ndarray, ...]:
+    """Merge the visible faces of a padded chunk into as few quads as
+    possible.
+
+    Faces are merged when they point the same way, lie in the same plane,
+    belong to voxels of the same type and have the same shade from
+    `face_shades()`. Shaded quads only stretch along the axes their shade
+    does not change along, so they look the same as separate faces.
+    Returns the face, local position, size, palette number and shade of each
+    quad as arrays.
+    """
+    types = padded[1:-1, 1:-1, 1:-1].astype(np.int64)
+    stretch = None
+    if shades is not None:
+        types = types | shades.astype(np.int64) << 16
+        stretch = _shade_stretch
+    exposed = exposed_faces(padded)
+    quads = []
+    for face in range(len(UNIT_VECTORS)):
+        normal = _normal_axis(face)
+        u, v = FACE_AXES[face]
+        local = [0, 0, 0]
+        keys = types if shades is None else types[face]
+        for depth in range(len(padded) - 2):
+            layer = np.take(exposed[face], depth, axis=normal)
+            if not layer.any():
+                continue
+            mask = np.where(layer, np.take(keys, depth, axis=normal), 0)
+            if u > v:
+                mask = mask.T
+            local[normal] = depth
+            for i, j, width, height, cell in _merge_mask(mask.tolist(),
+                                                         stretch):
+                local[u], local[v] = i, j
+                size = [1, 1, 1]
+                size[u], size[v] = width, height
+                quads.append((face, *local, *size, cell))
+    quads = np.array(quads, dtype=np.int64).reshape(-1, 8)
+    keys = quads[:, 7]
+    quad_shades = None if shades is None else (keys >> 16).astype(np.uint32)
+    return (quads[:, 0], quads[:, 1:4], quads[:, 4:7], keys & 0xFFFF,
+            quad_shades)
+
+
+@functools.lru_cache(maxsize=4096)
+def _shade_stretch(key: int) -> Tuple[bool, bool]:
+    """Return whether a quad keyed by palette number and shade can grow
+    along its u and v axes, which it can if its shade is the same on both
+    sides of that axis.
+    """
+    shade = key >> 16
+    c = [shade >> (corner * SHADE_BITS) & ((1 << SHADE_BITS) - 1)
+         for corner in range(4)]
+    return c[0] == c[1] and c[2] == c[3], c[0] == c[2] and c[1] == c[3]
+
+
+def _merge_mask(mask: List[List], stretch: Callable=None
+                ) -> Iterator[Tuple[int, int, int, int, int]]:
+    """Cover the non-zero cells of a square mask with maximal rectangles of
+    equal cells, consuming the mask as it goes. Yields the corner, size and
+    cell value of each rectangle. A `stretch` function can stop rectangles
+    of some values from growing along either axis.
+    """
+    n = len(mask)
+    for j in range(n):
+        i = 0
+        while i < n:
+            cell = mask[i][j]
+            if not cell:
+                i += 1
+                continue
+            wide, tall = stretch(cell) if stretch else (True, True)
+            width = 1
+            while wide and i + width < n and mask[i + width][j] == cell:
+                width += 1
+            height = 1
+            while tall and j + height < n and all(
+                    mask[i + k][j + height] == cell for k in range(width)):
+                height += 1
+            for k in range(width):
+                for h in range(height):
+                    mask[i + k][j + h] = 0
+            yield i, j, width, height, cell
+            i += width
+
+
+def _normal_axis(face: int) -> int:
+    """Return the axis that `face` points along."""
+    return [abs(c) for c in UNIT_VECTORS[face]].index(1)
+
+
+def _by_chunk(positions: np.ndarray
+              ) -> Iterator[Tuple[Key, np.ndarray, np.ndarray]]:
+    """Group block positions by chunk, yielding each chunk key with the
+    indices of its positions and their local coordinates.
+    """
+    if not len(positions):
+        return
+    keys = positions // CHUNK_SIZE
+    # One number per chunk sorts much faster than rows of three.
+    numbers = np.ravel_multi_index((keys + _KEY_OFFSET).T, (_KEY_RANGE,) * 3)
+    order = np.argsort(numbers, kind='stable')
+    starts = np.flatnonzero(np.diff(numbers[order], prepend=-1))
+    for members in np.split(order, starts[1:]):
+        key = keys[members[0]]
+        yield tuple(key.tolist()), members, positions[members] - \
+            key * CHUNK_SIZE
+
+
+def neighbor(position, face: int) -> Key:
+    """Return the block touching `face` of the block at `position`."""
+    x, y, z = voxel_key(position)
+    dx, dy, dz = UNIT_VECTORS[face]
+    return x + dx, y + dy, z + dz
+
+
+def make_face_indices(start=0) -> Tuple:
+    """The indices of a single face."""
+    return tuple(start + v for v in FACE_INDICES)
+
+
 def make_indices(start=0) -> Tuple:
     """The indices of a cube."""
     offsets = (
@@ -255,21 +1762,3 @@ def make_indices(start=0) -> Tuple:
     )
     return tuple(start + v for v in offsets)
 
-
-# def check_neighbors(self, position):
-#     """ Check all blocks surrounding `position` and ensure their visual
-#     state is current. This means hiding blocks that are not exposed and
-#     ensuring that all exposed blocks are shown. Usually used after a block
-#     is added or removed.
-#     """
-#     x, y, z = position
-#     for dx, dy, dz in FACES:
-#         key = (x + dx, y + dy, z + dz)
-#         if key not in self.world:
-#             continue
-#         if self.exposed(key):
-#             if key not in self._shown:
-#                 self.show_block(key)
-#         else:
-#             if key in self._shown:
-#                 self.hide_block(key)
\ No newline at end of file
@@ -0,0 +1,326 @@
+# coding=utf-8
+"""Flood light through a voxel world: sunlight from the sky and block light
+from blocks that glow.
+
+Light levels run from 0 to `voxel.MAX_LIGHT`. Every chunk keeps one byte per
+cell next to its voxel types, with the sunlight level in the high four bits
+and the block light level in the low four. Light spreads through air and
+fades by one level per block, except that full sunlight falls straight down
+without fading. Light does not spread through chunks that do not exist, but
+sunlight still falls into the chunks below them, as they can only hold air.
+
+Single voxel edits update the light incrementally with breadth-first flood
+fills: one removing the light that came from where the voxel changed, and one
+spreading light back in from the edge of the darkened cells. Whole chunks
+that change are lit with NumPy first and then joined up with their
+neighbours the same way.
+"""
+from collections import deque
+from typing import Deque, Dict, List, Set, Tuple
+
+import numpy as np
+
+import voxel
+from voxel import CHUNK_SIZE, MAX_LIGHT, UNIT_VECTORS, Key
+
+SUN, BLOCK = 4, 0  # The shift of each kind of light within a light byte
+DOWN = 5  # The face pointing along -z, the way sunlight falls
+FACES = tuple((face, dx, dy, dz)
+              for face, (dx, dy, dz) in enumerate(UNIT_VECTORS))
+
+
+class LightEngine:
+    """Keeps the light of a `voxel.VoxelWorld` up to date as it changes.
+    Attach it with `VoxelWorld.set_light_engine()`.
+    """
+    def __init__(self, world: voxel.VoxelWorld):
+        self.world = world
+        self._pending: Dict[voxel.Chunk, None] = {}  # Chunks to light
+        self._emission = np.zeros(0, dtype=np.int16)
+
+    @property
+    def emission(self) -> np.ndarray:
+        """The block light given off by each voxel type, indexed by palette
+        number.
+        """
+        palette = self.world.palette
+        if len(self._emission) != len(palette):
+            self._emission = np.array(
+                [0] + [self.world.blocks[t].light for t in palette],
+                dtype=np.int16)
+        return self._emission
+
+    def chunk_changed(self, chunk: voxel.Chunk) -> None:
+        """Light `chunk` again before it is next meshed, after many of its
+        voxels changed at once.
+        """
+        self._pending[chunk] = None
+
+    def chunk_unloaded(self, chunk: voxel.Chunk) -> None:
+        """Forget about `chunk`, which left the world."""
+        self._pending.pop(chunk, None)
+
+    def update(self) -> None:
+        """Light every chunk that changed since the last update."""
+        if not self._pending:
+            return
+        # From the top down, so sunlight reaching each chunk is already known.
+        chunks = sorted(self._pending, key=lambda c: -c.key[2])
+        self._pending.clear()
+        batch = set(chunks)
+        touched: Dict[voxel.Chunk, Set[int]] = {}
+        for shift in (SUN, BLOCK):
+            removed, spread = [], []
+            for chunk in chunks:
+                self._light_chunk(chunk, shift, batch, removed, spread,
+                                  touched)
+            spread.extend(self._remove(removed, shift, touched, batch))
+            self._spread(spread, shift, touched)
+        self._queue(touched)
+
+    def voxel_changed(self, key: Key, old_type: int) -> None:
+        """Update the light after the voxel at the block `key` changed from
+        the palette number `old_type`.
+        """
+        self.update()
+        chunk = self.world.chunk_at(voxel.chunk_key(key))
+        cell = voxel.cell_index(*key)
+        new_type = chunk.cells[cell]
+        touched: Dict[voxel.Chunk, Set[int]] = {chunk: {cell}}
+        for shift in (SUN, BLOCK):
+            level = _get(chunk, cell, shift)
+            emitted = int(self.emission[new_type]) if shift == BLOCK else 0
+            if new_type:
+                # A solid voxel blocks all light but its own.
+                _set(chunk, cell, shift, emitted)
+                spread = self._remove([(key, level)], shift, touched)
+                if emitted:
+                    spread.append(key)
+            else:
+                if shift == BLOCK and self.emission[old_type]:
+                    _set(chunk, cell, shift, 0)
+                    spread = self._remove([(key, level)], shift, touched)
+                else:
+                    spread = []
+                # The new air lets the light around it in.
+                spread.extend(_neighbors(key))
+            self._spread(spread, shift, touched)
+        self._queue(touched)
+
+    def _light_chunk(self, chunk: voxel.Chunk, shift: int,
+                     batch: Set[voxel.Chunk], removed: List, spread: List,
+                     touched: Dict):
+        """Light a chunk on its own from the sky above it and the blocks in
+        it, then collect where light has to be removed from or spread into
+        its neighbours to join the chunk up with them.
+        """
+        n = CHUNK_SIZE
+        types = chunk.types
+        air = types == 0
+        if shift == SUN:
+            above = self.world.chunk_at((chunk.key[0], chunk.key[1],
+                                         chunk.key[2] + 1))
+            sky = np.full((n, n), MAX_LIGHT, dtype=np.int16) if above is None \
+                else (above.light[:, :, 0] >> SUN).astype(np.int16)
+            # Full sunlight down to the first solid voxel of each column.
+            open_above = np.logical_and.accumulate(air[:, :, ::-1],
+                                                   axis=2)[:, :, ::-1]
+            seed = np.where(open_above & (sky == MAX_LIGHT)[:, :, None],
+                            MAX_LIGHT, 0).astype(np.int16)
+        else:
+            seed = self.emission[types]
+        levels = _relax(seed, air, shift == SUN)
+        old = (chunk.light >> shift) & MAX_LIGHT
+        chunk.light &= ~np.uint8(MAX_LIGHT << shift)
+        chunk.light |= levels.astype(voxel.LIGHT_DTYPE) << shift
+
+        for face, vector in enumerate(UNIT_VECTORS):
+            other = self.world.chunk_at(tuple(
+                k + d for k, d in zip(chunk.key, vector)))
+            if other is None:
+                continue
+            axis = voxel._normal_axis(face)
+            last = n - 1 if vector[axis] > 0 else 0
+            before = np.take(old, last, axis)
+            after = np.take(levels, last, axis)
+            beyond = (np.take(other.light, n - 1 - last, axis) >> shift) \
+                & MAX_LIGHT
+            beyond = beyond.astype(np.int16)
+            falls = shift == SUN and face == DOWN
+            rises = shift == SUN and face == voxel.opposite(DOWN)
+            if other not in batch:
+                # Light the neighbour may have taken from the old chunk.
+                took = (beyond != 0) & (after < before) & (
+                    (beyond < before) | (falls & (before == MAX_LIGHT)))
+                for key in _border_keys(other, axis, n - 1 - last, took):
+                    removed.append((key, self._darken(other, key, shift,
+                                                      touched, spread)))
+            # Light crossing the border either way.
+            gain = (after - 1 > beyond) | (falls & (after == MAX_LIGHT) &
+                                           (beyond < MAX_LIGHT))
+            spread.extend(_border_keys(chunk, axis, last, gain))
+            inflow = (beyond - 1 > after) | (rises & (beyond == MAX_LIGHT) &
+                                             (after < MAX_LIGHT))
+            spread.extend(_border_keys(other, axis, n - 1 - last, inflow))
+
+    def _remove(self, removed: List[Tuple[Key, int]], shift: int,
+                touched: Dict, skip: Set[voxel.Chunk]=frozenset()
+                ) -> List[Key]:
+        """Darken the cells lit by the given cells, which were darkened
+        from their given former levels, and everything lit through them.
+        Chunks in `skip` are left alone. Returns the cells at the edge of
+        the darkness, whose light has to spread back into it.
+        """
+        n = CHUNK_SIZE
+        views = _Views(self.world)
+        emission = self.emission.tolist() if shift == BLOCK else None
+        keep = ~(MAX_LIGHT << shift) & 0xFF
+        edge = []
+        queue: Deque[Tuple[int, int, int, int]] = deque(
+            (x, y, z, level) for (x, y, z), level in removed)
+        while queue:
+            x, y, z, level = queue.popleft()
+            for face, dx, dy, dz in FACES:
+                x1, y1, z1 = x + dx, y + dy, z + dz
+                view = views[x1 // n, y1 // n, z1 // n]
+                if view is None or view[0] in skip:
+                    continue
+                chunk, light, cells = view
+                cell = ((x1 % n) * n + y1 % n) * n + z1 % n
+                byte = light[cell]
+                near = (byte >> shift) & MAX_LIGHT
+                if not near:
+                    continue
+                if near < level or (face == DOWN and level == MAX_LIGHT and
+                                    shift == SUN):
+                    # Lit from the darkened cells, so darken it as well.
+                    emitted = emission[cells[cell]] if emission else 0
+                    light[cell] = byte & keep | emitted << shift
+                    touched.setdefault(chunk, set()).add(cell)
+                    queue.append((x1, y1, z1, near))
+                    if emitted:
+                        edge.append((x1, y1, z1))
+                else:
+                    edge.append((x1, y1, z1))
+        return edge
+
+    def _darken(self, chunk: voxel.Chunk, key: Key, shift: int,
+                touched: Dict, edge: List[Key]) -> int:
+        """Take the light of one cell away, apart from the light it gives
+        off itself, and return the level it had.
+        """
+        cell = voxel.cell_index(*key)
+        level = _get(chunk, cell, shift)
+        emitted = int(self.emission[chunk.cells[cell]]) if shift == BLOCK \
+            else 0
+        _set(chunk, cell, shift, emitted)
+        touched.setdefault(chunk, set()).add(cell)
+        if emitted:
+            edge.append(key)
+        return level
+
+    def _spread(self, spread: List[Key], shift: int, touched: Dict) -> None:
+        """Flood light outwards from the given cells into the air around
+        them.
+        """
+        n = CHUNK_SIZE
+        views = _Views(self.world)
+        keep = ~(MAX_LIGHT << shift) & 0xFF
+        queue: Deque[Tuple[int, int, int, int]] = deque()
+        for x, y, z in spread:
+            view = views[x // n, y // n, z // n]
+            if view is not None:
+                level = (view[1][voxel.cell_index(x, y, z)] >> shift) \
+                    & MAX_LIGHT
+                queue.append((x, y, z, level))
+        while queue:
+            x, y, z, level = queue.popleft()
+            if level <= 1:
+                continue
+            for face, dx, dy, dz in FACES:
+                x1, y1, z1 = x + dx, y + dy, z + dz
+                view = views[x1 // n, y1 // n, z1 // n]
+                if view is None:
+                    continue
+                chunk, light, cells = view
+                cell = ((x1 % n) * n + y1 % n) * n + z1 % n
+                if cells[cell]:
+                    continue
+                new = level - 1
+                if face == DOWN and level == MAX_LIGHT and shift == SUN:
+                    new = MAX_LIGHT
+                byte = light[cell]
+                if (byte >> shift) & MAX_LIGHT < new:
+                    light[cell] = byte & keep | new << shift
+                    touched.setdefault(chunk, set()).add(cell)
+                    queue.append((x1, y1, z1, new))
+
+    def _queue(self, touched: Dict[voxel.Chunk, Set[int]]) -> None:
+        """Queue the meshes that show the touched cells for a rebuild."""
+        for chunk, cells in touched.items():
+            if self.world.has_chunk(chunk):
+                local = np.stack(np.unravel_index(
+                    list(cells), (CHUNK_SIZE,) * 3), axis=1)
+                self.world.queue_cells(chunk, local)
+
+
+class _Views(dict):
+    """The chunks of a world by chunk coordinates, each with memoryviews of
+    its light and palette numbers by cell index, which are quicker to index
+    one cell at a time than the arrays. Holds None for missing chunks.
+    """
+    def __init__(self, world: voxel.VoxelWorld):
+        super().__init__()
+        self.world = world
+
+    def __missing__(self, key: Key):
+        chunk = self.world.chunk_at(key)
+        view = self[key] = None if chunk is None else (
+            chunk, memoryview(chunk.light_cells), memoryview(chunk.cells))
+        return view
+
+
+def _relax(seed: np.ndarray, air: np.ndarray, sun: bool) -> np.ndarray:
+    """Spread the light of `seed` through the air of a chunk until it
+    settles, as if the chunk were surrounded by darkness.
+    """
+    n = CHUNK_SIZE
+    levels = seed.astype(np.int16)
+    padded = np.zeros((n + 2,) * 3, dtype=np.int16)
+    while True:
+        padded[1:-1, 1:-1, 1:-1] = levels
+        best = np.zeros_like(levels)
+        for dx, dy, dz in UNIT_VECTORS:
+            np.maximum(best, padded[1 + dx:n + 1 + dx, 1 + dy:n + 1 + dy,
+                                    1 + dz:n + 1 + dz], out=best)
+        best -= 1
+        if sun:
+            falling = padded[1:-1, 1:-1, 2:] == MAX_LIGHT
+            best[falling] = MAX_LIGHT
+        new = np.where(air, np.maximum(levels, best), seed)
+        if np.array_equal(new, levels):
+            return levels
+        levels = new
+
+
+def _get(chunk: voxel.Chunk, cell: int, shift: int) -> int:
+    return (int(chunk.light_cells[cell]) >> shift) & MAX_LIGHT
+
+
+def _set(chunk: voxel.Chunk, cell: int, shift: int, level: int) -> None:
+    byte = int(chunk.light_cells[cell]) & ~(MAX_LIGHT << shift)
+    chunk.light_cells[cell] = byte | level << shift
+
+
+def _border_keys(chunk: voxel.Chunk, axis: int, layer: int,
+                 mask: np.ndarray) -> List[Key]:
+    """Return the blocks of a chunk's border layer picked by `mask`."""
+    cells = np.argwhere(mask)
+    cells = np.insert(cells, axis, layer, axis=1) + \
+        np.array(chunk.key) * CHUNK_SIZE
+    return [tuple(key) for key in cells.tolist()]
+
+
+def _neighbors(key: Key) -> List[Key]:
+    x, y, z = key
+    return [(x + dx, y + dy, z + dz) for dx, dy, dz in UNIT_VECTORS]
@@ -0,0 +1,123 @@
+# coding=utf-8
+"""Keep Bullet collision shapes in sync with the chunks of a voxel world."""
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+from panda3d.bullet import BulletBoxShape
+from panda3d.bullet import BulletRigidBodyNode
+from panda3d.bullet import BulletTriangleMesh
+from panda3d.bullet import BulletTriangleMeshShape
+from panda3d.bullet import BulletWorld
+from panda3d.core import NodePath
+from panda3d.core import Point3
+from panda3d.core import TransformState
+from panda3d.core import Vec3
+
+import voxel
+
+# Chunks that need more boxes than this collide against their mesh instead.
+MAX_COLLISION_BOXES = 128
+
+Box = Tuple[Tuple[int, int, int], Tuple[int, int, int]]  # start, size
+
+
+def box_decomposition(occupied: np.ndarray,
+                      limit: int=None) -> Optional[List[Box]]:
+    """Cover the occupied cells with few, non-overlapping boxes: the runs
+    of cells along z, merged with the matching runs next to them along y,
+    then along x. Returns None if that takes more than `limit` boxes.
+    """
+    edges = np.diff(np.pad(occupied, ((0, 0), (0, 0), (1, 1))).astype(
+        np.int8), axis=2)
+    # Starts and ends come in the same order, one of each per run.
+    x, y, z = np.nonzero(edges == 1)
+    ends = np.nonzero(edges == -1)[2]
+    ones = np.ones_like(x)
+    boxes = np.column_stack((x, y, z, ones, ones, ends - z))
+    boxes = _merge_along(_merge_along(boxes, 1), 0)
+    if limit is not None and len(boxes) > limit:
+        return None
+    return [(tuple(box[:3]), tuple(box[3:])) for box in boxes.tolist()]
+
+
+def _merge_along(boxes: np.ndarray, axis: int) -> np.ndarray:
+    """Merge the boxes, as rows of start and size, that touch along `axis`
+    and are the same in the other two axes.
+    """
+    if not len(boxes):
+        return boxes
+    others = [c for c in range(6) if c not in (axis, axis + 3)]
+    # Sorted by the other axes, then along `axis`
+    boxes = boxes[np.lexsort([boxes[:, axis]] +
+                             [boxes[:, c] for c in reversed(others)])]
+    same = (boxes[1:, others] == boxes[:-1, others]).all(axis=1)
+    touching = boxes[1:, axis] == boxes[:-1, axis] + boxes[:-1, axis + 3]
+    first = np.flatnonzero(np.concatenate(([True], ~(same & touching))))
+    merged = boxes[first]
+    merged[:, axis + 3] = np.add.reduceat(boxes[:, axis + 3], first)
+    return merged
+
+
+def make_chunk_body(chunk: voxel.Chunk) -> BulletRigidBodyNode:
+    """Build a static body colliding like the voxels of `chunk`. Its
+    shapes are relative to the chunk's origin.
+    """
+    node = BulletRigidBodyNode('chunk_{}_{}_{}'.format(*chunk.key))
+    boxes = box_decomposition(chunk.occupied, MAX_COLLISION_BOXES)
+    if boxes is None:
+        # Mesh the voxels themselves, as the chunk's own mesh may still be
+        # waiting for a worker thread.
+        triangles = voxel.build_mesh(voxel.Mesher.Greedy,
+                                     voxel.pad(chunk.types))
+        vertices = [Point3(*v) for v in triangles.rows[:, :3].tolist()]
+        mesh = BulletTriangleMesh()
+        for a, b, c in triangles.indices.reshape(-1, 3).tolist():
+            mesh.addTriangle(vertices[a], vertices[b], vertices[c])
+        node.addShape(BulletTriangleMeshShape(mesh, dynamic=False))
+        return node
+
+    s = voxel.CUBE_SIZE / 2.0
+    for start, size in boxes:
+        half = Vec3(*((n - 1) / 2.0 + s for n in size))
+        center = Vec3(*(p + (n - 1) / 2.0 for p, n in zip(start, size)))
+        node.addShape(BulletBoxShape(half), TransformState.makePos(center))
+    return node
+
+
+class ChunkColliders:
+    """One static rigid body per chunk, rebuilt only for chunks that changed.
+    """
+    def __init__(self, physics: BulletWorld, parent: NodePath):
+        self.physics = physics
+        self.parent = parent
+        self._bodies: Dict[Tuple[int, int, int], NodePath] = {}
+        self._dirty: Set[voxel.Chunk] = set()
+
+    def mark_dirty(self, chunk: voxel.Chunk) -> None:
+        """Queue the body of `chunk` to be rebuilt on the next update."""
+        self._dirty.add(chunk)
+
+    def update(self) -> None:
+        """Rebuild the bodies of all chunks changed since the last update."""
+        for chunk in self._dirty:
+            self.remove(chunk.key)
+            if not len(chunk):
+                continue
+            node = make_chunk_body(chunk)
+            node_path = self.parent.attachNewNode(node)
+            node_path.setPos(*chunk.origin)
+            self.physics.attachRigidBody(node)
+            self._bodies[chunk.key] = node_path
+        self._dirty.clear()
+
+    def unload(self, chunk: voxel.Chunk) -> None:
+        """Forget `chunk` entirely, eg. when it is streamed out."""
+        self._dirty.discard(chunk)
+        self.remove(chunk.key)
+
+    def remove(self, key: Tuple[int, int, int]) -> None:
+        """Drop the body of the chunk at `key`, if it has one."""
+        node_path = self._bodies.pop(key, None)
+        if node_path is not None:
+            self.physics.removeRigidBody(node_path.node())
+            node_path.removeNode()
@@ -0,0 +1,238 @@
+# coding=utf-8
+"""Read and write voxel worlds in a compact, chunked binary format.
+
+A world file starts with a fixed header, followed by the palette of voxel
+types as JSON, a table with the position of every chunk and finally the
+chunks themselves. Each chunk is a run-length encoded array of palette
+indices, where 0 is air and `i` is `palette[i - 1]`.
+
+Edits made since the last save can be appended to a journal next to the
+world file, which is much cheaper than writing the whole world again. Each
+journal entry holds its own palette, followed by the changed blocks and
+their new palette indices. Loading a world replays its journal, and saving
+it folds the journal back in.
+"""
+import json
+import mmap
+import os
+import struct
+from typing import Dict, Iterator, List, Mapping, Tuple
+
+import numpy as np
+
+import terrain
+import voxel
+
+MAGIC = b'EVOX'
+VERSION = 1
+HEADER = struct.Struct('<4sHHII')  # magic, version, chunk size, chunks, palette
+TABLE_ENTRY = struct.Struct('<iiiQI')  # chunk key, data offset, data length
+RUN = np.dtype([('length', '<u2'), ('value', '<u2')])
+JOURNAL_SUFFIX = '.journal'
+JOURNAL_MAGIC = b'EVXJ'
+JOURNAL_ENTRY = struct.Struct('<4sII')  # magic, changes, palette length
+CHANGE = np.dtype([('position', '<i4', 3), ('value', '<u2')])
+
+ChunkKey = Tuple[int, int, int]
+
+
+def encode_runs(cells: np.ndarray) -> bytes:
+    """Run-length encode a flat array of palette indices."""
+    starts = np.flatnonzero(np.diff(cells)) + 1
+    starts = np.concatenate(([0], starts))
+    runs = np.empty(len(starts), dtype=RUN)
+    runs['length'] = np.diff(np.append(starts, len(cells)))
+    runs['value'] = cells[starts]
+    return runs.tobytes()
+
+
+def decode_runs(data, volume: int) -> np.ndarray:
+    """Expand run-length encoded palette indices back to a flat array."""
+    runs = np.frombuffer(data, dtype=RUN)
+    cells = np.repeat(runs['value'], runs['length'])
+    if len(cells) != volume:
+        raise ValueError('Corrupt chunk: {} cells instead of {}'.format(
+            len(cells), volume))
+    return cells
+
+
+class WorldFile:
+    """A saved world, opened read-only. The file is memory-mapped and each
+    chunk is only decoded when asked for.
+    """
+    def __init__(self, path: str):
+        self._file = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        except ValueError:  # Empty files can't be mapped.
+            self._file.close()
+            raise ValueError('{} is not a world file'.format(path))
+
+        if len(self._map) < HEADER.size:
+            self.close()
+            raise ValueError('{} is not a world file'.format(path))
+        magic, version, self.chunk_size, count, palette_length = \
+            HEADER.unpack_from(self._map)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError('{} is not a world file'.format(path))
+        if version != VERSION:
+            self.close()
+            raise ValueError('Unsupported world file version {}'.format(
+                version))
+
+        offset = HEADER.size
+        palette = self._map[offset:offset + palette_length]
+        self.palette: List = json.loads(palette.decode('utf-8'))
+        offset += palette_length
+
+        self._table: Dict[ChunkKey, Tuple[int, int]] = {}
+        for _ in range(count):
+            x, y, z, start, length = TABLE_ENTRY.unpack_from(self._map, offset)
+            self._table[x, y, z] = start, length
+            offset += TABLE_ENTRY.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __iter__(self) -> Iterator[ChunkKey]:
+        return iter(self._table)
+
+    def __len__(self):
+        return len(self._table)
+
+    def __contains__(self, key: ChunkKey):
+        return key in self._table
+
+    def __getitem__(self, key: ChunkKey) -> np.ndarray:
+        """Decode the palette indices of one chunk, indexed by local x, y
+        and z.
+        """
+        start, length = self._table[key]
+        data = memoryview(self._map)[start:start + length]
+        try:
+            cells = decode_runs(data, self.chunk_size ** 3)
+        finally:
+            data.release()
+        return cells.reshape((self.chunk_size,) * 3)
+
+    def close(self) -> None:
+        """Release the memory map and the file."""
+        self._map.close()
+        self._file.close()
+
+
+def save(world: voxel.VoxelWorld, path: str,
+         held: Mapping[ChunkKey, np.ndarray]=None) -> None:
+    """Write every voxel of `world` to `path`, replacing it atomically.
+    `held` adds chunks that are not in the world right now, as arrays of
+    its palette numbers, such as the edited chunks a `terrain.ChunkStreamer`
+    unloaded.
+    """
+    # Chunks already store palette numbers, so they are written as they are.
+    # Chunks emptied by edits are kept too, so that streamed worlds do not
+    # generate them again.
+    palette = list(world.palette)
+    chunks: List[Tuple[ChunkKey, bytes]] = [
+        (chunk.key, encode_runs(chunk.cells)) for chunk in world.chunks]
+    chunks.extend((key, encode_runs(types.reshape(-1)))
+                  for key, types in (held or {}).items())
+
+    palette_data = json.dumps(palette).encode('utf-8')
+    offset = HEADER.size + len(palette_data) + TABLE_ENTRY.size * len(chunks)
+    parts = [HEADER.pack(MAGIC, VERSION, voxel.CHUNK_SIZE, len(chunks),
+                         len(palette_data)),
+             palette_data]
+    for key, data in chunks:
+        parts.append(TABLE_ENTRY.pack(*key, offset, len(data)))
+        offset += len(data)
+    parts.extend(data for _, data in chunks)
+
+    temporary = path + '.tmp'
+    with open(temporary, 'wb') as outfile:
+        outfile.write(b''.join(parts))
+    os.replace(temporary, path)
+    # Everything in the journal is part of the world file now.
+    try:
+        os.remove(path + JOURNAL_SUFFIX)
+    except FileNotFoundError:
+        pass
+
+
+def load(path: str, world: voxel.VoxelWorld,
+         streamer: terrain.ChunkStreamer=None) -> None:
+    """Fill `world` with the chunks saved in `path`, replacing the ones it
+    already holds at the same keys. With a `streamer`, the saved chunks are
+    handed to it instead, to be loaded in place of generated ones as the
+    player comes near them.
+    """
+    with WorldFile(path) as world_file:
+        if world_file.chunk_size != voxel.CHUNK_SIZE:
+            raise ValueError('{} uses chunks of {} blocks'.format(
+                path, world_file.chunk_size))
+        if streamer is not None:
+            lookup = np.array([0] + [world.palette.id_of(t)
+                                     for t in world_file.palette],
+                              dtype=voxel.TYPE_DTYPE)
+            for key in world_file:
+                streamer.hold(key, lookup[world_file[key]])
+        else:
+            # Whole chunks at once, each queued for meshing only once.
+            for key in world_file:
+                world.set_chunk(key, world_file[key], world_file.palette)
+    replay_journal(path, world, streamer)
+
+
+def append_journal(path: str, world: voxel.VoxelWorld, positions: np.ndarray,
+                   type_ids: np.ndarray) -> None:
+    """Record that the blocks at `positions` now hold the palette numbers
+    `type_ids` of `world`, 0 for air, in the journal of the world saved at
+    `path`.
+    """
+    changes = np.empty(len(positions), dtype=CHANGE)
+    changes['position'] = positions
+    changes['value'] = type_ids
+    palette_data = json.dumps(list(world.palette)).encode('utf-8')
+    with open(path + JOURNAL_SUFFIX, 'ab') as outfile:
+        outfile.write(b''.join((
+            JOURNAL_ENTRY.pack(JOURNAL_MAGIC, len(changes), len(palette_data)),
+            palette_data, changes.tobytes())))
+
+
+def replay_journal(path: str, world: voxel.VoxelWorld,
+                   streamer: terrain.ChunkStreamer=None) -> int:
+    """Apply the journal of the world saved at `path` to `world`, and
+    return how many entries it held. An entry cut short, say by a crash
+    while it was written, ends the journal. With a `streamer`, the chunks
+    an entry touches are loaded first, so it edits them rather than air.
+    """
+    try:
+        with open(path + JOURNAL_SUFFIX, 'rb') as infile:
+            data = infile.read()
+    except FileNotFoundError:
+        return 0
+    offset = entries = 0
+    while offset + JOURNAL_ENTRY.size <= len(data):
+        magic, count, palette_length = JOURNAL_ENTRY.unpack_from(data, offset)
+        start = offset + JOURNAL_ENTRY.size
+        end = start + palette_length + count * CHANGE.itemsize
+        if magic != JOURNAL_MAGIC or end > len(data):
+            break
+        palette = json.loads(data[start:start + palette_length].decode('utf-8'))
+        changes = np.frombuffer(data, dtype=CHANGE, count=count,
+                                offset=start + palette_length)
+        lookup = np.array([0] + [world.palette.id_of(t) for t in palette],
+                          dtype=voxel.TYPE_DTYPE)
+        if streamer is not None:
+            keys = np.unique(np.floor_divide(changes['position'],
+                                             voxel.CHUNK_SIZE), axis=0)
+            for key in map(tuple, keys.tolist()):
+                if key not in streamer:
+                    streamer.load(key)
+        world.set_voxels(changes['position'], lookup[changes['value']])
+        offset, entries = end, entries + 1
+    return entries